@@ -0,0 +1,5 @@
+import os
+
+# The tests check the arguments, and pytest imports the package before
+# `test.py`, so typeguard is enabled here:
+os.environ.setdefault("TALK_WITH_ME_TYPECHECK", "1")
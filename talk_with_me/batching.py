@@ -0,0 +1,182 @@
+"""
+Batches of padded pairs for training the seq2seq chatbot.
+"""
+from typing import Iterator, List, Optional, Tuple
+import numpy as np
+from .vocabulary import Voc, PAD_token
+
+# Padded input, input lengths, padded target, target mask and max target length,
+# as returned by `batch2TrainData` from the chatbot notebook:
+Batch = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]
+
+
+def _pad(
+    indexes: np.ndarray, offsets: np.ndarray, order: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pad encoded sentences, taken in `order`, into one matrix.
+
+    Returns
+    -------
+    np.ndarray
+        int64 matrix of shape (number of sentences, max length).
+    np.ndarray
+        int64 lengths of the sentences.
+    """
+
+    lengths = (offsets[1:] - offsets[:-1])[order]
+    matrix = np.full(
+        (len(order), lengths.max() if len(order) else 0), PAD_token, dtype=np.int64
+    )
+    rows = np.repeat(np.arange(len(order)), lengths)
+    columns = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    matrix[rows, columns] = indexes[np.repeat(offsets[:-1][order], lengths) + columns]
+    return matrix, lengths
+
+
+class BucketBatcher:
+    """
+    Pairs grouped into batches of similar length and padded once.
+
+    Pairs are sorted by the length of the input and split into buckets of
+    `bucket_width` input lengths, every bucket is split into batches. All
+    pairs are padded once into contiguous matrices and every batch is a view
+    of them trimmed to its own max lengths, so serving a batch costs no loops
+    and no copies. Every epoch the rows are permuted within their buckets,
+    so the batches are made of different pairs, and the batches are served
+    in random order.
+
+    Parameters
+    ----------
+    voc : Voc
+        Vocabulary which contains all words of the pairs, see `Voc.fit_pairs`.
+    pairs : list of lists of str
+        Pairs from `Data4Chatbot.make_data`.
+    batch_size : int (default=64)
+        Max number of pairs in a batch.
+    bucket_width : int (default=1)
+        Number of different input lengths in a bucket. Wider buckets give
+        fewer incomplete batches, but more padding.
+    max_length : int or None (default=None)
+        Pairs with sentences longer than this, EOS included, are skipped.
+    seed : int or None (default=None)
+        Seed of the contents and of the order of batches.
+    """
+
+    def __init__(
+        self,
+        voc: Voc,
+        pairs: List[List[str]],
+        batch_size: int = 64,
+        bucket_width: int = 1,
+        max_length: Optional[int] = None,
+        seed: Optional[int] = None,
+    ):
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+
+        q_indexes, q_offsets, a_indexes, a_offsets = voc.encode_pairs(pairs)
+        if (q_indexes < 0).any() or (a_indexes < 0).any():
+            raise KeyError("Pairs contain words which are not in the vocabulary")
+        q_lengths, a_lengths = np.diff(q_offsets), np.diff(a_offsets)
+
+        # Longest inputs first, as `pack_padded_sequence` expects:
+        order = np.lexsort((-a_lengths, -q_lengths))
+        if max_length is not None:
+            keep = (q_lengths <= max_length) & (a_lengths <= max_length)
+            order = order[keep[order]]
+
+        self.inputs, self.input_lengths = _pad(q_indexes, q_offsets, order)
+        self.targets, self.target_lengths = _pad(a_indexes, a_offsets, order)
+        self.mask = np.arange(self.targets.shape[1]) < self.target_lengths[:, None]
+
+        # Batches do not cross the bounds of buckets:
+        self.buckets = (self.input_lengths - 1) // bucket_width
+        bounds = np.concatenate(
+            [[0], np.flatnonzero(np.diff(self.buckets)) + 1, [len(order)]]
+        )
+        starts = np.concatenate(
+            [
+                np.arange(start, end, batch_size)
+                for start, end in zip(bounds, bounds[1:])
+            ]
+            + [np.zeros(0, dtype=np.int64)]
+        ).astype(np.int64)
+        ends = np.append(starts[1:], len(order))[: len(starts)]
+        self.batch_bounds = np.stack([starts, ends], axis=1)
+        self.batch_ids = np.repeat(np.arange(len(starts)), ends - starts)
+        self._update_max_lengths()
+
+    def _update_max_lengths(self):
+        """Max lengths of every batch, after the rows were placed."""
+
+        starts = self.batch_bounds[:, 0]
+        if len(starts):
+            self.max_input_lengths = self.input_lengths[starts]
+            self.max_target_lengths = np.maximum.reduceat(self.target_lengths, starts)
+        else:
+            self.max_input_lengths = self.max_target_lengths = np.zeros(0, np.int64)
+
+    def shuffle(self):
+        """
+        Permute the rows within their buckets, which gives new contents to
+        the batches. Rows of a batch stay sorted by input length.
+        """
+
+        order = np.lexsort((self.rng.random(len(self.buckets)), self.buckets))
+        order = order[np.lexsort((-self.input_lengths[order], self.batch_ids))]
+        self.inputs, self.input_lengths = self.inputs[order], self.input_lengths[order]
+        self.targets, self.target_lengths = (
+            self.targets[order],
+            self.target_lengths[order],
+        )
+        self.mask = self.mask[order]
+        self._update_max_lengths()
+
+    def __len__(self) -> int:
+        return len(self.batch_bounds)
+
+    def __getitem__(self, i: int) -> Batch:
+        """
+        Returns the batch `i` in the format of `batch2TrainData`, but as numpy
+        views: time-major padded input, input lengths, time-major padded target,
+        target mask and max target length. Use `torch.from_numpy` to get tensors.
+        """
+
+        start, end = self.batch_bounds[i]
+        max_input_length = self.max_input_lengths[i]
+        max_target_length = self.max_target_lengths[i]
+        return (
+            self.inputs[start:end, :max_input_length].T,
+            self.input_lengths[start:end],
+            self.targets[start:end, :max_target_length].T,
+            self.mask[start:end, :max_target_length].T,
+            int(max_target_length),
+        )
+
+    def __iter__(self) -> Iterator[Batch]:
+        """Batches of one epoch with new contents, in random order."""
+
+        self.shuffle()
+        for i in self.rng.permutation(len(self)):
+            yield self[i]
+
+    def padding_efficiency(self) -> dict:
+        """
+        Share of real tokens among all tokens of the padded batches,
+        for inputs, targets and both together.
+        """
+
+        sizes = self.batch_bounds[:, 1] - self.batch_bounds[:, 0]
+        real_inputs = int(self.input_lengths.sum())
+        real_targets = int(self.target_lengths.sum())
+        padded_inputs = int((sizes * self.max_input_lengths).sum())
+        padded_targets = int((sizes * self.max_target_lengths).sum())
+        return {
+            "inputs": real_inputs / max(padded_inputs, 1),
+            "targets": real_targets / max(padded_targets, 1),
+            "total": (real_inputs + real_targets)
+            / max(padded_inputs + padded_targets, 1),
+        }
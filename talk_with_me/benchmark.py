@@ -0,0 +1,965 @@
+"""
+Microbenchmarks for the data preparation pipeline.
+
+Usage:
+    python -m talk_with_me.benchmark clear_message
+    python -m talk_with_me.benchmark html_parser --chats 100 --files 30
+    python -m talk_with_me.benchmark vocabulary --pairs 1000000
+    python -m talk_with_me.benchmark batching --pairs 200000
+    python -m talk_with_me.benchmark pairs --pairs 1000000
+    python -m talk_with_me.benchmark pipeline --chats 50 --files 10 --output out.json
+    python -m talk_with_me.benchmark reader --chats 40 --files 30
+    python -m talk_with_me.benchmark startup
+    python -m talk_with_me.benchmark decoder --messages 1000 --batch-size 64
+    python -m talk_with_me.benchmark conversation --batch-size 64 --turns 10
+    python -m talk_with_me.benchmark export --messages 1000 --batch-size 64
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, List, Optional, Tuple
+from .data4ml import Data4Chatbot, Data4TextGeneration
+from .batching import BucketBatcher
+from .html_parser import PARSERS, detect_encoding
+from .vocabulary import Voc, EOS_token, PAD_token, SOS_token
+from .perfect_regex import (
+    perfect_url_regex,
+    perfect_emoji_regex,
+    perfect_email_regex,
+    perfect_phone_regex,
+)
+
+DATA4TEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data4test")
+PATH_TO_CONFIG = os.path.join(os.path.dirname(DATA4TEST), "..", "data_params.json")
+
+SAMPLE_MESSAGES = [
+    "Привет, как дела?",
+    "Вариант подарка\nФотография\nhttps://sun9-31.userapi.com/c205628/v205628626/19be1/bCtv1V6LIkg.jpg",
+    "Ок\n25 прикреплённых сообщений",
+    "Вот моя почта: yanko.julia@yandex.ru, записывай",
+    "А это 8(800)555-35-35 мой номер",
+    "Весело\nАудиозапись",
+    "\nВидеозапись\nhttps://vk.com/video-111096931_456261957",
+    "https://youtu.be/u5QL2SoHYdA",
+    "Всё👌",
+    "\nСтикер",
+]
+
+
+def legacy_clear_message(data: Data4TextGeneration, message: str) -> str:
+    """`Data4ML._clear_message` as it was before the rules were precompiled."""
+
+    if "\nСсылка\nhttps:" in message or "#comments" in message:
+        return ""
+    for end in data.message_ends:
+        if message.endswith(end):
+            message = message[: message.rfind("\n")]
+    for attachment in data.blacklist:
+        message = re.sub(f"[\n]?{attachment}[\n]?" + perfect_url_regex, "", message)
+        message = re.sub(f"[\n]?{attachment}[\n]?$", "", message)
+    message = re.sub(perfect_emoji_regex, "", message)
+    message = re.sub(perfect_email_regex, "", message)
+    message = re.sub(perfect_phone_regex, " ", message)
+    message = re.sub(perfect_url_regex, "", message)
+    message = re.sub("[\n]?Аудиозапись[\n]?", "", message)
+    message = re.sub("  ", " ", message)
+    return message.strip()
+
+
+def load_messages() -> List[str]:
+    """Messages of all chats from `data4test` and a few handmade samples."""
+
+    data = Data4TextGeneration(path_to_config=PATH_TO_CONFIG)
+    messages = list(SAMPLE_MESSAGES)
+    for folder in data.get_list_of_folders(DATA4TEST):
+        parent_folder = os.path.join(DATA4TEST, folder)
+        files = data.get_list_of_files_in_folder(parent_folder)
+        messages.extend(data.parse_html(parent_folder, files))
+    return messages
+
+
+def measure(func: Callable[[str], str], messages: List[str], repeat: int) -> float:
+    """Returns the number of messages processed per second."""
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in messages:
+            func(message)
+    return repeat * len(messages) / (time.perf_counter() - start)
+
+
+def make_archive(path: str, chats: int, files: int) -> None:
+    """
+    Make a `messages` folder with `chats` chats of `files` html files each
+    by copying the files from `data4test`.
+    """
+
+    templates = sorted(glob.glob(os.path.join(DATA4TEST, "*", "*.html")))
+    for chat in range(chats):
+        folder = os.path.join(path, str(100000000 + chat))
+        os.makedirs(folder)
+        for i in range(files):
+            template = templates[(chat + i) % len(templates)]
+            shutil.copyfile(template, os.path.join(folder, f"messages{i * 300}.html"))
+
+
+SYNTHETIC_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="windows-1251">
+  <title>VK</title>
+</head>
+<body>
+  <div class="wrap">
+    <div class="page_content page_block">
+      <h2 class="page_block_h2">
+<div class="page_block_header clear_fix">
+  <div class="page_block_header_inner _header_inner"><div class="ui_crumb" >{name}</div></div>
+</div>
+</h2>
+      <div class="wrap_page_content">"""
+
+SYNTHETIC_MESSAGE = """<div class="item">
+  <div class='item__main'><div class="message" data-id="{id}">
+  <div class="message__header">{author}, {day} {month} 2016 в {time}</div>
+  <div>{body}</div>
+</div></div>
+</div>"""
+
+SYNTHETIC_ATTACHMENT = """<div class="kludges"><div class="attachment">
+  <div class="attachment__description">{kind}</div>
+  <a class='attachment__link' href='{url}'>{url}</a>
+</div></div>"""
+
+SYNTHETIC_TAIL = """      </div>
+    </div>
+  </div>
+</body>
+</html>"""
+
+MONTHS = "янв фев мар апр мая июн июл авг сен окт ноя дек".split()
+WORDS = (
+    "привет как дела что делаешь сегодня завтра вечером пойдём гулять "
+    "спасибо хорошо давай конечно нет да может потом позвони напиши "
+    "hello ok cool see you later"
+).split()
+EMOJI = ["👌", "😂", "❤", "👍", "🙂"]
+ATTACHMENTS = ["Фотография", "Видеозапись", "Документ", "Аудиозапись", "Ссылка"]
+
+
+def make_synthetic_archive(
+    path: str,
+    chats: int = 100,
+    files: int = 30,
+    messages: int = 300,
+    attachments: float = 0.1,
+    emoji: float = 0.1,
+    urls: float = 0.05,
+    seed: int = 0,
+) -> None:
+    """
+    Make a `messages` folder of random chats in the format of the VK archive,
+    like the files of `data4test`.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the archive.
+    chats : int (default=100)
+        Number of valid chats. A few folders which `get_list_of_folders`
+        skips (groups and group chats) are added as well.
+    files : int (default=30)
+        Number of html files in every chat.
+    messages : int (default=300)
+        Number of messages in every file, the VK archive has 300.
+    attachments : float (default=0.1)
+        Share of messages with an attachment.
+    emoji : float (default=0.1)
+        Share of messages with an emoji.
+    urls : float (default=0.05)
+        Share of messages with a link in the text.
+    """
+
+    rng = random.Random(seed)
+    folders = [str(100000000 + chat) for chat in range(chats)]
+    folders += [f"-{100000000 + chat}" for chat in range(max(1, chats // 20))]
+    folders += [str(2000000000 + chat) for chat in range(max(1, chats // 20))]
+
+    message_id = 0
+    for folder in folders:
+        os.makedirs(os.path.join(path, folder))
+        for i in range(files):
+            items = []
+            for _ in range(messages):
+                message_id += 1
+                text = " ".join(rng.choices(WORDS, k=rng.randint(1, 12)))
+                if rng.random() < emoji:
+                    text += rng.choice(EMOJI)
+                if rng.random() < urls:
+                    text += f" https://vk.com/wall-{rng.randint(1, 10 ** 8)}_1"
+                if rng.random() < attachments:
+                    url = f"https://sun9-{rng.randint(1, 99)}.userapi.com/{message_id}.jpg"
+                    text += SYNTHETIC_ATTACHMENT.format(
+                        kind=rng.choice(ATTACHMENTS), url=url
+                    )
+                author = (
+                    "Вы"
+                    if rng.random() < 0.5
+                    else f'<a href="https://vk.com/id{folder}">Собеседник {folder}</a>'
+                )
+                items.append(
+                    SYNTHETIC_MESSAGE.format(
+                        id=message_id,
+                        author=author,
+                        day=rng.randint(1, 28),
+                        month=rng.choice(MONTHS),
+                        time=f"{rng.randint(0, 23)}:{rng.randint(0, 59):02}:00",
+                        body=text,
+                    )
+                )
+            html = (
+                SYNTHETIC_HEAD.format(name=f"Собеседник {folder}")
+                + "".join(items)
+                + SYNTHETIC_TAIL
+            )
+            with open(
+                os.path.join(path, folder, f"messages{i * messages}.html"), "wb"
+            ) as f:
+                f.write(html.encode("cp1251", "xmlcharrefreplace"))
+
+
+def profile(func: Callable[[], Any]) -> Tuple[Any, float, int]:
+    """
+    Run `func` twice: without tracing to measure the time and with
+    `tracemalloc` to measure the peak memory of Python allocations.
+
+    Returns
+    -------
+    any
+        Result of `func`.
+    float
+        Elapsed seconds.
+    int
+        Peak traced memory in bytes.
+    """
+
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_pipeline(
+    chats: int = 100,
+    files: int = 30,
+    messages: int = 300,
+    attachments: float = 0.1,
+    emoji: float = 0.1,
+    urls: float = 0.05,
+    jobs: int = 1,
+    output: Optional[str] = None,
+    **kwargs,
+) -> dict:
+    """
+    Throughput and peak memory of every stage of `Data4Chatbot` on a synthetic
+    archive, printed or saved as json to compare them between commits.
+
+    Items of a stage are its inputs: folders for `get_list_of_files_in_folder`,
+    files for `parse_html` and messages for the rest. Peak memory counts only
+    Python allocations, not the ones inside lxml.
+    """
+
+    params = {
+        "chats": chats,
+        "files": files,
+        "messages": messages,
+        "attachments": attachments,
+        "emoji": emoji,
+        "urls": urls,
+        "jobs": jobs,
+    }
+    stages = {}
+
+    def run(name: str, func: Callable[[], Any], items: Optional[int] = None) -> Any:
+        """Profile a stage, which processes `items` inputs or as many as it returns."""
+
+        result, elapsed, peak = profile(func)
+        if items is None:
+            items = len(result)
+        stages[name] = {
+            "items": items,
+            "outputs": len(result),
+            "seconds": elapsed,
+            "items_per_sec": items / elapsed if elapsed else None,
+            "peak_memory_mb": peak / 2**20,
+        }
+        print(
+            f"{name:>27}: {items:>9,} items, {elapsed:7.2f} s, "
+            f"{stages[name]['items_per_sec'] or 0:>12,.0f} items/sec, "
+            f"{stages[name]['peak_memory_mb']:8.1f} MB",
+            file=sys.stderr,
+        )
+        return result
+
+    with tempfile.TemporaryDirectory() as archive:
+        make_synthetic_archive(
+            archive, chats, files, messages, attachments, emoji, urls
+        )
+        data = Data4Chatbot(path_to_config=PATH_TO_CONFIG, n_jobs=jobs)
+        data.home_folder = archive
+
+        folders = run("get_list_of_folders", lambda: data.get_list_of_folders(archive))
+        paths = [os.path.join(archive, folder) for folder in folders]
+        chat_files = run(
+            "get_list_of_files_in_folder",
+            lambda: [data.get_list_of_files_in_folder(path) for path in paths],
+        )
+        n_files = sum(map(len, chat_files))
+        chat_messages = run(
+            "parse_html",
+            lambda: [
+                data.parse_html(path, files) for path, files in zip(paths, chat_files)
+            ],
+            n_files,
+        )
+        n_messages = sum(map(len, chat_messages))
+
+        # Texts without headers, as `clear_messages` passes them:
+        texts = [
+            message[message.find("\n") + 1 :]
+            for messages_ in chat_messages
+            for message in messages_
+        ]
+        cleared = run("_clear_message", lambda: [data._clear_message(m) for m in texts])
+        run("normalize_message", lambda: [data.normalize_message(m) for m in cleared])
+        merged = [data.clear_messages(messages_) for messages_ in chat_messages]
+        run(
+            "get_pairs",
+            lambda: [pair for m in merged for pair in data.get_pairs(m)],
+            sum(map(len, merged)),
+        )
+        run("make_data", lambda: data.make_data(limit=1), n_messages)
+
+    results = {
+        "benchmark": "pipeline",
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "html_parser": data.html_parser,
+        "params": params,
+        "stages": stages,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    return results
+
+
+def bench_html_parser(chats: int = 100, files: int = 30, **kwargs) -> None:
+    with tempfile.TemporaryDirectory() as archive:
+        make_archive(archive, chats, files)
+        paths = sorted(glob.glob(os.path.join(archive, "*", "*.html")))
+
+        # Encoding sniffed in every file, detected once, detected once and mmap:
+        encoding = detect_encoding(paths[0])
+        variants = [(None, False), (encoding, False), (encoding, True)]
+
+        results = {}
+        for name, parse_file in PARSERS.items():
+            for file_encoding, use_mmap in variants:
+                label = f"{name}, encoding={file_encoding}, mmap={use_mmap}"
+                start = time.perf_counter()
+                messages = [parse_file(file, file_encoding, use_mmap) for file in paths]
+                elapsed = time.perf_counter() - start
+                results[label] = messages
+                print(
+                    f"{label:>36}: {len(paths) / elapsed:,.0f} files/sec, "
+                    f"{sum(map(len, messages)) / elapsed:,.0f} messages/sec"
+                )
+        first = next(iter(results.values()))
+        assert all(messages == first for messages in results.values())
+
+
+def evict(paths: List[str]) -> None:
+    """Drop the files from the page cache, so that they are read from disk."""
+
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def bench_reader(
+    chats: int = 100,
+    files: int = 30,
+    messages: int = 300,
+    jobs: int = 1,
+    **kwargs,
+) -> None:
+    """
+    Files per second of `make_data` without and with `prefetch` threads,
+    with the html files evicted from the page cache (cold) and cached (warm).
+    Eviction is a hint to the kernel, it needs a disk under the temp folder.
+    """
+
+    with tempfile.TemporaryDirectory() as archive:
+        make_synthetic_archive(archive, chats, files, messages, 0.1, 0.1, 0.05)
+        paths = sorted(glob.glob(os.path.join(archive, "*", "*.html")))
+        expected = None
+        for state in ["cold", "warm"]:
+            for threads in [0, 4, 16]:
+                data = Data4Chatbot(
+                    path_to_config=PATH_TO_CONFIG,
+                    home_folder=archive,
+                    n_jobs=jobs,
+                    prefetch=threads,
+                )
+                if state == "cold":
+                    evict(paths)
+                start = time.perf_counter()
+                pairs = data.make_data(limit=1)
+                elapsed = time.perf_counter() - start
+                expected = expected or pairs
+                assert pairs == expected
+                print(
+                    f"{state}, prefetch={threads:>2}: "
+                    f"{len(paths) / elapsed:10,.0f} files/sec"
+                )
+
+
+def bench_clear_message(repeat: int = 200, **kwargs) -> None:
+    data = Data4TextGeneration(path_to_config=PATH_TO_CONFIG)
+    messages = load_messages()
+
+    for message in messages:
+        assert data.cleaner.clear(message) == legacy_clear_message(data, message)
+
+    before = measure(lambda m: legacy_clear_message(data, m), messages, repeat)
+    after = measure(data.cleaner.clear, messages, repeat)
+    print(f"messages:        {len(messages) * repeat}")
+    print(f"before, msg/sec: {before:,.0f}")
+    print(f"after, msg/sec:  {after:,.0f}")
+    print(f"speedup:         {after / before:.1f}x")
+
+
+class LegacyVoc:
+    """`Voc` from the chatbot notebook."""
+
+    def __init__(self, name):
+        self.name = name
+        self.trimmed = False
+        self.word2index = {}
+        self.word2count = {}
+        self.index2word = {PAD_token: "PAD", SOS_token: "SOS", EOS_token: "EOS"}
+        self.num_words = 3
+
+    def addSentence(self, sentence):
+        for word in sentence.split(" "):
+            self.addWord(word)
+
+    def addWord(self, word):
+        if word not in self.word2index:
+            self.word2index[word] = self.num_words
+            self.word2count[word] = 1
+            self.index2word[self.num_words] = word
+            self.num_words += 1
+        else:
+            self.word2count[word] += 1
+
+    def trim(self, min_count):
+        if self.trimmed:
+            return
+        self.trimmed = True
+        keep_words = [k for k, v in self.word2count.items() if v >= min_count]
+        self.word2index = {}
+        self.word2count = {}
+        self.index2word = {PAD_token: "PAD", SOS_token: "SOS", EOS_token: "EOS"}
+        self.num_words = 3
+        for word in keep_words:
+            self.addWord(word)
+
+
+def legacy_trim_rare_words(voc, pairs, min_count):
+    """`trimRareWords` from the chatbot notebook without prints."""
+
+    voc.trim(min_count)
+    keep_pairs = []
+    for pair in pairs:
+        keep_input = all(word in voc.word2index for word in pair[0].split(" "))
+        keep_output = all(word in voc.word2index for word in pair[1].split(" "))
+        if keep_input and keep_output:
+            keep_pairs.append(pair)
+    return keep_pairs
+
+
+def legacy_indexes_from_sentence(voc, sentence):
+    return [voc.word2index[word] for word in sentence.split(" ")] + [EOS_token]
+
+
+def make_pairs(n_pairs: int, n_words: int = 200000, seed: int = 0) -> List[List[str]]:
+    """Random pairs of sentences with Zipf-distributed words."""
+
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(n_words)]
+    weights = [1 / (i + 1) for i in range(n_words)]
+    tokens = iter(rng.choices(words, weights, k=n_pairs * 2 * 9))
+    return [
+        [
+            " ".join(next(tokens) for _ in range(rng.randint(1, 9))),
+            " ".join(next(tokens) for _ in range(rng.randint(1, 9))),
+        ]
+        for _ in range(n_pairs)
+    ]
+
+
+def legacy_get_pairs(data: Data4Chatbot, messages: List[str]) -> List[List[str]]:
+    """`get_pairs` splitting both messages of every pair."""
+
+    pairs = [[messages[i - 1], messages[i]] for i in range(1, len(messages))]
+    return [
+        pair
+        for pair in pairs
+        if len(pair[0].split(" ")) < data.max_length
+        and len(pair[1].split(" ")) < data.max_length
+    ]
+
+
+def bench_pairs(pairs: int = 1000000, **kwargs) -> None:
+    """Pairs of `pairs` consecutive messages filtered by their lengths."""
+
+    messages = [message for pair in make_pairs(pairs // 2) for message in pair]
+    data = Data4Chatbot(path_to_config=PATH_TO_CONFIG, max_length=8)
+
+    start = time.perf_counter()
+    legacy = legacy_get_pairs(data, messages)
+    before = time.perf_counter() - start
+    start = time.perf_counter()
+    result = list(data._iter_pairs(messages))
+    after = time.perf_counter() - start
+    assert result == legacy
+
+    data.min_length, data.max_ratio = 2, 2.0
+    start = time.perf_counter()
+    constrained = list(data._iter_pairs(messages))
+    with_ratio = time.perf_counter() - start
+
+    print(f"messages:              {len(messages):,}")
+    print(f"pairs kept:            {len(result):,}")
+    print(f"before, msg/sec:       {len(messages) / before:,.0f}")
+    print(f"after, msg/sec:        {len(messages) / after:,.0f}")
+    print(f"speedup:               {before / after:.1f}x")
+    print(f"constrained, msg/sec:   {len(messages) / with_ratio:,.0f}")
+    print(f"pairs kept:            {len(constrained):,}")
+
+
+def bench_vocabulary(pairs: int = 1000000, min_count: int = 3, **kwargs) -> None:
+    pairs = make_pairs(pairs)
+
+    start = time.perf_counter()
+    legacy_voc = LegacyVoc("legacy")
+    for pair in pairs:
+        legacy_voc.addSentence(pair[0])
+        legacy_voc.addSentence(pair[1])
+    legacy_pairs = legacy_trim_rare_words(legacy_voc, pairs, min_count)
+    legacy_encoded = [
+        (
+            legacy_indexes_from_sentence(legacy_voc, pair[0]),
+            legacy_indexes_from_sentence(legacy_voc, pair[1]),
+        )
+        for pair in legacy_pairs
+    ]
+    before = time.perf_counter() - start
+
+    start = time.perf_counter()
+    voc = Voc("voc")
+    kept_pairs, encoded = voc.fit_pairs(pairs, min_count)
+    after = time.perf_counter() - start
+
+    assert voc.word2index == legacy_voc.word2index
+    assert kept_pairs == legacy_pairs
+    q_indexes, q_offsets, a_indexes, a_offsets = encoded
+    assert q_indexes.tolist() == [i for q, _ in legacy_encoded for i in q]
+    assert a_indexes.tolist() == [i for _, a in legacy_encoded for i in a]
+
+    print(f"pairs:         {len(pairs):,} ({len(kept_pairs):,} kept)")
+    print(f"notebook, s:   {before:.2f}")
+    print(f"vocabulary, s: {after:.2f}")
+    print(f"speedup:       {before / after:.1f}x")
+
+
+def legacy_batch2train_data(voc, pair_batch):
+    """`batch2TrainData` from the chatbot notebook without torch tensors."""
+
+    pair_batch.sort(key=lambda x: len(x[0].split(" ")), reverse=True)
+    input_batch = [legacy_indexes_from_sentence(voc, pair[0]) for pair in pair_batch]
+    output_batch = [legacy_indexes_from_sentence(voc, pair[1]) for pair in pair_batch]
+    lengths = [len(indexes) for indexes in input_batch]
+    inp = list(itertools.zip_longest(*input_batch, fillvalue=PAD_token))
+    output = list(itertools.zip_longest(*output_batch, fillvalue=PAD_token))
+    mask = [[int(token != PAD_token) for token in row] for row in output]
+    return inp, lengths, output, mask, max(len(indexes) for indexes in output_batch)
+
+
+def bench_batching(pairs: int = 200000, batch_size: int = 64, **kwargs) -> None:
+    pairs = make_pairs(pairs)
+    voc = Voc("voc")
+    pairs, _ = voc.fit_pairs(pairs)
+    n_batches = len(pairs) // batch_size
+
+    rng = random.Random(0)
+    start = time.perf_counter()
+    real = padded = 0
+    for _ in range(n_batches):
+        batch = [rng.choice(pairs) for _ in range(batch_size)]
+        inp, lengths, output, mask, _ = legacy_batch2train_data(voc, batch)
+        real += sum(lengths) + sum(map(sum, mask))
+        padded += len(inp) * batch_size + len(output) * batch_size
+    before = time.perf_counter() - start
+    print(
+        f"notebook: {n_batches / before:,.0f} batches/sec, efficiency {real / padded:.3f}"
+    )
+
+    for bucket_width in [1, 2, 4]:
+        start = time.perf_counter()
+        batcher = BucketBatcher(voc, pairs, batch_size, bucket_width, seed=0)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in batcher:
+            pass
+        after = time.perf_counter() - start
+        print(
+            f"bucket_width={bucket_width}: built in {build:.2f} s, "
+            f"{len(batcher) / after:,.0f} batches/sec, "
+            f"efficiency {batcher.padding_efficiency()['total']:.3f}"
+        )
+
+
+def legacy_greedy_replies(encoder, decoder, voc, sentences, max_length):
+    """`GreedySearchDecoder` and `evaluate` from the chatbot notebook."""
+
+    import torch
+
+    replies = []
+    for sentence in sentences:
+        indexes_batch = [
+            [voc.word2index[word] for word in sentence.split(" ")] + [EOS_token]
+        ]
+        lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
+        input_seq = torch.LongTensor(indexes_batch).transpose(0, 1)
+
+        encoder_outputs, encoder_hidden = encoder(input_seq, lengths)
+        decoder_hidden = encoder_hidden[: decoder.n_layers]
+        decoder_input = torch.ones(1, 1, dtype=torch.long) * SOS_token
+        all_tokens = torch.zeros([0], dtype=torch.long)
+        all_scores = torch.zeros([0])
+        for _ in range(max_length):
+            decoder_output, decoder_hidden = decoder(
+                decoder_input, decoder_hidden, encoder_outputs
+            )
+            decoder_scores, decoder_input = torch.max(decoder_output, dim=1)
+            all_tokens = torch.cat((all_tokens, decoder_input), dim=0)
+            all_scores = torch.cat((all_scores, decoder_scores), dim=0)
+            decoder_input = torch.unsqueeze(decoder_input, 0)
+
+        words = [voc.index2word[token.item()] for token in all_tokens]
+        replies.append([x for x in words if not (x == "EOS" or x == "PAD")])
+    return replies
+
+
+def bench_decoder(
+    messages: int = 300, batch_size: int = 64, hidden_size: int = 500, **kwargs
+) -> None:
+    """
+    Replies per second of the notebook greedy loop and of `BatchDecoder`
+    on CPU, with random models of the notebook size: 2 layers, dot attention.
+    """
+
+    import torch
+    from .decoding import BatchDecoder
+    from .seq2seq import EncoderRNN, LuongAttnDecoderRNN
+
+    torch.manual_seed(0)
+    sentences = [pair[0] for pair in make_pairs(messages, n_words=7000)]
+    voc = Voc("benchmark")
+    voc.add_sentences(sentences)
+    embedding = torch.nn.Embedding(voc.num_words, hidden_size)
+    encoder = EncoderRNN(hidden_size, embedding, 2).eval()
+    decoder = LuongAttnDecoderRNN("dot", embedding, hidden_size, voc.num_words, 2)
+    decoder.eval()
+    batch_decoder = BatchDecoder(encoder, decoder, voc)
+
+    def batched(method: str, **decode_kwargs) -> Callable[[], list]:
+        return lambda: [
+            reply
+            for start in range(0, len(sentences), batch_size)
+            for reply in batch_decoder.decode(
+                sentences[start : start + batch_size], method, **decode_kwargs
+            )
+        ]
+
+    runs = [
+        (
+            "notebook greedy",
+            lambda: legacy_greedy_replies(
+                encoder, decoder, voc, sentences, batch_decoder.max_length
+            ),
+        ),
+        ("batch greedy", batched("greedy")),
+        ("batch top-10 sampling", batched("sample", top_k=10)),
+        ("batch beam search, 5", batched("beam", beam_size=5)),
+    ]
+    with torch.no_grad():
+        for name, func in runs:
+            start = time.perf_counter()
+            replies = func()
+            elapsed = time.perf_counter() - start
+            print(f"{name:>22}: {len(replies) / elapsed:10,.1f} replies/sec")
+
+
+def bench_conversation(
+    messages: int = 300, batch_size: int = 64, turns: int = 10, **kwargs
+) -> None:
+    """
+    Latency of a turn of `batch_size` conversations with the LSTM generator
+    of the notebook size, when every turn feeds the whole history as
+    `predict` of the notebook does and when the states are cached.
+    """
+
+    import torch
+    from .generation import RNNModule, TextGenerator
+    from .state_cache import StateCache
+
+    torch.manual_seed(0)
+    voc = Voc("benchmark")
+    voc.add_sentences([pair[0] for pair in make_pairs(messages, 7000)])
+    vocab = [voc.index2word[i] for i in range(voc.num_words)]
+    net = RNNModule(len(vocab), 32, 64, 64)
+    prompts = [pair[0] for pair in make_pairs(batch_size * turns, 7000, seed=1)]
+    conversations = [str(i) for i in range(batch_size)]
+
+    plain = TextGenerator(net, vocab, length=10)
+    cache = StateCache()
+    cached = TextGenerator(net, vocab, length=10, cache=cache)
+    histories = [""] * batch_size
+    for turn in range(turns):
+        batch = prompts[turn * batch_size : (turn + 1) * batch_size]
+        start = time.perf_counter()
+        texts = plain.generate(
+            [f"{history} {prompt}" for history, prompt in zip(histories, batch)]
+        )
+        full = time.perf_counter() - start
+        histories = texts
+
+        start = time.perf_counter()
+        cached.generate(batch, conversations=conversations)
+        incremental = time.perf_counter() - start
+        print(
+            f"turn {turn + 1:>3}: {full * 1000:8.1f} ms full history, "
+            f"{incremental * 1000:8.1f} ms cached, "
+            f"{(full - incremental) * 1000:8.1f} ms saved"
+        )
+    stats = cache.stats()
+    print(
+        f"hit rate {stats['hit_rate']:.2f}, "
+        f"{stats['saved_tokens_per_turn']:.1f} tokens not fed per turn, "
+        f"{stats['bytes'] / 1024:.1f} KiB of states"
+    )
+
+
+def bench_export(
+    messages: int = 300, batch_size: int = 64, hidden_size: int = 500, **kwargs
+) -> None:
+    """
+    Latency of a batch, size and accuracy of the eager models and of their
+    TorchScript exports in float32 and int8 on CPU, random models of the
+    notebook sizes. Perplexities of random models are close to the size of
+    the vocabulary, only their differences matter.
+    """
+
+    import torch
+    from .decoding import BatchDecoder
+    from .export import (
+        export_chatbot,
+        export_generator,
+        load_batch_decoder,
+        load_text_generator,
+        reply_agreement,
+    )
+    from .generation import RNNModule, TextGenerator
+    from .seq2seq import EncoderRNN, LuongAttnDecoderRNN
+
+    torch.manual_seed(0)
+    pairs = make_pairs(messages, n_words=7000)
+    sentences = [question for question, _ in pairs][:batch_size]
+    voc = Voc("benchmark")
+    voc.add_pairs(pairs)
+    embedding = torch.nn.Embedding(voc.num_words, hidden_size)
+    encoder = EncoderRNN(hidden_size, embedding, 2)
+    decoder = LuongAttnDecoderRNN("dot", embedding, hidden_size, voc.num_words, 2)
+    vocab = [voc.index2word[i] for i in range(voc.num_words)]
+    net = RNNModule(len(vocab), 32, 64, 64)
+    tokens = torch.randint(len(vocab), (batch_size, 33)).numpy()
+    windows = [(tokens[:, :-1], tokens[:, 1:])]
+
+    def latency(func: Callable[[], Any], repeat: int = 5) -> float:
+        """Mean milliseconds of a call after a warm-up one."""
+
+        func()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        variants = [
+            ("eager", BatchDecoder(encoder, decoder, voc), TextGenerator(net, vocab))
+        ]
+        sizes = {}
+        for name, quantized in [("float32", False), ("int8", True)]:
+            chatbot_path = os.path.join(tmp, f"chatbot-{name}.pt")
+            generator_path = os.path.join(tmp, f"generator-{name}.pt")
+            export_chatbot(encoder, decoder, voc, chatbot_path, quantized)
+            export_generator(net, vocab, generator_path, quantized)
+            sizes[name] = (
+                os.path.getsize(chatbot_path) / 2**20,
+                os.path.getsize(generator_path) / 2**20,
+            )
+            variants.append(
+                (
+                    name,
+                    load_batch_decoder(chatbot_path),
+                    load_text_generator(generator_path),
+                )
+            )
+
+        eager = variants[0][1]
+        for name, batch_decoder, generator in variants:
+            chatbot_ms = latency(lambda: batch_decoder.decode(sentences))
+            generator_ms = latency(lambda: generator.generate(sentences))
+            line = (
+                f"{name:>7}: chatbot {chatbot_ms:8.1f} ms, "
+                f"generator {generator_ms:8.1f} ms per {len(sentences)} messages, "
+                f"chatbot perplexity {batch_decoder.perplexity(pairs):8.1f}, "
+                f"generator perplexity {generator.perplexity(windows):8.1f}"
+            )
+            if name in sizes:
+                line += (
+                    f", equal greedy replies "
+                    f"{reply_agreement(eager, batch_decoder, sentences):.1%}, "
+                    f"{sizes[name][0]:.1f} + {sizes[name][1]:.1f} MiB"
+                )
+            print(line)
+
+
+def import_time(typecheck: bool, repeat: int = 10) -> float:
+    """Best time in seconds of `import talk_with_me` in a fresh interpreter."""
+
+    env = dict(os.environ, TALK_WITH_ME_TYPECHECK=str(int(typecheck)))
+    code = (
+        "import time; start = time.perf_counter(); import talk_with_me; "
+        "print(time.perf_counter() - start)"
+    )
+    return min(
+        float(
+            subprocess.run(
+                [sys.executable, "-c", code],
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        )
+        for _ in range(repeat)
+    )
+
+
+def bench_startup(repeat: int = 200, **kwargs) -> None:
+    from . import typecheck
+    from typeguard import typechecked
+
+    if typecheck.ENABLED:
+        raise RuntimeError("Run the benchmark with TALK_WITH_ME_TYPECHECK=0")
+
+    print(f"import talk_with_me, typeguard on:  {import_time(True) * 1000:.1f} ms")
+    print(f"import talk_with_me, typeguard off: {import_time(False) * 1000:.1f} ms")
+
+    data = Data4Chatbot(path_to_config=PATH_TO_CONFIG)
+    messages = load_messages()
+    for name in ["_clear_message", "normalize_message"]:
+        method = getattr(Data4Chatbot, name)
+        checked = typechecked(method)
+        before = measure(lambda m: checked(data, m), messages, repeat)
+        after = measure(lambda m: method(data, m), messages, repeat)
+        print(
+            f"{name}: {1e6 / before:.2f} us/call checked, "
+            f"{1e6 / after:.2f} us/call unchecked"
+        )
+
+
+BENCHMARKS = {
+    "clear_message": bench_clear_message,
+    "conversation": bench_conversation,
+    "decoder": bench_decoder,
+    "export": bench_export,
+    "html_parser": bench_html_parser,
+    "vocabulary": bench_vocabulary,
+    "batching": bench_batching,
+    "pairs": bench_pairs,
+    "pipeline": bench_pipeline,
+    "reader": bench_reader,
+    "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("--chats", type=int, default=100, help="chats in archive")
+    parser.add_argument("--files", type=int, default=30, help="files per chat")
+    parser.add_argument("--repeat", type=int, default=200, help="repetitions")
+    parser.add_argument("--pairs", type=int, default=1000000, help="pairs")
+    parser.add_argument("--messages", type=int, default=300, help="messages per file")
+    parser.add_argument("--attachments", type=float, default=0.1, help="share")
+    parser.add_argument("--emoji", type=float, default=0.1, help="share")
+    parser.add_argument("--urls", type=float, default=0.05, help="share")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes")
+    parser.add_argument("--batch-size", type=int, default=64, help="batch size")
+    parser.add_argument("--turns", type=int, default=10, help="conversation turns")
+    parser.add_argument("--output", help="json file of the results")
+    args = parser.parse_args()
+    BENCHMARKS[args.name](**vars(args))
@@ -0,0 +1,154 @@
+"""
+Persistent on-disk cache of the cleaned messages of html files.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from typing import Iterator, Optional
+
+
+class FileCache:
+    """
+    Cache of the data prepared from a file, stored as json in `cache_dir`.
+
+    An entry is addressed by the key of the file, the hash of its path, size
+    and modification time (or content if `hash_content` is True) together
+    with `fingerprint` of the cleaning rules, so a changed file or changed
+    rules never hit a stale entry. The key is computed once with `key` and
+    used both to look the entry up and to store it.
+
+    Every entry keeps the path of its file, so `prune` can remove the entries
+    of deleted files, and also the oldest entries above `max_size`.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache, created if it does not exist.
+    fingerprint : str
+        Hash of everything besides the file that affects the prepared data.
+    hash_content : bool (default=False)
+        Address the files by the hash of their content instead of mtime.
+        It is slower, but survives re-exports and copies of the archive.
+    max_size : int or None (default=None)
+        Size of the cache in bytes kept by `prune`, unlimited if None.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        fingerprint: str,
+        hash_content: bool = False,
+        max_size: Optional[int] = None,
+    ):
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.hash_content = hash_content
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path: str) -> str:
+        """Key of the entry of the file in its current state."""
+
+        key = hashlib.sha1(self.fingerprint.encode())
+        if self.hash_content:
+            with open(path, "rb") as f:
+                key.update(hashlib.sha1(f.read()).digest())
+        else:
+            stat = os.stat(path)
+            key.update(
+                f"{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}".encode()
+            )
+        return key.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def _entries(self) -> Iterator[os.DirEntry]:
+        for folder in os.scandir(self.cache_dir):
+            if folder.is_dir():
+                yield from (
+                    entry
+                    for entry in os.scandir(folder.path)
+                    if entry.name.endswith(".json")
+                )
+
+    def get(self, key: str) -> Optional[list]:
+        """Returns the cached data of the key or None if there is no entry."""
+
+        try:
+            with open(self._entry_path(key), "r", encoding="utf-8") as f:
+                f.readline()  # path of the file
+                data = json.loads(f.readline())
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def set(self, key: str, data: list, path: str) -> None:
+        """Stores the data prepared from the file `path` under its key."""
+
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        # Write to a temporary file first, so that concurrent workers
+        # never read a partially written entry:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(json.dumps(os.path.abspath(path), ensure_ascii=False) + "\n")
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, entry_path)
+
+    def clear(self) -> None:
+        """Removes all entries."""
+
+        for entry in list(self._entries()):
+            os.remove(entry.path)
+
+    def prune(self) -> int:
+        """
+        Removes the entries of files which no longer exist, then the oldest
+        entries until the cache fits in `max_size`.
+
+        Returns
+        -------
+        int
+            Number of removed entries.
+        """
+
+        kept = []
+        removed = 0
+        for entry in list(self._entries()):
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    path = json.loads(f.readline())
+                exists = os.path.exists(path)
+            except ValueError:
+                exists = False
+            if exists:
+                stat = entry.stat()
+                kept.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            else:
+                os.remove(entry.path)
+                removed += 1
+
+        if self.max_size is not None:
+            size = sum(entry_size for _, entry_size, _ in kept)
+            for _, entry_size, entry_path in sorted(kept):
+                if size <= self.max_size:
+                    break
+                os.remove(entry_path)
+                size -= entry_size
+                removed += 1
+        return removed
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
@@ -0,0 +1,188 @@
+"""
+Precompiled rules for clearing VK messages from attachments and garbage.
+"""
+import re
+import time
+from functools import partial
+from typing import Any, Callable, List, Optional, Tuple
+from .perfect_regex import (
+    perfect_url_regex,
+    perfect_emoji_regex,
+    perfect_email_regex,
+    perfect_phone_regex,
+)
+from .profiler import Profiler
+
+
+class MessageCleaner:
+    """
+    Clear messages with the rules compiled once.
+
+    The result is the same as applying every rule to every message one by one,
+    but each rule is guarded by a cheap check of its marker (a substring, the
+    alternation of all attachment labels, etc.), so a typical message is
+    scanned only a few times instead of once per rule.
+
+    Parameters
+    ----------
+    blacklist : list of str
+        Labels of attachments, such as `Фотография`, which are removed
+        together with their links.
+    message_ends : list of str
+        Suffixes, such as `Стикер`, which are removed together with the last
+        line of the message, if the line is only the suffix with an optional
+        number before it, so that `Check the Map` is kept in English archives.
+    link : str (default="Ссылка")
+        Label of links, messages with links to reposts are skipped.
+    audio : str (default="Аудиозапись")
+        Label of audio records, removed where it stands on its own line.
+    """
+
+    def __init__(
+        self,
+        blacklist: List[str],
+        message_ends: List[str],
+        link: str = "Ссылка",
+        audio: str = "Аудиозапись",
+    ):
+        self.blacklist = list(blacklist)
+        self.message_ends = tuple(message_ends)
+        self.link_marker = f"\n{link}\nhttps:"
+        self.audio = audio
+
+        # One scan tells if any of the attachment rules can match:
+        # Labels come from the config, so they are matched literally:
+        escaped = [re.escape(attachment) for attachment in self.blacklist]
+        self._attachment_regex = re.compile("|".join(escaped) or "(?!)")
+        self._attachment_rules = [
+            (
+                attachment,
+                re.compile(f"[\n]?{pattern}[\n]?" + perfect_url_regex),
+                re.compile(f"[\n]?{pattern}[\n]?$"),
+            )
+            for attachment, pattern in zip(self.blacklist, escaped)
+        ]
+
+        self._emoji_regex = re.compile(perfect_emoji_regex)
+        self._email_regex = re.compile(perfect_email_regex)
+        self._phone_regex = re.compile(perfect_phone_regex)
+        self._url_regex = re.compile(perfect_url_regex)
+        self._audio_regex = re.compile(f"\n?^{re.escape(audio)}$\n?", re.MULTILINE)
+        ends = "|".join(re.escape(end) for end in self.message_ends)
+        self._message_end_regex = re.compile(
+            f"\n(?:\\d+ )?(?:{ends})$" if ends else "(?!)"
+        )
+        self._digit_regex = re.compile(r"\d")
+        self.rules = self._build_rules()
+
+    def __getstate__(self) -> dict:
+        # The rules are closures, which are not pickled, they are built again:
+        state = self.__dict__.copy()
+        del state["rules"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.rules = self._build_rules()
+
+    def _build_rules(
+        self,
+    ) -> List[Tuple[str, Optional[Callable[[str], Any]], Callable[[str], str]]]:
+        """
+        Steps of `clear` in order: name, guard telling if the rule can change
+        the message (None to always apply it) and the rule itself.
+        The message is dropped as soon as it is empty.
+        """
+
+        return [
+            # If `Ссылка` in message - not append this message:
+            (
+                "links",
+                lambda message: self.link_marker in message or "#comments" in message,
+                lambda message: "",
+            ),
+            # Delete trash such as stickers, attached messages:
+            (
+                "message_ends",
+                lambda message: message.endswith(self.message_ends),
+                self._cut_message_end,
+            ),
+            # Delete attachments such as photos, documents, ect.:
+            ("attachments", self._attachment_regex.search, self._remove_attachments),
+            # Delete trash:
+            (
+                "emoji",
+                lambda message: not message.isascii(),
+                partial(self._emoji_regex.sub, ""),
+            ),
+            (
+                "email",
+                lambda message: "@" in message,
+                partial(self._email_regex.sub, ""),
+            ),
+            ("phone", self._digit_regex.search, partial(self._phone_regex.sub, " ")),
+            (
+                "url",
+                lambda message: "http" in message,
+                partial(self._url_regex.sub, ""),
+            ),
+            (
+                "audio",
+                lambda message: self.audio in message,
+                partial(self._audio_regex.sub, ""),
+            ),
+            ("spaces", None, lambda message: message.replace("  ", " ").strip()),
+        ]
+
+    def _cut_message_end(self, message: str) -> str:
+        match = self._message_end_regex.search(message)
+        return message[: match.start()] if match else message
+
+    def _remove_attachments(self, message: str) -> str:
+        for attachment, with_url_regex, at_end_regex in self._attachment_rules:
+            if attachment in message:
+                message = with_url_regex.sub("", message)
+                message = at_end_regex.sub("", message)
+        return message
+
+    def clear(self, message: str) -> str:
+        """Сlean a message from attachments and garbage."""
+
+        for _, guard, apply in self.rules:
+            if guard is None or guard(message):
+                message = apply(message)
+                if not message:
+                    break
+        return message
+
+    def drop_reason(self, message: str) -> str:
+        """
+        Name of the rule because of which `clear` returned an empty string:
+        `link` and `comments` for reposts, `attachment` for messages which
+        are only attachments and `empty` for the rest.
+        """
+
+        if self.link_marker in message:
+            return "link"
+        if "#comments" in message:
+            return "comments"
+        if message.endswith(self.message_ends) or self._attachment_regex.search(
+            message
+        ):
+            return "attachment"
+        return "empty"
+
+    def clear_profiled(self, message: str, profiler: Profiler) -> str:
+        """
+        The same as `clear`, but the time of every rule is added
+        to the `profiler` as `rule:<name>`.
+        """
+
+        for name, guard, apply in self.rules:
+            start = time.perf_counter()
+            if guard is None or guard(message):
+                message = apply(message)
+            profiler.add_time(f"rule:{name}", time.perf_counter() - start)
+            if not message:
+                break
+        return message
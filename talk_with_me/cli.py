@@ -0,0 +1,202 @@
+"""
+Prepare VK archives from the command line.
+
+Usage:
+    python -m talk_with_me ~/Archive --mode chatbot --output ./data
+    python -m talk_with_me ~/Archive1 ~/Archive2 --mode text --jobs -1 --output ./data
+
+Every archive is prepared chat by chat and written straight to disk, so
+the memory used does not depend on the size of the archives. With several
+archives the data of each one is written to its own subfolder of `--output`.
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Iterable, List, Optional
+from .data4ml import Data4Chatbot, Data4ML, Data4TextGeneration
+
+MODES = {"chatbot": Data4Chatbot, "text": Data4TextGeneration}
+FORMATS = ["corpus", "jsonl"]
+PATH_TO_CONFIG = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "data_params.json"
+)
+
+
+def find_messages(archive: str) -> str:
+    """Path to `messages` folder of the archive, or the path itself."""
+
+    messages = os.path.join(archive, "messages")
+    return messages if os.path.isdir(messages) else archive
+
+
+def output_paths(archives: List[str], output: str) -> List[str]:
+    """
+    Output of every archive: `output` itself for one archive or
+    its subfolders named after the archives for several ones.
+    """
+
+    if len(archives) == 1:
+        return [output]
+
+    paths, used = [], set()
+    for archive in archives:
+        name = os.path.basename(os.path.normpath(archive)) or "archive"
+        if name == "messages":
+            name = os.path.basename(os.path.dirname(os.path.abspath(archive)))
+        unique, i = name, 1
+        while unique in used:
+            i += 1
+            unique = f"{name}_{i}"
+        used.add(unique)
+        paths.append(os.path.join(output, unique))
+    return paths
+
+
+def save_jsonl(path: str, data: Iterable[list]) -> int:
+    """Write every pair or chat as a json line, returns the number of lines."""
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    n_lines = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for item in data:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            n_lines += 1
+    return n_lines
+
+
+def prepare(data: Data4ML, output: str, output_format: str, limit: int) -> None:
+    """Prepare the archive of `data.home_folder` and stream it to `output`."""
+
+    if output_format == "corpus":
+        data.save(output, limit=limit)
+    else:
+        if isinstance(data, Data4Chatbot):
+            items = data.iter_pairs(limit)
+        else:
+            items = data.iter_messages(limit)
+        save_jsonl(output, items)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m talk_with_me",
+        description=__doc__.strip().splitlines()[0],
+    )
+    parser.add_argument(
+        "archives", nargs="+", help="VK archives or their `messages` folders"
+    )
+    parser.add_argument("--mode", choices=sorted(MODES), default="chatbot")
+    parser.add_argument(
+        "--output", required=True, help="folder of the corpus or jsonl file"
+    )
+    parser.add_argument("--format", choices=FORMATS, default="corpus")
+    parser.add_argument("--config", default=PATH_TO_CONFIG, help="json config")
+    parser.add_argument(
+        "--limit", type=int, default=2, help="skip chats with fewer html files"
+    )
+    parser.add_argument(
+        "--max-length", type=int, default=10, help="max words in a message (chatbot)"
+    )
+    parser.add_argument(
+        "--min-length", type=int, default=1, help="min words in a message (chatbot)"
+    )
+    parser.add_argument(
+        "--max-ratio", type=float, help="max ratio of lengths in a pair (chatbot)"
+    )
+    parser.add_argument(
+        "--session-gap",
+        type=float,
+        help="seconds of silence which split a chat into sessions (chatbot)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="worker processes, -1 for all cores"
+    )
+    parser.add_argument(
+        "--prefetch", type=int, default=0, help="threads reading html files ahead"
+    )
+    parser.add_argument("--cache-dir", help="cache of cleaned files between runs")
+    parser.add_argument(
+        "--cache-max-size", type=float, help="max size of the cache in megabytes"
+    )
+    parser.add_argument(
+        "--dedup", type=int, help="keep at most this many copies of a pair or message"
+    )
+    parser.add_argument(
+        "--near-duplicates", action="store_true", help="dedup similar texts too"
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="print time of every stage"
+    )
+    args = parser.parse_args(argv)
+    if args.near_duplicates and args.dedup is None:
+        parser.error("--near-duplicates requires --dedup")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Prepare every archive, skipping the ones which fail.
+
+    Returns
+    -------
+    int
+        Exit code: 0 if all archives are prepared, 1 otherwise.
+    """
+
+    args = parse_args(argv)
+    kwargs = {}
+    if args.mode == "chatbot":
+        kwargs["max_length"] = args.max_length
+        kwargs["min_length"] = args.min_length
+        kwargs["max_ratio"] = args.max_ratio
+        kwargs["session_gap"] = args.session_gap
+
+    cache_max_size = None
+    if args.cache_max_size is not None:
+        cache_max_size = int(args.cache_max_size * 2**20)
+
+    failed = []
+    for archive, output in zip(args.archives, output_paths(args.archives, args.output)):
+        messages = find_messages(archive)
+        if not os.path.isdir(messages):
+            print(f"No such directory: {archive}", file=sys.stderr)
+            failed.append(archive)
+            continue
+
+        try:
+            data = MODES[args.mode](
+                path_to_config=args.config,
+                home_folder=messages,
+                n_jobs=args.jobs,
+                prefetch=args.prefetch,
+                cache_dir=args.cache_dir,
+                cache_max_size=cache_max_size,
+                profile=args.profile,
+                dedup=args.dedup,
+                near_duplicates=args.near_duplicates,
+                **kwargs,
+            )
+            prepare(data, output, args.format, args.limit)
+        except Exception as e:  # keep preparing the other archives
+            print(f"Failed to prepare {archive}: {e!r}", file=sys.stderr)
+            failed.append(archive)
+            continue
+
+        print(f"{archive} -> {output}", file=sys.stderr)
+        if data.dedup:
+            overall = data.dedup.stats()["overall"]
+            print(
+                f"duplicates: {overall['duplicates']:,} of {overall['total']:,} "
+                f"({overall['ratio']:.1%})",
+                file=sys.stderr,
+            )
+        if data.profiler:
+            print(data.profiler.report(), file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
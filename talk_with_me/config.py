@@ -0,0 +1,143 @@
+"""
+Schema of `data_params.json` and the rules compiled from it.
+
+Keys of the config, all optional:
+    home_folder   path to `messages` folder from archive;
+    html_parser   backend of `html_parser.PARSERS`;
+    encoding      encoding of the html files or `auto` to detect it once
+                  from the first file;
+    mmap          read the html files through `mmap`;
+    locale        language of the archive of `locales.LOCALES` or `auto`
+                  to detect it from the html files;
+    blacklist     labels of attachments removed together with their links,
+                  by default they are taken from the locale;
+    message_ends  suffixes removed together with the last line of a message,
+                  by default they are taken from the locale;
+    folders       filters of chat folders of `get_list_of_folders`:
+                  `skip_prefixes` (VK groups or applications start with `-`),
+                  `min_length` (shorter names are some kind of service letters)
+                  and `skip_lengths` (group chats have names of 10 characters).
+
+Other keys are kept as they are.
+"""
+import codecs
+import copy
+from typing import List
+from .html_parser import PARSERS
+from .locales import LOCALES
+
+DEFAULT_CONFIG = {
+    "home_folder": "../messages",
+    "html_parser": "bs4",
+    "encoding": "auto",
+    "mmap": False,
+    "locale": "auto",
+    "blacklist": None,
+    "message_ends": None,
+    "folders": {"skip_prefixes": ["-"], "min_length": 7, "skip_lengths": [10]},
+}
+
+
+def _is_list_of(value, item_type: type) -> bool:
+    return isinstance(value, list) and all(
+        isinstance(item, item_type) and not isinstance(item, bool) for item in value
+    )
+
+
+def _check(condition: bool, message: str) -> None:
+    if not condition:
+        raise ValueError(f"Invalid config: {message}")
+
+
+def validate_config(cfg: dict) -> dict:
+    """
+    Check the config and fill the missing keys with `DEFAULT_CONFIG`.
+
+    Returns
+    -------
+    dict
+        Full config, the argument is not modified.
+
+    Raises
+    ------
+    ValueError
+        If a key has a wrong type or value.
+    """
+
+    _check(isinstance(cfg, dict), "expected a json object")
+    result = copy.deepcopy(DEFAULT_CONFIG)
+    result.update(copy.deepcopy(cfg))
+
+    _check(isinstance(result["home_folder"], str), "home_folder must be a string")
+    _check(
+        result["html_parser"] in PARSERS,
+        f"unknown html_parser: {result['html_parser']}, "
+        f"expected one of {sorted(PARSERS)}",
+    )
+    _check(isinstance(result["encoding"], str), "encoding must be a string")
+    if result["encoding"] != "auto":
+        try:
+            result["encoding"] = codecs.lookup(result["encoding"]).name
+        except LookupError:
+            _check(False, f"unknown encoding: {result['encoding']}")
+    _check(isinstance(result["mmap"], bool), "mmap must be true or false")
+    _check(
+        result["locale"] == "auto" or result["locale"] in LOCALES,
+        f"unknown locale: {result['locale']}, "
+        f"expected auto or one of {sorted(LOCALES)}",
+    )
+    for key in ["blacklist", "message_ends"]:
+        _check(
+            result[key] is None or _is_list_of(result[key], str) and all(result[key]),
+            f"{key} must be null or a list of non-empty strings",
+        )
+
+    folders = result["folders"]
+    _check(isinstance(folders, dict), "folders must be an object")
+    unknown = set(folders) - set(DEFAULT_CONFIG["folders"])
+    _check(not unknown, f"unknown keys of folders: {sorted(unknown)}")
+    result["folders"] = folders = {**DEFAULT_CONFIG["folders"], **folders}
+    _check(
+        _is_list_of(folders["skip_prefixes"], str) and all(folders["skip_prefixes"]),
+        "folders.skip_prefixes must be a list of non-empty strings",
+    )
+    _check(
+        isinstance(folders["min_length"], int)
+        and not isinstance(folders["min_length"], bool)
+        and folders["min_length"] >= 0,
+        "folders.min_length must be a non-negative integer",
+    )
+    _check(
+        _is_list_of(folders["skip_lengths"], int),
+        "folders.skip_lengths must be a list of integers",
+    )
+    return result
+
+
+class FolderFilter:
+    """
+    Filter of chat folders compiled from `folders` of the config.
+
+    Parameters
+    ----------
+    skip_prefixes : list of str
+        Folders starting with any of them are skipped.
+    min_length : int
+        Folders with shorter names are skipped.
+    skip_lengths : list of int
+        Folders with names of these lengths are skipped.
+    """
+
+    def __init__(
+        self, skip_prefixes: List[str], min_length: int, skip_lengths: List[int]
+    ):
+        self.skip_prefixes = tuple(skip_prefixes)
+        self.min_length = min_length
+        self.skip_lengths = frozenset(skip_lengths)
+
+    def accepts(self, folder: str) -> bool:
+        return not (
+            folder.startswith(self.skip_prefixes)
+            or len(folder) < self.min_length
+            or len(folder) in self.skip_lengths
+        )
@@ -0,0 +1,164 @@
+"""
+Compact binary format of prepared corpora.
+
+A corpus is a folder with:
+    blob.bin      UTF-8 text of all messages one after another;
+    offsets.npy   int64 array, message `i` is `blob[offsets[i]:offsets[i + 1]]`;
+    index.npy     int64 array of chat boundaries (`chats` corpora, chat `i` is
+                  messages from `index[i]` to `index[i + 1]`) or of message
+                  indexes of pairs with shape (n, 2) (`pairs` corpora);
+    meta.json     kind of the corpus and version of the format.
+
+All arrays are memory-mapped on load, so opening a corpus of any size is
+instant and only the accessed messages are read from disk.
+"""
+import json
+import os
+from array import array
+from typing import Iterable, Iterator, List
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+class _MessageWriter:
+    """Appends messages to `blob.bin` of a corpus and collects their offsets."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.blob = open(os.path.join(path, "blob.bin"), "wb")
+        self.offsets = array("q", [0])
+
+    def write(self, message: str) -> int:
+        """Returns the index of the written message."""
+
+        self.offsets.append(self.offsets[-1] + self.blob.write(message.encode()))
+        return len(self.offsets) - 2
+
+    def close(self, kind: str, index: np.ndarray) -> None:
+        self.blob.close()
+        np.save(
+            os.path.join(self.path, "offsets.npy"),
+            np.frombuffer(self.offsets, dtype=np.int64),
+        )
+        np.save(os.path.join(self.path, "index.npy"), index)
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"kind": kind, "version": FORMAT_VERSION}, f)
+
+
+def save_chats(path: str, chats: Iterable[List[str]]) -> None:
+    """
+    Save the output of `Data4TextGeneration.make_data`.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the corpus.
+    chats : iterable of lists of str
+        Messages of every chat, can be a generator such as `iter_messages`.
+    """
+
+    writer = _MessageWriter(path)
+    bounds = array("q", [0])
+    for chat in chats:
+        for message in chat:
+            writer.write(message)
+        bounds.append(len(writer.offsets) - 1)
+    writer.close("chats", np.frombuffer(bounds, dtype=np.int64))
+
+
+def save_pairs(path: str, pairs: Iterable[List[str]]) -> None:
+    """
+    Save the output of `Data4Chatbot.make_data`.
+
+    The answer of a pair is usually the question of the next one, so such
+    messages are stored only once.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the corpus.
+    pairs : iterable of lists of str
+        Pairs of messages, can be a generator such as `iter_pairs`.
+    """
+
+    writer = _MessageWriter(path)
+    index = array("q")
+    last_answer, last_index = None, None
+    for question, answer in pairs:
+        if question != last_answer:
+            last_index = writer.write(question)
+        index.append(last_index)
+        last_answer, last_index = answer, writer.write(answer)
+        index.append(last_index)
+    writer.close("pairs", np.frombuffer(index, dtype=np.int64).reshape(-1, 2))
+
+
+class Corpus:
+    """
+    Memory-mapped corpus saved by `save_chats` or `save_pairs`.
+
+    Items of `chats` corpora are lists of messages of a chat and items of
+    `pairs` corpora are pairs of messages, as in the output of `make_data`.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the corpus.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported corpus version: {meta['version']}")
+
+        self.kind = meta["kind"]
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.index = np.load(os.path.join(path, "index.npy"), mmap_mode="r")
+        blob_path = os.path.join(path, "blob.bin")
+        if os.path.getsize(blob_path):
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:  # empty files can not be memory-mapped
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    @property
+    def n_messages(self) -> int:
+        return len(self.offsets) - 1
+
+    def message_bytes(self, i: int) -> np.ndarray:
+        """UTF-8 bytes of the message `i`, a view of the memory-mapped blob."""
+
+        return self.blob[self.offsets[i] : self.offsets[i + 1]]
+
+    def message(self, i: int) -> str:
+        return self.message_bytes(i).tobytes().decode()
+
+    def __len__(self) -> int:
+        return len(self.index) - 1 if self.kind == "chats" else len(self.index)
+
+    def __getitem__(self, i: int) -> List[str]:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("corpus index out of range")
+
+        if self.kind == "chats":
+            start, end = self.index[i], self.index[i + 1]
+            if start == end:
+                return []
+            # Decode the whole chat at once and split it by offsets:
+            offsets = self.offsets[start : end + 1] - self.offsets[start]
+            text = self.blob[self.offsets[start] : self.offsets[end]].tobytes()
+            return [
+                text[offsets[j] : offsets[j + 1]].decode() for j in range(end - start)
+            ]
+        return [self.message(j) for j in self.index[i]]
+
+    def __iter__(self) -> Iterator[List[str]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def tolist(self) -> List[List[str]]:
+        return list(self)
@@ -1,57 +1,189 @@
 """
 Module for preparing and clearing text data from VK messages.
 """
+import copy
+import hashlib
 import json
 import os
 import re
 from abc import ABC, abstractmethod
-from typing import List
-from bs4 import BeautifulSoup
-from typeguard import typechecked
-from tqdm import tqdm
-from perfect_regex import (
-    perfect_url_regex,
-    perfect_emoji_regex,
-    perfect_email_regex,
-    perfect_phone_regex,
-)
+from collections import deque
+from itertools import islice
+from time import perf_counter
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, Optional, Tuple
+from . import perfect_regex
+from .cache import FileCache
+from .cleaner import MessageCleaner
+from .config import FolderFilter, validate_config
+from .html_parser import PARSERS, detect_encoding, first_html_file
+from .locales import DEFAULT_LOCALE, LOCALES, NON_LETTER_REGEX, detect_file_locale
+from .profiler import Profiler, timer
+from .reader import prefetch
+from .records import MessageRecord, session_bounds
+from .typecheck import typechecked
+
+if TYPE_CHECKING:
+    import numpy as np
+    from .corpus import Corpus
+
+# Increase it when the code preparing the messages of a file changes,
+# to invalidate the existing caches:
+CACHE_VERSION = 4
+
+FILE_NUMBER_REGEX = re.compile(r"messages(\d+)\.html")
 
 
 class Data4ML(ABC):
-    """The base class to prepare and clear text data from VK messages.
-    """
+    """The base class to prepare and clear text data from VK messages."""
+
+    def __init__(
+        self,
+        path_to_config: str = "./data_params.json",
+        home_folder: Optional[str] = None,
+        n_jobs: int = 1,
+        chunksize: Optional[int] = None,
+        prefetch: int = 0,
+        cache_dir: Optional[str] = None,
+        hash_content: bool = False,
+        cache_max_size: Optional[int] = None,
+        profile: bool = False,
+        profile_rules: bool = False,
+        dedup: Optional[int] = None,
+        near_duplicates: bool = False,
+    ):
+        """
+        Parameters
+        ----------
+        path_to_config : str (default="./data_params.json")
+            Path to the json config, see `config` for its keys.
+        home_folder : str or None (default=None)
+            Path to `messages` folder from archive. If None, it is taken
+            from `home_folder` of the config or is `../messages`.
+        n_jobs : int (default=1)
+            Number of worker processes used by `make_data`. Chats are processed
+            serially if 1, with all available cores if -1.
+        chunksize : int or None (default=None)
+            Number of chat folders sent to a worker at once. If None, the folders
+            are split into about 4 chunks per worker.
+        prefetch : int (default=0)
+            Number of threads reading html files ahead of their parsing
+            in every process, see `reader.prefetch`. Files are read by
+            the parser itself if 0.
+        cache_dir : str or None (default=None)
+            Directory of the cache of cleaned messages of every html file,
+            so that repeated runs process only new or changed files.
+            The cache is disabled if None.
+        hash_content : bool (default=False)
+            Detect changed files by the hash of their content instead of
+            size and modification time, see `FileCache`.
+        cache_max_size : int or None (default=None)
+            Size of the cache in bytes. If set, the entries of deleted files
+            and then the oldest entries are removed after every pass over
+            the chats, see `FileCache.prune`.
+        profile : bool (default=False)
+            Collect the time of every stage and counters of files and messages
+            in `self.profiler`, see `Profiler.report`. If False, the profiler
+            is None and costs nothing.
+        profile_rules : bool (default=False)
+            Collect also the time of every rule of `MessageCleaner`,
+            implies `profile`.
+        dedup : int or None (default=None)
+            Keep at most `dedup` copies of every pair (`Data4Chatbot`) or
+            message (`Data4TextGeneration`) across all chats, see
+            `Deduplicator`. Duplicates are kept if None.
+        near_duplicates : bool (default=False)
+            Treat near-duplicate texts as copies too, used only with `dedup`.
+        """
 
-    def __init__(self, path_to_config: str = "./data_params.json"):
-        self.cfg = self.read_json(path_to_config)
-
-        self.home_folder = "../messages"  # add to json
-        self.blacklist = [
-            "Фотография",
-            "Документ",
-            "Видеозапись",
-            "Аудиозапись",
-            "Видео",
-            "История",
-            "Запись на стене",
-            "Подарок",
-            "Ссылка",
-        ]
+        self.cfg = validate_config(self.read_json(path_to_config))
+        self.html_parser = self.cfg["html_parser"]
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.chunksize = chunksize
+        self.prefetch = prefetch
+
+        self.home_folder = home_folder or self.cfg["home_folder"]
+        self.folder_filter = FolderFilter(**self.cfg["folders"])
+
+        # With `auto` locale and encoding they are detected by `_map_folders`
+        # for every new `home_folder`, the defaults are used until then:
+        self.encoding = None if self.cfg["encoding"] == "auto" else self.cfg["encoding"]
+        self.cache = None
+        self._detected_folder = None
+        self.set_locale(
+            DEFAULT_LOCALE if self.cfg["locale"] == "auto" else self.cfg["locale"]
+        )
 
-        self.message_ends = [
-            "прикреплённое сообщение",
-            "прикреплённых сообщений",
-            "прикреплённых сообщения",
-            "Запись на стене",
-            "Сообщение удалено",
-            "Карта",
-            "Стикер",
-        ]
+        self.profiler = Profiler(profile_rules) if profile or profile_rules else None
+        self.dedup = None
+        if dedup is not None:
+            from .dedup import Deduplicator
+
+            self.dedup = Deduplicator(dedup, near_duplicates)
+        if cache_dir is not None:
+            self.cache = FileCache(
+                cache_dir, self._fingerprint(), hash_content, cache_max_size
+            )
+
+    def set_locale(self, name: str) -> None:
+        """
+        Compile the cleaning rules of the locale of `locales.LOCALES`,
+        `blacklist` and `message_ends` of the config take precedence.
+        """
+
+        self.locale = LOCALES[name]
+        self.blacklist = self.cfg["blacklist"]
+        if self.blacklist is None:
+            self.blacklist = self.locale.blacklist
+        self.message_ends = self.cfg["message_ends"]
+        if self.message_ends is None:
+            self.message_ends = self.locale.message_ends
+        self.cleaner = MessageCleaner(
+            self.blacklist, self.message_ends, self.locale.link, self.locale.audio
+        )
+        if self.cache:
+            self.cache.fingerprint = self._fingerprint()
+
+    def _detect_archive(self, folders: List[str]) -> None:
+        """
+        Detect the locale and the encoding of `self.home_folder` by its first
+        html file, if they are `auto` in the config.
+        """
+
+        if self._detected_folder == self.home_folder:
+            return
+        self._detected_folder = self.home_folder
+        path = first_html_file(self.home_folder, folders)
+
+        if self.cfg["encoding"] == "auto":
+            self.encoding = path and detect_encoding(path)
+        if self.cfg["locale"] == "auto":
+            name = (path and detect_file_locale(path)) or DEFAULT_LOCALE
+            if name != self.locale.name:
+                self.set_locale(name)
+
+    def _fingerprint(self) -> str:
+        """Hash of the rules which affect the prepared data of a file."""
+
+        rules = {
+            "class": type(self).__name__,
+            "version": CACHE_VERSION,
+            "locale": self.locale.name,
+            "blacklist": self.blacklist,
+            "message_ends": self.message_ends,
+            "regexes": [
+                perfect_regex.perfect_url_regex,
+                perfect_regex.perfect_emoji_regex,
+                perfect_regex.perfect_email_regex,
+                perfect_regex.perfect_phone_regex,
+            ],
+        }
+        rules = json.dumps(rules, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(rules.encode()).hexdigest()
 
     @abstractmethod
     @typechecked
     def make_data(self, limit: int):
-        """Starts a full cycle of preparing and cleaning text data from VK messages.
-        """
+        """Starts a full cycle of preparing and cleaning text data from VK messages."""
 
     @abstractmethod
     @typechecked
@@ -72,11 +204,275 @@ class Data4ML(ABC):
             Messages in the correct order.
         """
 
+    @abstractmethod
+    def _process_chat(self, parent_folder: str, files: List[str]) -> list:
+        """Prepare the data of one chat from its sorted list of `files`."""
+
+    @abstractmethod
+    def _prepare_file(self, path: str, content: Optional[bytes] = None) -> list:
+        """Prepare the data of one html file, which can be cached."""
+
+    def _parse_file(
+        self, path: str, content: Optional[bytes] = None, records: bool = False
+    ) -> list:
+        """
+        Parse messages from html file with the backend chosen
+        by `html_parser` in the config.
+
+        Parameters
+        ----------
+        path : str
+            Path to the file.
+        content : bytes or None (default=None)
+            Content of the file if it is already read.
+        records : bool (default=False)
+            Return also the ids of messages and their authors.
+
+        Returns
+        -------
+        list of str or list of tuple
+            Full text of messages with their headers or `(id, author_id, text)`
+            of every message if `records`, in the correct order.
+        """
+
+        parse_file = PARSERS[self.html_parser]
+        if self.profiler:
+            start = perf_counter()
+            messages = parse_file(
+                path, self.encoding, self.cfg["mmap"], content, records
+            )
+            self.profiler.add_time("parse_html", perf_counter() - start)
+            self.profiler.count("files_parsed")
+            self.profiler.count(
+                "bytes_read", os.path.getsize(path) if content is None else len(content)
+            )
+            self.profiler.count("messages_parsed", len(messages))
+        else:
+            messages = parse_file(
+                path, self.encoding, self.cfg["mmap"], content, records
+            )
+
+        # Reverse the list to save the message sequence:
+        return messages[::-1]
+
+    def _clean_text(self, message: str) -> str:
+        """Text of a message without its header as it is kept in records."""
+
+        return self._clear_message(message)
+
+    def _iter_records(
+        self, path: str, content: Optional[bytes] = None
+    ) -> Iterator[MessageRecord]:
+        """
+        Parse the messages of html file into records in one pass, skipping
+        the ones which are empty after cleaning.
+        """
+
+        parse_timestamp = self.locale.parse_timestamp
+        for id, author_id, message in self._parse_file(path, content, records=True):
+            end = message.find("\n")
+            text = self._clean_text(message[end + 1 :])
+            if text:
+                if self.profiler:
+                    self.profiler.count("messages_out")
+                yield MessageRecord(id, author_id, parse_timestamp(message[:end]), text)
+
+    def _process_records(
+        self, parent_folder: str, files: List[str]
+    ) -> List[MessageRecord]:
+        return [
+            record
+            for file in files
+            for record in self._iter_records(os.path.join(parent_folder, file))
+        ]
+
+    def iter_records(self, limit: int = 2) -> Iterator[List[MessageRecord]]:
+        """
+        Lazily parse the chats into structured records of messages.
+
+        Yields
+        ------
+        list of MessageRecord
+            Messages of one chat in the correct order with their ids, authors,
+            dates and cleared text, see `records.to_columns` to filter them.
+        """
+
+        return self._map_folders(limit, self._process_records)
+
+    def _iter_html(self, parent_folder: str, files: List[str]) -> Iterator[str]:
+        """Parse messages from html one file at a time, see `_parse_file`."""
+
+        for file in files:
+            yield from self._parse_file(os.path.join(parent_folder, file))
+
+    def _iter_prepared(self, parent_folder: str, files: List[str]) -> Iterator:
+        """
+        Prepare the data of html files one file at a time, taking it from
+        `self.cache` if the file has not changed since the last run.
+
+        If `self.prefetch` is set, the files which are not cached are read
+        by `reader.prefetch` ahead of their parsing.
+        """
+
+        entries = []
+        for file in files:
+            path = os.path.join(parent_folder, file)
+            # The key is computed once, it costs a stat or a hash of the file:
+            key = self.cache.key(path) if self.cache else None
+            entries.append((path, key, self.cache.get(key) if self.cache else None))
+        contents = None
+        if self.prefetch:
+            missing = [path for path, _, data in entries if data is None]
+            contents = prefetch(missing, self.prefetch) if missing else None
+
+        for path, key, data in entries:
+            if data is None:
+                content = next(contents)[1] if contents else None
+                data = self._prepare_file(path, content)
+                if self.cache:
+                    self.cache.set(key, data, path)
+            elif self.profiler:
+                self.profiler.count("files_from_cache")
+            yield from data
+
+    def _process_folder(
+        self, folder: str, limit: int, process_chat: Callable
+    ) -> Optional[list]:
+        """
+        Prepare the data of one chat folder with `process_chat`.
+
+        Returns None if the chat is skipped because of `limit`.
+        """
+
+        parent_folder = os.path.join(self.home_folder, folder)
+        with timer(self.profiler, "list_files"):
+            files = self.get_list_of_files_in_folder(parent_folder, limit=limit)
+        if not files:
+            return None
+        return process_chat(parent_folder, files)
+
+    def __getstate__(self) -> dict:
+        """
+        State of the copy of `self` sent to a worker process with every
+        chunk of folders, see `_process_folders`.
+
+        The deduplicator is applied in the parent process and grows with
+        the corpus, so it is not sent. The profiler and the counters of
+        the cache are sent empty, their stats come back with the results.
+        """
+
+        state = self.__dict__.copy()
+        state["dedup"] = None
+        if self.profiler:
+            state["profiler"] = Profiler(self.profiler.rules)
+        if self.cache:
+            state["cache"] = copy.copy(self.cache)
+            state["cache"].hits = state["cache"].misses = 0
+        return state
+
+    def _process_folders(
+        self, folders: List[str], limit: int, process_chat: Callable
+    ) -> Tuple[List[Optional[list]], Tuple[int, int], Optional[dict]]:
+        """
+        Prepare the data of chat folders in a worker process.
+
+        Returns also the number of cache hits and misses and the stats of
+        the profiler, which are lost with the copy of `self` in the worker.
+        """
+
+        results = [
+            self._process_folder(folder, limit, process_chat) for folder in folders
+        ]
+        hits, misses = (self.cache.hits, self.cache.misses) if self.cache else (0, 0)
+        return results, (hits, misses), self.profiler and self.profiler.to_dict()
+
+    def _map_folders(
+        self,
+        limit: int,
+        process_chat: Optional[Callable] = None,
+        with_folders: bool = False,
+    ) -> Iterator:
+        """
+        Lazily prepare all valid chats from `self.home_folder`.
+
+        Chats are processed in a pool of `self.n_jobs` processes if it is
+        greater than 1. In both cases the results are yielded in the order
+        of `get_list_of_folders` and only a few chats are kept in memory.
+
+        Parameters
+        ----------
+        limit : int
+            See `get_list_of_files_in_folder`.
+        process_chat : callable or None (default=None)
+            Function preparing one chat from its folder and files.
+            If None, `self._process_chat` is used.
+        with_folders : bool (default=False)
+            Yield tuples of the folder and the result instead of results.
+        """
+
+        from concurrent.futures import ProcessPoolExecutor
+        from tqdm import tqdm
+
+        process_chat = process_chat or self._process_chat
+        with timer(self.profiler, "list_folders"):
+            folders = self.get_list_of_folders(self.home_folder)
+        self._detect_archive(folders)
+
+        if self.n_jobs > 1 and len(folders) > 1:
+            chunksize = self.chunksize or max(1, len(folders) // (self.n_jobs * 4))
+            chunks = (
+                folders[i : i + chunksize] for i in range(0, len(folders), chunksize)
+            )
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as executor, tqdm(
+                total=len(folders)
+            ) as progress:
+                # Keep only a few chunks in flight, so that the results
+                # do not pile up in memory while the consumer is busy:
+                pending = deque(
+                    (
+                        chunk,
+                        executor.submit(
+                            self._process_folders, chunk, limit, process_chat
+                        ),
+                    )
+                    for chunk in islice(chunks, 2 * self.n_jobs)
+                )
+                while pending:
+                    chunk_folders, future = pending.popleft()
+                    results, (hits, misses), stats = future.result()
+                    if self.cache:
+                        self.cache.hits += hits
+                        self.cache.misses += misses
+                    if self.profiler:
+                        self.profiler.merge(stats)
+                    for chunk in islice(chunks, 1):
+                        pending.append(
+                            (
+                                chunk,
+                                executor.submit(
+                                    self._process_folders, chunk, limit, process_chat
+                                ),
+                            )
+                        )
+                    progress.update(len(results))
+                    for folder, result in zip(chunk_folders, results):
+                        if result is not None:
+                            yield (folder, result) if with_folders else result
+        else:
+            for folder in tqdm(folders):
+                result = self._process_folder(folder, limit, process_chat)
+                if result is not None:
+                    yield (folder, result) if with_folders else result
+
+        if self.cache and self.cache.max_size is not None:
+            with timer(self.profiler, "prune_cache"):
+                self.cache.prune()
+
     @typechecked
     def get_list_of_folders(self, messages_path: str) -> List[str]:
         """
         Scans the folder and selects only valid chats, skipping group chats,
-        applications or some kind of service letters.
+        applications or some kind of service letters by `folders` of the config.
 
         Parameters:
         -----------
@@ -92,19 +488,14 @@ class Data4ML(ABC):
         folders = []
 
         if os.path.isdir(messages_path):
-            for folder in os.listdir(messages_path):
-                if not os.path.isdir(os.path.join(messages_path, folder)):
-                    continue
-                if folder.startswith("-"):  # VK groups or applications
-                    continue
-                if len(folder) < 7:  # some kind of service letters
-                    continue
-                if len(folder) == 10:  # group chats
-                    continue
-                folders.append(folder)
-
-                # This is so that the folders are in the same order as on the git:
-                folders.sort()
+            # `scandir` knows the types of entries without extra system calls:
+            with os.scandir(messages_path) as entries:
+                for entry in entries:
+                    if self.folder_filter.accepts(entry.name) and entry.is_dir():
+                        folders.append(entry.name)
+
+            # This is so that the folders are in the same order as on the git:
+            folders.sort()
         else:
             print(f"No such directory: {messages_path}")
         return folders
@@ -134,16 +525,17 @@ class Data4ML(ABC):
         files = []
         if os.path.isdir(folder_name):
             # Get list of only html files from folder:
-            files = [file for file in os.listdir(folder_name) if file.endswith(".html")]
+            with os.scandir(folder_name) as entries:
+                files = [
+                    entry.name for entry in entries if entry.name.endswith(".html")
+                ]
 
             if len(files) < limit:  # short dialogs
                 return []
 
             # Descending sort to consider message order:
-            files = sorted(
-                files,
-                key=lambda x: int(re.search(r"messages(\d+)\.html", x).group(1)),
-                reverse=True,
+            files.sort(
+                key=lambda x: int(FILE_NUMBER_REGEX.search(x).group(1)), reverse=True
             )
         else:
             print(f"No such directory: {folder_name}")
@@ -151,39 +543,53 @@ class Data4ML(ABC):
 
     @typechecked
     def _clear_message(self, message: str) -> str:
-        """Сlean a message from attachments and garbage using regular expressions.
+        """Сlean a message from attachments and garbage using regular expressions
+        compiled once in `self.cleaner`.
         """
 
-        # If `Ссылка` in message - not append this message:
-        if "\nСсылка\nhttps:" in message or "#comments" in message:
-            return ""
-
-        # Delete trash such as stickers, attached messages:
-        for end in self.message_ends:
-            if message.endswith(end):
-                message = message[: message.rfind("\n")]
-
-        # Delete attachments such as photos, documents, ect.:
-        for attachment in self.blacklist:
-            message = re.sub(f"[\n]?{attachment}[\n]?" + perfect_url_regex, "", message)
-            message = re.sub(f"[\n]?{attachment}[\n]?$", "", message)
+        if not self.profiler:
+            return self.cleaner.clear(message)
 
-        # Delete trash:
-        message = re.sub(perfect_emoji_regex, "", message)
-        message = re.sub(perfect_email_regex, "", message)
-        message = re.sub(perfect_phone_regex, " ", message)
-        message = re.sub(perfect_url_regex, "", message)
-        message = re.sub(f"[\n]?Аудиозапись[\n]?", "", message)
-        message = re.sub("  ", " ", message)
-        message = message.strip()
-
-        return message
+        start = perf_counter()
+        if self.profiler.rules:
+            clear_message = self.cleaner.clear_profiled(message, self.profiler)
+        else:
+            clear_message = self.cleaner.clear(message)
+        self.profiler.add_time("clear_message", perf_counter() - start)
+        self.profiler.count("messages_in")
+        if not clear_message:
+            self.profiler.count(f"dropped_{self.cleaner.drop_reason(message)}")
+        return clear_message
 
     @abstractmethod
     @typechecked
     def clear_messages(self, all_messages: list) -> list:
         pass
 
+    @abstractmethod
+    def save(self, path: str, data: Optional[Iterable] = None, limit: int = 2) -> None:
+        """
+        Save prepared data in the compact binary format, see `corpus`.
+
+        Parameters
+        ----------
+        path : str
+            Folder of the corpus.
+        data : iterable or None (default=None)
+            Output of `make_data`. If None, the data is prepared from
+            `self.home_folder` and written to disk chat by chat.
+        limit : int (default=2)
+            See `make_data`, used only if `data` is None.
+        """
+
+    @staticmethod
+    def load(path: str) -> "Corpus":
+        """Open the data saved by `save`, memory-mapped without reading it."""
+
+        from .corpus import Corpus
+
+        return Corpus(path)
+
     @staticmethod
     @typechecked
     def read_json(path_to_config: str) -> dict:
@@ -203,107 +609,265 @@ class Data4TextGeneration(Data4ML):
 
     @typechecked
     def make_data(self, limit=2) -> list:
-        result = []
-        for folder in tqdm(self.get_list_of_folders(self.home_folder)):
-            parent_folder = os.path.join(self.home_folder, folder)
-            files = self.get_list_of_files_in_folder(parent_folder, limit=limit)
-            if files:
-                messages = self.parse_html(parent_folder, files)
-                clear_messages = self.clear_messages(messages)
-                result.append(clear_messages)
-        return result
+        return list(self.iter_messages(limit))
 
-    @typechecked
-    def parse_html(self, parent_folder: str, files: list) -> list:
-        all_messages = []
-        for file in files:
-            with open(os.path.join(parent_folder, file), "rb") as f:
-                soup = BeautifulSoup(f, "lxml")
+    def iter_messages(self, limit: int = 2) -> Iterator[List[str]]:
+        """
+        Lazily prepare the chats one by one, see `make_data`.
+
+        Yields
+        ------
+        list of str
+            Cleared messages of one chat, without the extra copies
+            if `dedup` is set.
+        """
+
+        if self.dedup is None:
+            return self._map_folders(limit)
+        return (
+            self.dedup.filter(messages, folder)
+            for folder, messages in self._map_folders(limit, with_folders=True)
+        )
+
+    def save(self, path: str, data: Optional[Iterable] = None, limit: int = 2) -> None:
+        from .corpus import save_chats
 
-            messages = []
-            for message in soup.find_all("div", {"class": "message"}):
-                message = message.text.strip()
-                messages.append(message[message.find("\n") + 1 :])
+        save_chats(path, self.iter_messages(limit) if data is None else data)
 
-            # Reverse the list to save the message sequence:
-            all_messages.extend(messages[::-1])
-        return all_messages
+    def _process_chat(self, parent_folder: str, files: List[str]) -> list:
+        return list(self._iter_prepared(parent_folder, files))
+
+    def _prepare_file(self, path: str, content: Optional[bytes] = None) -> list:
+        messages = (
+            message[message.find("\n") + 1 :]
+            for message in self._parse_file(path, content)
+        )
+        return list(self._iter_clear(messages))
 
     @typechecked
-    def clear_messages(self, all_messages: list) -> list:
-        cleared_messages = []
+    def parse_html(self, parent_folder: str, files: list) -> list:
+        return [
+            message[message.find("\n") + 1 :]
+            for message in self._iter_html(parent_folder, files)
+        ]
+
+    def _iter_clear(self, all_messages: Iterable[str]) -> Iterator[str]:
         for message in all_messages:
             message = self._clear_message(message)
             if message:
-                cleared_messages.append(message)
+                if self.profiler:
+                    self.profiler.count("messages_out")
+                yield message
 
-        return cleared_messages
+    @typechecked
+    def clear_messages(self, all_messages: list) -> list:
+        return list(self._iter_clear(all_messages))
 
 
 class Data4Chatbot(Data4ML):
-    def __init__(self, max_length: int = 10, **kwargs):
+    """
+    Collects pairs of a message and the answer to it, merging consecutive
+    messages of the same author into one.
+
+    Parameters
+    ----------
+    max_length : int (default=10)
+        Pairs with a message of this many words or more are skipped.
+    min_length : int (default=1)
+        Pairs with a message of fewer words are skipped.
+    max_ratio : float or None (default=None)
+        Pairs where one message is more than `max_ratio` times longer than
+        the other are skipped. The ratio is not checked if None.
+    session_gap : float or None (default=None)
+        Split chats into sessions where no one wrote for longer than
+        `session_gap` seconds. Messages are merged and paired only within
+        a session, so an answer sent months later is not paired with
+        an unrelated question. Chats are not split if None.
+    **kwargs
+        Parameters of `Data4ML`.
+    """
+
+    def __init__(
+        self,
+        max_length: int = 10,
+        min_length: int = 1,
+        max_ratio: Optional[float] = None,
+        session_gap: Optional[float] = None,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
         self.max_length = max_length
+        self.min_length = min_length
+        self.max_ratio = max_ratio
+        self.session_gap = session_gap
 
     @typechecked
     def make_data(self, limit=2) -> list:
-        result = []
-        for folder in tqdm(self.get_list_of_folders(self.home_folder)):
-            parent_folder = os.path.join(self.home_folder, folder)
-            files = self.get_list_of_files_in_folder(parent_folder, limit=limit)
-            if files:
-                messages = self.parse_html(parent_folder, files)
-                clear_messages = self.clear_messages(messages)
-                result.extend(self.get_pairs(clear_messages))
-        return result
+        return list(self.iter_pairs(limit))
 
-    @typechecked
-    def parse_html(self, parent_folder: str, files: list) -> list:
-        all_messages = []
-        for file in files:
-            with open(os.path.join(parent_folder, file), "rb") as f:
-                soup = BeautifulSoup(f, "lxml")
+    def iter_messages(self, limit: int = 2) -> Iterator[List[str]]:
+        """
+        Lazily prepare the chats one by one.
+
+        Yields
+        ------
+        list of str
+            Normalized messages of one chat, merged by author within
+            sessions if `session_gap` is set.
+        """
+
+        return self._map_folders(limit, self._process_messages)
+
+    def iter_pairs(self, limit: int = 2) -> Iterator[List[str]]:
+        """
+        Lazily prepare the pairs of all chats, see `make_data`.
 
-            messages = []
-            for message in soup.find_all("div", {"class": "message"}):
-                message = message.text.strip()
-                messages.append(message)
+        Yields
+        ------
+        list of str
+            Pair of a message and the answer to it.
+        """
+
+        if self.dedup is None:
+            for pairs in self._map_folders(limit):
+                yield from pairs
+        else:
+            for folder, pairs in self._map_folders(limit, with_folders=True):
+                yield from self.dedup.filter_pairs(pairs, folder)
+
+    def save(self, path: str, data: Optional[Iterable] = None, limit: int = 2) -> None:
+        from .corpus import save_pairs
+
+        save_pairs(path, self.iter_pairs(limit) if data is None else data)
 
-            # Reverse the list to save the message sequence:
-            all_messages.extend(messages[::-1])
-        return all_messages
+    def _iter_sessions(self, parent_folder: str, files: List[str]) -> Iterator[list]:
+        """
+        Rows of `_prepare_file` of the chat split into sessions by
+        `self.session_gap`, the whole chat is one session if it is None.
+        """
+
+        rows = list(self._iter_prepared(parent_folder, files))
+        if self.session_gap is None or not rows:
+            yield rows
+            return
+
+        with timer(self.profiler, "split_sessions"):
+            timestamps = [timestamp for _, _, timestamp, _ in rows]
+            bounds = session_bounds(timestamps, self.session_gap).tolist()
+        if self.profiler:
+            self.profiler.count("sessions", len(bounds) - 1)
+        for start, end in zip(bounds, bounds[1:]):
+            yield rows[start:end]
+
+    def _merge_session(self, rows: list) -> Iterator[str]:
+        return self._merge_turns((author_id, text) for _, author_id, _, text in rows)
+
+    def _process_messages(self, parent_folder: str, files: List[str]) -> list:
+        return [
+            message
+            for rows in self._iter_sessions(parent_folder, files)
+            for message in self._merge_session(rows)
+        ]
+
+    def _process_chat(self, parent_folder: str, files: List[str]) -> list:
+        return [
+            pair
+            for rows in self._iter_sessions(parent_folder, files)
+            for pair in self._iter_pairs(self._merge_session(rows))
+        ]
+
+    def _prepare_file(self, path: str, content: Optional[bytes] = None) -> list:
+        # Records are kept as json rows of the cache:
+        return [
+            [record.id, record.author_id, record.timestamp, record.text]
+            for record in self._iter_records(path, content)
+        ]
+
+    @typechecked
+    def parse_html(self, parent_folder: str, files: list) -> list:
+        return list(self._iter_html(parent_folder, files))
 
     @typechecked
     def normalize_message(self, s: str) -> str:
         """Lowercase, trim, and remove non-letter characters"""
 
+        if self.profiler:
+            start = perf_counter()
+            s = self._normalize_message(s)
+            self.profiler.add_time("normalize_message", perf_counter() - start)
+            return s
+        return self._normalize_message(s)
+
+    def _normalize_message(self, s: str) -> str:
         s = s.lower().strip()
         s = re.sub("\n", ".", s)
         s = re.sub(r"([.!?])", r" \1", s)  # add space before `.`, `!` or `?`
-        s = re.sub(r"[^а-яА-ЯёЁa-zA-Z.!?]+", r" ", s)  # remove non-letter characters
+        s = NON_LETTER_REGEX.sub(" ", s)  # remove non-letter characters
         s = re.sub(r"\s+", r" ", s).strip()
         return s
 
     @typechecked
     def _check_max_length(self, p: list) -> bool:
-        """Return True if both sentences in a pair 'p' are underthe `self.max_length` threshold.
-        """
+        """Return True if both sentences in a pair 'p' are underthe `self.max_length` threshold."""
 
         return (
             len(p[0].split(" ")) < self.max_length
             and len(p[1].split(" ")) < self.max_length
         )
 
+    @staticmethod
+    def count_words(messages: Iterable[str]) -> "np.ndarray":
+        """Number of words of every message, split by spaces as in `Voc`."""
+
+        import numpy as np
+
+        return np.fromiter((message.count(" ") + 1 for message in messages), np.int32)
+
+    def _length_mask(self, first: "np.ndarray", second: "np.ndarray") -> "np.ndarray":
+        """
+        Which pairs are kept by the numbers of words of their messages,
+        see `max_length`, `min_length` and `max_ratio`.
+        """
+
+        import numpy as np
+
+        mask = (first < self.max_length) & (second < self.max_length)
+        if self.min_length > 1:
+            mask &= (first >= self.min_length) & (second >= self.min_length)
+        if self.max_ratio is not None:
+            mask &= np.maximum(first, second) <= self.max_ratio * np.minimum(
+                first, second
+            )
+        return mask
+
     @typechecked
     def filter_pairs(self, pairs: list) -> list:
-        """Filter pairs using filterPair condition."""
+        """Filter pairs by the numbers of words of their messages."""
 
-        return [pair for pair in pairs if self._check_max_length(pair)]
+        mask = self._length_mask(
+            self.count_words(pair[0] for pair in pairs),
+            self.count_words(pair[1] for pair in pairs),
+        )
+        return [pair for pair, keep in zip(pairs, mask.tolist()) if keep]
 
     @typechecked
     def get_pairs(self, messages: list) -> list:
-        pairs = [[messages[i - 1], messages[i]] for i in range(1, len(messages))]
-        return self.filter_pairs(pairs)
+        return list(self._iter_pairs(messages))
+
+    def _iter_pairs(self, messages: Iterable[str]) -> Iterator[List[str]]:
+        """
+        Pairs of consecutive messages, see `get_pairs`. Words of every message
+        are counted once and the pairs are filtered by one mask over them.
+        """
+
+        messages = list(messages)
+        with timer(self.profiler, "filter_pairs"):
+            lengths = self.count_words(messages)
+            kept = self._length_mask(lengths[:-1], lengths[1:]).nonzero()[0]
+        if self.profiler:
+            self.profiler.count("dropped_pairs", max(len(messages) - 1, 0) - len(kept))
+        for i in kept.tolist():
+            yield [messages[i], messages[i + 1]]
 
     @typechecked
     def check_last_character(self, messages: list) -> None:
@@ -312,25 +876,58 @@ class Data4Chatbot(Data4ML):
 
     @typechecked
     def clear_messages(self, all_messages: list) -> list:
-        messages = []
+        """
+        Clear the messages of `parse_html` and merge consecutive messages
+        of the same author.
+
+        It is the legacy path: the texts have only the display names
+        of authors, so messages are merged by the name before the comma
+        and different people with the same name are taken for one author.
+        `make_data` and `iter_messages` merge by the ids of authors.
+        """
+
+        return list(self._merge_turns(self._iter_authored(all_messages)))
+
+    def _clean_text(self, message: str) -> str:
+        clear_message = self._clear_message(message)
+        if clear_message:
+            clear_message = self.normalize_message(clear_message)
+            if not clear_message and self.profiler:
+                self.profiler.count("dropped_normalized")
+        return clear_message
+
+    def _iter_authored(self, all_messages: Iterable[str]) -> Iterator[List[str]]:
+        """
+        Clear and normalize messages.
+
+        Yields
+        ------
+        list of str
+            Author and text of every message which is not empty after cleaning.
+        """
 
-        # Who start the dialog:
-        last_author = all_messages[0][: all_messages[0].find(",")]
         for message in all_messages:
             author = message[: message.find(",")]
-            message = message[message.find("\n") + 1 :]
-            clear_message = self.normalize_message(self._clear_message(message))
+            clear_message = self._clean_text(message[message.find("\n") + 1 :])
             if clear_message:
+                if self.profiler:
+                    self.profiler.count("messages_out")
+                yield [author, clear_message]
+
+    def _merge_turns(self, authored: Iterable) -> Iterator[str]:
+        """Merge consecutive messages of the same author into one."""
 
-                if author == last_author:  # still one message
-                    if messages:
-                        messages[-1] += " \n " + clear_message
-                    else:  # for the first iteration
-                        messages.append(clear_message)
-                else:  # if author change
-                    messages.append(clear_message)
+        turn = None
+        last_author = None
+        for author, clear_message in authored:
+            if turn is not None and author == last_author:  # still one message
+                turn += " \n " + clear_message
+            else:  # if author change or for the first iteration
+                if turn is not None:
+                    yield turn
+                turn = clear_message
 
-                last_author = author
+            last_author = author
 
             # TODO:
             """
@@ -359,4 +956,5 @@ class Data4Chatbot(Data4ML):
 
             3. Нужны ли нам знаки вопроса и точки?
             """
-        return messages
+        if turn is not None:
+            yield turn
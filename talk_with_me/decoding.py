@@ -0,0 +1,325 @@
+"""
+Replies of the seq2seq chatbot to many messages at once.
+
+`GreedySearchDecoder` and `evaluate` from `Data4Chatbot.ipynb` run the
+encoder and the decoder for one message at a time. `BatchDecoder` pads
+a batch of messages and decodes all of them together, greedily, by top-k
+sampling or by beam search.
+"""
+import math
+from typing import List, Optional, Tuple
+import numpy as np
+import torch
+from .seq2seq import EncoderRNN, LuongAttnDecoderRNN
+from .vocabulary import EOS_token, PAD_token, SOS_token, Voc
+
+METHODS = ["greedy", "sample", "beam"]
+
+
+class BatchDecoder:
+    """
+    Decoder of batches of messages with the models of the chatbot.
+
+    The tokens and scores of all steps are written into tensors allocated
+    once per batch. A sequence stops at `EOS_token`, and finished sequences
+    are dropped from the batch, so the remaining steps are cheaper.
+
+    Parameters
+    ----------
+    encoder : EncoderRNN
+        Trained encoder, switched to the eval mode.
+    decoder : LuongAttnDecoderRNN
+        Trained decoder, switched to the eval mode.
+    voc : Voc
+        Vocabulary of the models.
+    max_length : int (default=10)
+        Max number of words in a reply, `MAX_LENGTH` of the notebook.
+    device : str (default="cpu")
+        Device of the models.
+    n_layers : int or None (default=None)
+        Number of layers of the decoder, `decoder.n_layers` if None. An
+        exported decoder has no attributes, so it has to be given.
+    """
+
+    def __init__(
+        self,
+        encoder: EncoderRNN,
+        decoder: LuongAttnDecoderRNN,
+        voc: Voc,
+        max_length: int = 10,
+        device: str = "cpu",
+        n_layers: Optional[int] = None,
+    ):
+        self.encoder = encoder.eval()
+        self.decoder = decoder.eval()
+        self.voc = voc
+        self.max_length = max_length
+        self.device = device
+        self.n_layers = decoder.n_layers if n_layers is None else n_layers
+
+    def encode(self, sentences: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Time-major padded indexes of the words of normalized sentences and
+        their lengths, see `Data4Chatbot.normalize_message`. Unlike
+        `evaluate` of the notebook, unknown words are skipped instead of
+        raising KeyError.
+        """
+
+        if not sentences:
+            raise ValueError("Nothing to encode")
+        indexes, offsets = self.voc.encode(sentences)
+        known = indexes >= 0
+        lengths = np.add.reduceat(known.astype(np.int64), offsets[:-1])
+        indexes = torch.from_numpy(indexes[known].astype(np.int64))
+        lengths = torch.as_tensor(lengths, dtype=torch.long)
+        input_seq = torch.nn.utils.rnn.pad_sequence(
+            torch.split(indexes, lengths.tolist()), padding_value=PAD_token
+        )
+        return input_seq.to(self.device), lengths
+
+    def _encode_batch(
+        self, input_seq: torch.Tensor, lengths: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Outputs of the encoder, first hidden state of the decoder and the mask."""
+
+        encoder_outputs, encoder_hidden = self.encoder(input_seq, lengths)
+        hidden = encoder_hidden[: self.n_layers]
+        positions = torch.arange(encoder_outputs.size(0), device=self.device)
+        mask = positions[:, None] < lengths.to(self.device)[None, :]
+        return encoder_outputs, hidden, mask
+
+    def _search(
+        self,
+        input_seq: torch.Tensor,
+        lengths: torch.Tensor,
+        max_length: int,
+        top_k: Optional[int] = None,
+        temperature: float = 1.0,
+        generator: Optional[torch.Generator] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Greedy search if `top_k` is None, top-k sampling otherwise.
+
+        Returns
+        -------
+        torch.Tensor
+            Time-major tokens, `(max length, batch size)`, `PAD_token`
+            after the end of a sequence.
+        torch.Tensor
+            Probabilities of the tokens.
+        """
+
+        encoder_outputs, hidden, mask = self._encode_batch(input_seq, lengths)
+        batch_size = input_seq.size(1)
+        tokens = torch.full(
+            (max_length, batch_size), PAD_token, dtype=torch.long, device=self.device
+        )
+        scores = torch.zeros(max_length, batch_size, device=self.device)
+        step_input = torch.full(
+            (1, batch_size), SOS_token, dtype=torch.long, device=self.device
+        )
+        # Columns of the running sequences in `tokens`:
+        active = torch.arange(batch_size, device=self.device)
+
+        for step in range(max_length):
+            output, hidden = self.decoder(step_input, hidden, encoder_outputs, mask)
+            if top_k is None:
+                score, token = torch.max(output, dim=1)
+            else:
+                top_scores, top_tokens = output.topk(top_k, dim=1)
+                weights = top_scores ** (1 / temperature)
+                choice = torch.multinomial(weights, 1, generator=generator)
+                token = top_tokens.gather(1, choice).squeeze(1)
+                score = top_scores.gather(1, choice).squeeze(1)
+            tokens[step, active] = token
+            scores[step, active] = score
+
+            running = token != EOS_token
+            if not running.all():
+                if not running.any():
+                    break
+                active = active[running]
+                token = token[running]
+                hidden = hidden[:, running]
+                encoder_outputs = encoder_outputs[:, running]
+                mask = mask[:, running]
+            step_input = token.unsqueeze(0)
+        return tokens, scores
+
+    def _beam_search(
+        self,
+        input_seq: torch.Tensor,
+        lengths: torch.Tensor,
+        max_length: int,
+        beam_size: int,
+        length_penalty: float,
+    ) -> torch.Tensor:
+        """
+        Beam search, the beams of every input are decoded in one batch.
+        A finished beam keeps its score and is extended only by `PAD_token`.
+
+        Returns
+        -------
+        torch.Tensor
+            Time-major tokens of the best beam of every input, see `_search`.
+        """
+
+        batch_size = input_seq.size(1)
+        encoder_outputs, hidden, mask = self._encode_batch(input_seq, lengths)
+        # The beams of input `i` are the rows `i * beam_size + beam`:
+        encoder_outputs = encoder_outputs.repeat_interleave(beam_size, dim=1)
+        hidden = hidden.repeat_interleave(beam_size, dim=1)
+        mask = mask.repeat_interleave(beam_size, dim=1)
+
+        shape = (max_length, batch_size, beam_size)
+        tokens = torch.full(shape, PAD_token, dtype=torch.long, device=self.device)
+        parents = torch.zeros(shape, dtype=torch.long, device=self.device)
+        beam_scores = torch.full(
+            (batch_size, beam_size), float("-inf"), device=self.device
+        )
+        beam_scores[:, 0] = 0  # all beams start as one
+        beam_lengths = torch.zeros(
+            (batch_size, beam_size), dtype=torch.long, device=self.device
+        )
+        finished = torch.zeros(
+            (batch_size, beam_size), dtype=torch.bool, device=self.device
+        )
+        first_rows = torch.arange(batch_size, device=self.device)[:, None] * beam_size
+        step_input = torch.full(
+            (1, batch_size * beam_size), SOS_token, dtype=torch.long, device=self.device
+        )
+
+        for step in range(max_length):
+            output, hidden = self.decoder(step_input, hidden, encoder_outputs, mask)
+            n_words = output.size(1)
+            log_probs = output.clamp_min(1e-30).log().view(batch_size, beam_size, -1)
+            log_probs[finished] = float("-inf")
+            log_probs[finished, PAD_token] = 0
+
+            candidates = (beam_scores.unsqueeze(2) + log_probs).view(batch_size, -1)
+            beam_scores, best = candidates.topk(beam_size, dim=1)
+            parent = torch.div(best, n_words, rounding_mode="floor")
+            token = best % n_words
+            tokens[step] = token
+            parents[step] = parent
+
+            finished = finished.gather(1, parent)
+            beam_lengths = beam_lengths.gather(1, parent) + (~finished).long()
+            finished = finished | (token == EOS_token)
+            if finished.all():
+                break
+            hidden = hidden[:, (first_rows + parent).view(-1)]
+            step_input = token.view(1, -1)
+
+        beam = (beam_scores / beam_lengths.clamp_min(1) ** length_penalty).argmax(dim=1)
+        result = tokens[: step + 1, :, 0].clone()
+        for i in range(step, -1, -1):
+            result[i] = tokens[i].gather(1, beam[:, None]).squeeze(1)
+            beam = parents[i].gather(1, beam[:, None]).squeeze(1)
+        return result
+
+    def _to_words(self, tokens: torch.Tensor) -> List[List[str]]:
+        """Words of every column of tokens up to `EOS_token` or `PAD_token`."""
+
+        replies = []
+        for column in tokens.t().tolist():
+            words = []
+            for token in column:
+                if token in (EOS_token, PAD_token):
+                    break
+                words.append(self.voc.index2word[token])
+            replies.append(words)
+        return replies
+
+    def decode(
+        self,
+        sentences: List[str],
+        method: str = "greedy",
+        max_length: Optional[int] = None,
+        top_k: int = 10,
+        temperature: float = 1.0,
+        beam_size: int = 5,
+        length_penalty: float = 1.0,
+        generator: Optional[torch.Generator] = None,
+    ) -> List[List[str]]:
+        """
+        Words of the replies to the sentences, in their order.
+
+        Parameters
+        ----------
+        sentences : list of str
+            Normalized messages.
+        method : str (default="greedy")
+            `greedy` takes the most probable word at every step, `sample`
+            draws it from the `top_k` most probable ones and `beam` keeps
+            `beam_size` most probable replies.
+        max_length : int or None (default=None)
+            Max number of words in a reply, `self.max_length` if None.
+        top_k : int (default=10)
+            Number of words to sample from.
+        temperature : float (default=1.0)
+            Temperature of sampling, lower values give more probable words.
+        beam_size : int (default=5)
+            Number of beams of every sentence.
+        length_penalty : float (default=1.0)
+            The scores of finished beams are divided by their length to this
+            power, so 0 prefers short replies.
+        generator : torch.Generator or None (default=None)
+            Random generator of sampling.
+        """
+
+        if method not in METHODS:
+            raise ValueError(f"Unknown method: {method}, expected one of {METHODS}")
+        if not sentences:
+            return []
+        max_length = max_length or self.max_length
+
+        with torch.no_grad():
+            input_seq, lengths = self.encode(sentences)
+            if method == "beam":
+                tokens = self._beam_search(
+                    input_seq, lengths, max_length, beam_size, length_penalty
+                )
+            else:
+                tokens, _ = self._search(
+                    input_seq,
+                    lengths,
+                    max_length,
+                    top_k if method == "sample" else None,
+                    temperature,
+                    generator,
+                )
+        return self._to_words(tokens)
+
+    def perplexity(self, pairs: List[List[str]], batch_size: int = 64) -> float:
+        """
+        Perplexity of the answers of normalized pairs and their `EOS_token`
+        given the questions, the decoder is fed the words of the answer as in
+        training. Unknown words are skipped, see `encode`.
+        """
+
+        total_nll, total_words = 0.0, 0
+        with torch.no_grad():
+            for start in range(0, len(pairs), batch_size):
+                batch = pairs[start : start + batch_size]
+                input_seq, lengths = self.encode([question for question, _ in batch])
+                target, target_lengths = self.encode([answer for _, answer in batch])
+                target_lengths = target_lengths.to(self.device)
+
+                encoder_outputs, hidden, mask = self._encode_batch(input_seq, lengths)
+                step_input = torch.full_like(target[:1], SOS_token)
+                for step in range(target.size(0)):
+                    output, hidden = self.decoder(
+                        step_input, hidden, encoder_outputs, mask
+                    )
+                    probs = output.gather(1, target[step, :, None]).squeeze(1)
+                    valid = step < target_lengths
+                    total_nll -= probs[valid].clamp_min(1e-30).log().sum().item()
+                    step_input = target[step : step + 1]
+                total_words += int(target_lengths.sum())
+        return math.exp(total_nll / total_words) if total_words else float("nan")
+
+    def reply(self, sentences: List[str], **kwargs) -> List[str]:
+        """Replies to the sentences as strings, see `decode` for the arguments."""
+
+        return [" ".join(words) for words in self.decode(sentences, **kwargs)]
@@ -0,0 +1,282 @@
+"""
+Removal of repeated messages and pairs across the whole archive.
+"""
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+import zlib
+import numpy as np
+
+MASK64 = (1 << 64) - 1
+MAX_COUNT = (1 << 32) - 1
+
+
+class HashIndex:
+    """
+    Set of 64-bit hashes with the number of occurrences of each one.
+
+    Hashes and counts are kept in two flat arrays with open addressing,
+    12 bytes per slot, about half of a python `set` of ints with the ints.
+    Hashes are built-in `hash` of strings, so an index is valid only
+    within one process.
+
+    Parameters
+    ----------
+    capacity : int (default=1 << 16)
+        Initial number of slots, rounded up to a power of two. The table
+        grows twice when it is half full.
+    max_items : int or None (default=None)
+        Max number of hashes to keep. Above it new hashes are not added,
+        so the memory is bounded, but their repeats are not detected.
+    """
+
+    def __init__(self, capacity: int = 1 << 16, max_items: Optional[int] = None):
+        capacity = 1 << max(capacity - 1, 1).bit_length()
+        self.max_items = max_items
+        self.n_items = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int) -> None:
+        self.keys = array("Q", bytes(8 * capacity))
+        self.counts = array("I", bytes(4 * capacity))
+        self.mask = capacity - 1
+
+    def _grow(self) -> None:
+        keys, counts = self.keys, self.counts
+        self._allocate(2 * len(keys))
+        for key, count in zip(keys, counts):
+            if key:
+                i = key & self.mask
+                while self.keys[i]:
+                    i = (i + 1) & self.mask
+                self.keys[i] = key
+                self.counts[i] = count
+
+    def add(self, key: int) -> int:
+        """
+        Add a hash and return the number of its previous occurrences.
+        """
+
+        key = (key & MASK64) or 1  # 0 marks empty slots
+        keys, mask = self.keys, self.mask
+        i = key & mask
+        while True:
+            found = keys[i]
+            if found == key:
+                count = self.counts[i]
+                self.counts[i] = min(count + 1, MAX_COUNT)
+                return count
+            if not found:
+                break
+            i = (i + 1) & mask
+
+        if self.max_items is None or self.n_items < self.max_items:
+            keys[i] = key
+            self.counts[i] = 1
+            self.n_items += 1
+            if 2 * self.n_items > len(keys):
+                self._grow()
+        return 0
+
+    def __contains__(self, key: int) -> bool:
+        key = (key & MASK64) or 1
+        i = key & self.mask
+        while self.keys[i]:
+            if self.keys[i] == key:
+                return True
+            i = (i + 1) & self.mask
+        return False
+
+    def __len__(self) -> int:
+        return self.n_items
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.itemsize * len(self.keys) + self.counts.itemsize * len(
+            self.counts
+        )
+
+
+class MinHasher:
+    """
+    MinHash signatures of character shingles, split into bands for
+    locality-sensitive hashing: two texts with Jaccard similarity `s`
+    share a band with probability `1 - (1 - s ** rows) ** bands`.
+
+    With the default 16 bands of 8 rows texts with similarity 0.8 share
+    a band with probability 0.95, with 0.5 - 0.06 and with 0.3 - 0.001.
+    Over a large archive even these small chances add up, so a shared
+    band only makes a candidate, see `Deduplicator`.
+
+    Parameters
+    ----------
+    num_perm : int (default=128)
+        Number of hash functions of a signature.
+    bands : int (default=16)
+        Number of bands, must divide `num_perm`.
+    shingle_size : int (default=3)
+        Number of characters in a shingle.
+    seed : int (default=0)
+        Seed of the hash functions.
+    """
+
+    def __init__(
+        self,
+        num_perm: int = 128,
+        bands: int = 16,
+        shingle_size: int = 3,
+        seed: int = 0,
+    ):
+        if num_perm % bands:
+            raise ValueError("bands must divide num_perm")
+        self.bands = bands
+        self.shingle_size = shingle_size
+
+        # Multiply-shift hashing with odd multipliers:
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 63, num_perm, dtype=np.uint64) * 2 + 1
+        self.b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        k = self.shingle_size
+        shingles = {text[i : i + k] for i in range(max(len(text) - k + 1, 1))}
+        # crc32 instead of `hash`, so the signatures do not depend on the process:
+        x = np.fromiter(
+            (zlib.crc32(s.encode()) for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        hashes = (self.a[:, None] * x + self.b[:, None]) >> np.uint64(32)
+        return hashes.min(axis=1).astype(np.uint32)
+
+    def band_hashes(self, signature: np.ndarray) -> List[int]:
+        """Hash of every band of the signature."""
+
+        return [
+            hash((i, band.tobytes()))
+            for i, band in enumerate(np.split(signature, self.bands))
+        ]
+
+    @staticmethod
+    def similarity(first: np.ndarray, second: np.ndarray) -> float:
+        """Estimate of the Jaccard similarity of two texts by their signatures."""
+
+        return float(np.count_nonzero(first == second)) / len(first)
+
+
+class Deduplicator:
+    """
+    Keep at most `max_copies` copies of every message or pair
+    across all chats and count the duplicates of every chat.
+
+    Parameters
+    ----------
+    max_copies : int (default=1)
+        Number of copies to keep. 1 drops all duplicates, greater values
+        only down-weight the frequent ones.
+    near : bool (default=False)
+        Detect also near-duplicates, such as the same message with another
+        punctuation, by MinHash of character shingles, see `MinHasher`.
+        A text which shares a band with a previous one is its copy only
+        if their signatures agree at least by `threshold`.
+    threshold : float (default=0.75)
+        Min similarity of near-duplicates.
+    max_items : int or None (default=None)
+        Max number of distinct items to remember, see `HashIndex`.
+        Near-duplicates keep also a signature of every distinct text,
+        `4 * num_perm` bytes each.
+    """
+
+    def __init__(
+        self,
+        max_copies: int = 1,
+        near: bool = False,
+        threshold: float = 0.75,
+        max_items: Optional[int] = None,
+    ):
+        self.max_copies = max_copies
+        self.max_items = max_items
+        self.index = HashIndex(max_items=max_items)
+        self.minhasher = MinHasher() if near else None
+        self.threshold = threshold
+        self.signatures: List[np.ndarray] = []
+        self.near_counts = array("I")
+        self.band_buckets: List[Dict[int, int]] = (
+            [{} for _ in range(self.minhasher.bands)] if near else []
+        )
+        self.totals: Counter = Counter()
+        self.duplicates: Counter = Counter()
+
+    def _count_near(self, text: str) -> int:
+        signature = self.minhasher.signature(text)
+        keys = self.minhasher.band_hashes(signature)
+        for bucket, key in zip(self.band_buckets, keys):
+            i = bucket.get(key)
+            if (
+                i is not None
+                and self.minhasher.similarity(self.signatures[i], signature)
+                >= self.threshold
+            ):
+                count = self.near_counts[i]
+                self.near_counts[i] = min(count + 1, MAX_COUNT)
+                return count
+
+        if self.max_items is None or len(self.signatures) < self.max_items:
+            i = len(self.signatures)
+            self.signatures.append(signature)
+            self.near_counts.append(1)
+            for bucket, key in zip(self.band_buckets, keys):
+                bucket.setdefault(key, i)
+        return 0
+
+    def count(self, text: str) -> int:
+        """Register the text and return the number of its previous copies."""
+
+        count = self.index.add(hash(text))
+        if self.minhasher is not None:
+            count = max(count, self._count_near(text))
+        return count
+
+    def filter(self, texts: Iterable[str], chat: Optional[str] = None) -> List[str]:
+        """Messages of the chat without the extra copies."""
+
+        kept = []
+        for text in texts:
+            self.totals[chat] += 1
+            if self.count(text) < self.max_copies:
+                kept.append(text)
+            else:
+                self.duplicates[chat] += 1
+        return kept
+
+    def filter_pairs(
+        self, pairs: Iterable[List[str]], chat: Optional[str] = None
+    ) -> List[List[str]]:
+        """Pairs of the chat without the extra copies."""
+
+        kept = []
+        for pair in pairs:
+            self.totals[chat] += 1
+            if self.count(f"{pair[0]}\0{pair[1]}") < self.max_copies:
+                kept.append(pair)
+            else:
+                self.duplicates[chat] += 1
+        return kept
+
+    def stats(self) -> Dict[str, dict]:
+        """Number of items, duplicates and their ratio overall and by chats."""
+
+        def ratio(total: int, duplicates: int) -> dict:
+            return {
+                "total": total,
+                "duplicates": duplicates,
+                "ratio": duplicates / total if total else 0.0,
+            }
+
+        return {
+            "overall": ratio(sum(self.totals.values()), sum(self.duplicates.values())),
+            "chats": {
+                chat: ratio(total, self.duplicates[chat])
+                for chat, total in self.totals.items()
+            },
+        }
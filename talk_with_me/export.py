@@ -0,0 +1,254 @@
+"""
+TorchScript export of the chatbot and the LSTM text generator for CPU.
+
+The models are traced, so an artifact is loaded by `torch.jit.load` without
+the classes of the notebooks. By default the LSTM, GRU and Linear layers are
+quantized first with dynamic int8 quantization: their weights are stored in
+int8 and the activations are quantized on the fly, which needs no
+calibration data. The vocabulary and the sizes of the models are stored in
+the artifact as extra files, so `load_batch_decoder` and
+`load_text_generator` need nothing else.
+
+Usage:
+    python -m talk_with_me.export chatbot checkpoint.tar chatbot.pt --pairs ./corpus
+    python -m talk_with_me.export generator model-1000.pth generator.pt \\
+        --vocab ./dataset --float
+
+With `--pairs` (a corpus of `save_pairs`) or `--vocab` the perplexity of the
+eager and of the exported model is printed, for the chatbot also the share
+of equal greedy replies.
+"""
+
+import argparse
+import json
+import os
+from itertools import islice
+from typing import List, Optional, Tuple
+import torch
+from torch import nn
+from .corpus import Corpus
+from .decoding import BatchDecoder
+from .generation import RNNModule, TextGenerator
+from .seq2seq import EncoderRNN, LuongAttnDecoderRNN, load_checkpoint
+from .state_cache import StateCache
+from .text_dataset import TokenDataset
+from .vocabulary import EOS_token, SOS_token, Voc
+
+QUANTIZED_LAYERS = {nn.LSTM, nn.GRU, nn.Linear}
+
+
+def quantize(model: nn.Module) -> nn.Module:
+    """Copy of the model with int8 weights of `QUANTIZED_LAYERS`."""
+
+    return torch.quantization.quantize_dynamic(
+        model.eval(), QUANTIZED_LAYERS, dtype=torch.qint8
+    )
+
+
+class Seq2Seq(nn.Module):
+    """Traced encoder and decoder of the chatbot saved as one module."""
+
+    def __init__(
+        self, encoder: torch.jit.ScriptModule, decoder: torch.jit.ScriptModule
+    ):
+        super().__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def forward(
+        self, input_seq: torch.Tensor, lengths: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.encoder(input_seq, lengths)
+
+
+def export_generator(
+    net: RNNModule, int_to_vocab: List[str], path: str, quantized: bool = True
+) -> None:
+    """
+    Saves `forward` and `feed` of the LSTM of `GenerationLSTM.ipynb` traced,
+    with int8 weights if `quantized`, together with its vocabulary.
+    """
+
+    config = {"model": "generator", "lstm_size": net.lstm_size, "quantized": quantized}
+    net = quantize(net) if quantized else net.eval()
+    x = torch.zeros((2, 3), dtype=torch.long)
+    lengths = torch.tensor([3, 2])
+    state = net.zero_state(2)
+    with torch.no_grad():
+        traced = torch.jit.trace_module(
+            net, {"forward": (x, state), "feed": (x, lengths, state)}
+        )
+    torch.jit.save(
+        traced,
+        path,
+        _extra_files={
+            "config.json": json.dumps(config),
+            "vocab.json": json.dumps(int_to_vocab, ensure_ascii=False),
+        },
+    )
+
+
+def export_chatbot(
+    encoder: EncoderRNN,
+    decoder: LuongAttnDecoderRNN,
+    voc: Voc,
+    path: str,
+    quantized: bool = True,
+) -> None:
+    """
+    Saves the encoder and a step of the decoder of `Data4Chatbot.ipynb`
+    traced, with int8 weights if `quantized`, together with the vocabulary.
+    """
+
+    config = {"model": "chatbot", "n_layers": decoder.n_layers, "quantized": quantized}
+    if quantized:
+        encoder, decoder = quantize(encoder), quantize(decoder)
+    else:
+        encoder, decoder = encoder.eval(), decoder.eval()
+
+    input_seq = torch.full((3, 2), EOS_token, dtype=torch.long)
+    lengths = torch.tensor([3, 2])
+    with torch.no_grad():
+        encoder_outputs, hidden = encoder(input_seq, lengths)
+        mask = torch.arange(3)[:, None] < lengths[None, :]
+        step_input = torch.full((1, 2), SOS_token, dtype=torch.long)
+        traced_encoder = torch.jit.trace(encoder, (input_seq, lengths))
+        traced_decoder = torch.jit.trace(
+            decoder, (step_input, hidden[: decoder.n_layers], encoder_outputs, mask)
+        )
+    voc_dict = dict(voc.__dict__, word2count={})  # the counts are not used
+    torch.jit.save(
+        torch.jit.script(Seq2Seq(traced_encoder, traced_decoder)),
+        path,
+        _extra_files={
+            "config.json": json.dumps(config),
+            "vocab.json": json.dumps(voc_dict, ensure_ascii=False),
+        },
+    )
+
+
+def load_exported(path: str) -> Tuple[torch.jit.ScriptModule, dict, object]:
+    """Module, config and vocabulary of an artifact."""
+
+    extra_files = {"config.json": "", "vocab.json": ""}
+    module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    config = json.loads(extra_files["config.json"])
+    return module, config, json.loads(extra_files["vocab.json"])
+
+
+def load_batch_decoder(path: str, **kwargs) -> BatchDecoder:
+    """Decoder of an artifact of `export_chatbot`, see `BatchDecoder` for `kwargs`."""
+
+    module, config, voc_dict = load_exported(path)
+    if config["model"] != "chatbot":
+        raise ValueError(f"{path} is not an export of the chatbot")
+    voc = Voc(voc_dict["name"])
+    voc.__dict__.update(voc_dict)
+    # Json keys are strings:
+    voc.index2word = {int(i): word for i, word in voc_dict["index2word"].items()}
+    return BatchDecoder(
+        module.encoder, module.decoder, voc, n_layers=config["n_layers"], **kwargs
+    )
+
+
+def load_text_generator(
+    path: str, length: int = 50, top_k: int = 5, cache: Optional[StateCache] = None
+) -> TextGenerator:
+    """Generator of an artifact of `export_generator`."""
+
+    module, config, int_to_vocab = load_exported(path)
+    if config["model"] != "generator":
+        raise ValueError(f"{path} is not an export of the generator")
+    return TextGenerator(
+        module, int_to_vocab, length, top_k, cache, lstm_size=config["lstm_size"]
+    )
+
+
+def reply_agreement(
+    first: BatchDecoder,
+    second: BatchDecoder,
+    sentences: List[str],
+    batch_size: int = 64,
+) -> float:
+    """Share of the sentences with equal greedy replies of two decoders."""
+
+    if not sentences:
+        return float("nan")
+    equal = 0
+    for start in range(0, len(sentences), batch_size):
+        batch = sentences[start : start + batch_size]
+        equal += sum(a == b for a, b in zip(first.decode(batch), second.decode(batch)))
+    return equal / len(sentences)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    models = parser.add_subparsers(dest="model", required=True)
+
+    chatbot = models.add_parser("chatbot", help="seq2seq chatbot")
+    chatbot.add_argument("checkpoint", help="checkpoint of the notebook")
+    chatbot.add_argument("output", help="path of the artifact")
+    chatbot.add_argument("--hidden-size", type=int, default=500)
+    chatbot.add_argument("--encoder-layers", type=int, default=2)
+    chatbot.add_argument("--decoder-layers", type=int, default=2)
+    chatbot.add_argument("--attn", default="dot", choices=["dot", "general", "concat"])
+    chatbot.add_argument("--pairs", help="corpus of normalized pairs to evaluate on")
+    chatbot.add_argument("--max-pairs", type=int, default=10000)
+
+    generator = models.add_parser("generator", help="LSTM text generator")
+    generator.add_argument("checkpoint", help="state dict of the model")
+    generator.add_argument("output", help="path of the artifact")
+    generator.add_argument("--vocab", required=True, help="folder of TokenDataset")
+    generator.add_argument("--embedding-size", type=int, default=64)
+    generator.add_argument("--lstm-size", type=int, default=64)
+    generator.add_argument("--max-batches", type=int, default=100)
+    for subparser in [chatbot, generator]:
+        subparser.add_argument(
+            "--float", action="store_true", help="keep float32 weights"
+        )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    quantized = not args.float
+    if args.model == "chatbot":
+        encoder, decoder, voc = load_checkpoint(
+            args.checkpoint,
+            args.hidden_size,
+            args.encoder_layers,
+            args.decoder_layers,
+            args.attn,
+        )
+        export_chatbot(encoder, decoder, voc, args.output, quantized)
+        if args.pairs:
+            corpus = Corpus(args.pairs)
+            pairs = [corpus[i] for i in range(min(len(corpus), args.max_pairs))]
+            eager = BatchDecoder(encoder, decoder, voc)
+            exported = load_batch_decoder(args.output)
+            print(f"perplexity, eager:    {eager.perplexity(pairs):.3f}")
+            print(f"perplexity, exported: {exported.perplexity(pairs):.3f}")
+            questions = [question for question, _ in pairs]
+            agreement = reply_agreement(eager, exported, questions)
+            print(f"equal greedy replies: {agreement:.1%}")
+    else:
+        int_to_vocab = TokenDataset.load_vocab(args.vocab)
+        net = RNNModule(len(int_to_vocab), 0, args.embedding_size, args.lstm_size)
+        net.load_state_dict(torch.load(args.checkpoint, map_location="cpu"))
+        export_generator(net, int_to_vocab, args.output, quantized)
+
+        dataset = TokenDataset(args.vocab, batch_size=16, seq_size=32)
+        for name, generator in [
+            ("eager", TextGenerator(net, int_to_vocab)),
+            ("exported", load_text_generator(args.output)),
+        ]:
+            batches = islice(dataset.get_batches(), args.max_batches)
+            print(f"perplexity, {name + ':':<9} {generator.perplexity(batches):.3f}")
+
+    size = os.path.getsize(args.output) / 2**20
+    kind = "int8" if quantized else "float32"
+    print(f"saved {kind} model to {args.output}, {size:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
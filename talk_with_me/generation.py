@@ -0,0 +1,231 @@
+"""
+LSTM text generator and batched sampling of texts from it.
+
+`RNNModule` is the model of `models/GenerationLSTM.ipynb`, so its
+checkpoints load as they are. `TextGenerator` does what `predict` of the
+notebook does, but for many prompts at once and returns the texts.
+With a `StateCache` it continues conversations: the LSTM state after
+the previous turns is restored, so only the words of a new turn are fed.
+"""
+import math
+from typing import Hashable, Iterable, List, Optional, Tuple
+import numpy as np
+import torch
+from torch import nn
+from .state_cache import StateCache
+
+State = Tuple[torch.Tensor, torch.Tensor]
+
+
+class RNNModule(nn.Module):
+    """
+    One-layer LSTM over word embeddings predicting the next word.
+
+    Parameters
+    ----------
+    n_vocab : int
+        Number of words in the vocabulary.
+    seq_size : int
+        Number of words in a training window.
+    embedding_size : int
+        Size of the embeddings.
+    lstm_size : int
+        Size of the hidden state.
+    """
+
+    def __init__(
+        self, n_vocab: int, seq_size: int, embedding_size: int, lstm_size: int
+    ):
+        super().__init__()
+        self.seq_size = seq_size
+        self.lstm_size = lstm_size
+        self.embedding = nn.Embedding(n_vocab, embedding_size)
+        self.lstm = nn.LSTM(embedding_size, lstm_size, batch_first=True)
+        self.dense = nn.Linear(lstm_size, n_vocab)
+
+    def forward(self, x: torch.Tensor, prev_state: State) -> Tuple[torch.Tensor, State]:
+        embed = self.embedding(x)
+        output, state = self.lstm(embed, prev_state)
+        logits = self.dense(output)
+        return logits, state
+
+    def feed(
+        self, x: torch.Tensor, lengths: torch.Tensor, prev_state: State
+    ) -> Tuple[torch.Tensor, State]:
+        """
+        Logits of the word after the last one of every padded row of `x`
+        and the state after it, the rows are run as one packed batch.
+        """
+
+        packed = nn.utils.rnn.pack_padded_sequence(
+            self.embedding(x), lengths, batch_first=True, enforce_sorted=False
+        )
+        output, state = self.lstm(packed, prev_state)
+        output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True)
+        # Output at the last word, by `gather` so it stays dynamic when traced:
+        last = (lengths - 1).view(-1, 1, 1).expand(-1, 1, output.size(2))
+        logits = self.dense(output.gather(1, last).squeeze(1))
+        return logits, state
+
+    def zero_state(self, batch_size: int) -> State:
+        return (
+            torch.zeros(1, batch_size, self.lstm_size),
+            torch.zeros(1, batch_size, self.lstm_size),
+        )
+
+
+class TextGenerator:
+    """
+    Continuation of prompts by sampling every next word uniformly from
+    the `top_k` most probable ones, as `predict` of the notebook does.
+
+    Parameters
+    ----------
+    net : RNNModule
+        Trained model, switched to the eval mode, or its export, see
+        `export.export_generator`.
+    int_to_vocab : list of str
+        Words by their indexes, for example `vocab.json` of `TokenDataset`.
+    length : int (default=50)
+        Number of words to generate.
+    top_k : int (default=5)
+        Number of the most probable words to choose from.
+    cache : StateCache or None (default=None)
+        States of conversations, see `generate`.
+    lstm_size : int or None (default=None)
+        Size of the hidden state, `net.lstm_size` if None. An exported
+        model has no attributes, so it has to be given.
+    """
+
+    def __init__(
+        self,
+        net: RNNModule,
+        int_to_vocab: List[str],
+        length: int = 50,
+        top_k: int = 5,
+        cache: Optional[StateCache] = None,
+        lstm_size: Optional[int] = None,
+    ):
+        self.net = net.eval()
+        self.int_to_vocab = int_to_vocab
+        self.vocab_to_int = {word: i for i, word in enumerate(int_to_vocab)}
+        self.length = length
+        self.top_k = top_k
+        self.cache = cache
+        self.lstm_size = net.lstm_size if lstm_size is None else lstm_size
+
+    def _encode(self, prompts: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Padded indexes of the known words of the prompts and their lengths.
+        A prompt without known words starts from the most frequent word.
+        """
+
+        encoded = [
+            [self.vocab_to_int[w] for w in prompt.split() if w in self.vocab_to_int]
+            or [0]
+            for prompt in prompts
+        ]
+        lengths = torch.tensor([len(indexes) for indexes in encoded])
+        padded = nn.utils.rnn.pad_sequence(
+            [torch.tensor(indexes) for indexes in encoded], batch_first=True
+        )
+        return padded, lengths
+
+    def _zero_state(self, batch_size: int) -> State:
+        return (
+            torch.zeros(1, batch_size, self.lstm_size),
+            torch.zeros(1, batch_size, self.lstm_size),
+        )
+
+    def _restore(
+        self, conversations: Optional[List[Hashable]], batch_size: int
+    ) -> Tuple[State, List[int]]:
+        """
+        Initial state of every row, the cached one of its conversation or
+        zeros, and the number of tokens it has consumed.
+        """
+
+        state_h, state_c = self._zero_state(batch_size)
+        history = [0] * batch_size
+        if self.cache is None or conversations is None:
+            return (state_h, state_c), history
+        for i, conversation in enumerate(conversations):
+            entry = self.cache.get(conversation)
+            if entry is not None:
+                (state_h[:, i], state_c[:, i]), history[i] = entry
+        return (state_h, state_c), history
+
+    def perplexity(self, batches: Iterable[Tuple[np.ndarray, np.ndarray]]) -> float:
+        """
+        Perplexity of the next words of windows of words, for example
+        `TokenDataset.get_batches`, every window starts from zero state.
+        """
+
+        total_nll, total_words = 0.0, 0
+        with torch.no_grad():
+            for x, y in batches:
+                x = torch.as_tensor(np.asarray(x), dtype=torch.long)
+                y = torch.as_tensor(np.asarray(y), dtype=torch.long)
+                logits, _ = self.net(x, self._zero_state(x.size(0)))
+                total_nll += nn.functional.cross_entropy(
+                    logits.reshape(-1, logits.size(-1)), y.reshape(-1), reduction="sum"
+                ).item()
+                total_words += y.numel()
+        return math.exp(total_nll / total_words) if total_words else float("nan")
+
+    def generate(
+        self,
+        prompts: List[str],
+        generator: Optional[torch.Generator] = None,
+        conversations: Optional[List[Hashable]] = None,
+    ) -> List[str]:
+        """
+        Prompts followed by the generated words.
+
+        All prompts are run through the LSTM in one packed batch, then every
+        step samples the next word of all of them at once.
+
+        Parameters
+        ----------
+        prompts : list of str
+            Beginnings of the texts.
+        generator : torch.Generator or None (default=None)
+            Random generator of sampling.
+        conversations : list or None (default=None)
+            Id of the conversation of every prompt. With `self.cache`, a prompt
+            continues the prompts and generated words of the previous turns of
+            its conversation, and the state after this turn replaces them.
+            Turns of one conversation in the same batch do not see each other.
+        """
+
+        if not prompts:
+            return []
+        batch_size = len(prompts)
+        with torch.no_grad():
+            x, lengths = self._encode(prompts)
+            state, history = self._restore(conversations, batch_size)
+            logits, state = self.net.feed(x, lengths, state)
+
+            tokens = torch.empty((batch_size, self.length), dtype=torch.long)
+            for step in range(self.length):
+                _, top_ix = torch.topk(logits, k=self.top_k, dim=1)
+                choice = top_ix.gather(
+                    1, torch.randint(self.top_k, (batch_size, 1), generator=generator)
+                )
+                tokens[:, step] = choice.squeeze(1)
+                logits, state = self.net(choice, state)
+                logits = logits[:, -1]
+
+        if self.cache is not None and conversations is not None:
+            state_h, state_c = state
+            for i, conversation in enumerate(conversations):
+                # Copies, so the entry does not keep the whole batch in memory:
+                self.cache.set(
+                    conversation,
+                    (state_h[:, i].clone(), state_c[:, i].clone()),
+                    history[i] + int(lengths[i]) + self.length,
+                )
+        return [
+            " ".join([prompt] + [self.int_to_vocab[i] for i in row])
+            for prompt, row in zip(prompts, tokens.tolist())
+        ]
@@ -0,0 +1,213 @@
+"""
+Backends for extracting messages from the html files of a VK archive.
+
+Every backend takes the path to a `messagesN.html` file and returns the full
+text of every `<div class="message">` (header included) stripped and in the
+order of the file, exactly as `BeautifulSoup(...).find_all(...).text` does.
+
+All files of an archive have the same encoding, so it can be detected once
+with `detect_encoding` and passed to the backends, which then do not look
+for it in every file. Files can also be read through `mmap` or passed
+as `content` already read, for example by `reader.prefetch`.
+
+With `records=True` the backends return `(id, author_id, text)` of every
+message instead of the text only, see `records.MessageRecord`.
+"""
+import codecs
+import io
+import mmap
+import os
+import re
+from contextlib import contextmanager
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+from .records import OWNER_ID, UNKNOWN_ID
+
+if TYPE_CHECKING:
+    from lxml import etree
+
+# The meta tag with the charset is at the beginning of a file:
+HEAD_SIZE = 4096
+_CHARSET_REGEX = re.compile(rb"""<meta[^>]*charset=["']?([\w-]+)""", re.IGNORECASE)
+
+# Whitespace-only strings are collapsed by BeautifulSoup to one character:
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+_DELETE_SPACES = str.maketrans("", "", ASCII_SPACES)
+
+# Links to users are `https://vk.com/id1`, to communities `https://vk.com/club1`:
+_AUTHOR_REGEX = re.compile(r"vk\.com/(id|club|public|event)(\d+)$")
+
+
+def author_id(href: Optional[str]) -> int:
+    """Id of the author by the link in the header of a message, see `records`."""
+
+    if href is None:
+        return OWNER_ID
+    match = _AUTHOR_REGEX.search(href)
+    if match is None:
+        return UNKNOWN_ID
+    kind, number = match.groups()
+    return int(number) if kind == "id" else -int(number)
+
+
+def message_id(data_id: Optional[str]) -> int:
+    return int(data_id) if data_id and data_id.isdigit() else 0
+
+
+def detect_encoding(path: str) -> Optional[str]:
+    """
+    Normalized name of the encoding declared in the meta tag of the html file,
+    None if there is no tag or the encoding is unknown.
+    """
+
+    with open(path, "rb") as f:
+        match = _CHARSET_REGEX.search(f.read(HEAD_SIZE))
+    if match is None:
+        return None
+    try:
+        return codecs.lookup(match.group(1).decode("ascii")).name
+    except LookupError:
+        return None
+
+
+def first_html_file(messages_path: str, folders: List[str]) -> Optional[str]:
+    """Path to the first html file of the chat `folders`, None if there is none."""
+
+    for folder in folders:
+        parent_folder = os.path.join(messages_path, folder)
+        for file in sorted(os.listdir(parent_folder)):
+            if file.endswith(".html"):
+                return os.path.join(parent_folder, file)
+    return None
+
+
+@contextmanager
+def _open(
+    path: str, use_mmap: bool, content: Optional[bytes] = None
+) -> Iterator[BinaryIO]:
+    """
+    The file opened for reading bytes, memory-mapped if `use_mmap`,
+    or its `content` if it is already read.
+    """
+
+    if content is not None:
+        yield io.BytesIO(content)
+        return
+
+    with open(path, "rb") as f:
+        if not use_mmap or not os.fstat(f.fileno()).st_size:
+            yield f
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+
+def parse_bs4(
+    path: str,
+    encoding: Optional[str] = None,
+    use_mmap: bool = False,
+    content: Optional[bytes] = None,
+    records: bool = False,
+) -> list:
+    """
+    Builds a full BeautifulSoup tree for the file. With a known `encoding`
+    the file is decoded at once instead of being sniffed by BeautifulSoup.
+    """
+
+    from bs4 import BeautifulSoup
+
+    with _open(path, use_mmap, content) as f:
+        if encoding is None:
+            soup = BeautifulSoup(f, "lxml")
+        else:
+            # `str` decodes the buffer of the mmap without copying it to bytes:
+            buffer = f if isinstance(f, mmap.mmap) else f.read()
+            soup = BeautifulSoup(str(buffer, encoding), "lxml")
+    messages = soup.find_all("div", {"class": "message"})
+    if not records:
+        return [message.text.strip() for message in messages]
+
+    result: List[Tuple[int, int, str]] = []
+    for message in messages:
+        header = message.find("div", {"class": "message__header"})
+        link = header and header.find("a")
+        result.append(
+            (
+                message_id(message.get("data-id")),
+                author_id(link.get("href") if link else None),
+                message.text.strip(),
+            )
+        )
+    return result
+
+
+def _element_text(element: "etree._Element") -> str:
+    """Text of the element as `BeautifulSoup.text` would return it."""
+
+    text = []
+    for string in element.itertext():
+        if not string.translate(_DELETE_SPACES):
+            string = "\n" if "\n" in string else " "
+        text.append(string)
+    return "".join(text)
+
+
+def parse_lxml(
+    path: str,
+    encoding: Optional[str] = None,
+    use_mmap: bool = False,
+    content: Optional[bytes] = None,
+    records: bool = False,
+) -> list:
+    """
+    Streams the file through lxml, keeping in memory only the message which
+    is being parsed right now.
+    """
+
+    from lxml import etree
+
+    # lxml fails on empty documents:
+    if not (os.path.getsize(path) if content is None else len(content)):
+        return []
+
+    messages = []
+    opened = []  # indexes of the messages being parsed, for the nested ones
+    with _open(path, use_mmap, content) as f:
+        for event, element in etree.iterparse(
+            f, events=("start", "end"), tag="div", html=True, encoding=encoding
+        ):
+            if "message" not in element.get("class", "").split():
+                continue
+
+            if event == "start":
+                # Reserve the place to keep the order of nested messages:
+                opened.append(len(messages))
+                messages.append(None)
+            else:
+                text = _element_text(element).strip()
+                if records:
+                    # The header is the first child of the message:
+                    link = element[0].find("a") if len(element) else None
+                    text = (
+                        message_id(element.get("data-id")),
+                        author_id(None if link is None else link.get("href")),
+                        text,
+                    )
+                messages[opened.pop()] = text
+                if not opened:
+                    element.clear()
+    return messages
+
+
+PARSERS: Dict[str, Callable[..., list]] = {
+    "bs4": parse_bs4,
+    "lxml": parse_lxml,
+}
@@ -0,0 +1,207 @@
+"""
+Rules of the languages of VK archives.
+
+The language of the interface of VK at the moment of the export defines
+the labels of attachments, service suffixes and the format of dates in
+the html files, while the letters of messages depend on the language of
+the users. Every `Locale` keeps both and the language of an archive is
+detected from the breadcrumb header of its first html file.
+"""
+import calendar
+import re
+from datetime import datetime
+from typing import Dict, List, Optional
+from .html_parser import HEAD_SIZE, detect_encoding
+
+
+class Locale:
+    """
+    Rules of one language of VK archives.
+
+    Parameters
+    ----------
+    name : str
+        Code of the language.
+    breadcrumb : str
+        Title of the messages section in the header of html files.
+    link : str
+        Label of links, messages with links to reposts are skipped.
+    audio : str
+        Label of audio records.
+    blacklist : list of str
+        Labels of attachments, see `MessageCleaner`.
+    message_ends : list of str
+        Service suffixes, see `MessageCleaner`.
+    letters : str
+        Letters of the alphabet besides the latin one, in the syntax of
+        regex character classes. People write in any language whatever
+        the interface is, so messages keep the letters of all locales,
+        see `NON_LETTER_REGEX`.
+    months : list of str
+        Short names of months in the headers of messages.
+    at : str
+        Word between the date and the time in the headers of messages.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        breadcrumb: str,
+        link: str,
+        audio: str,
+        blacklist: List[str],
+        message_ends: List[str],
+        letters: str,
+        months: List[str],
+        at: str,
+    ):
+        self.name = name
+        self.breadcrumb = breadcrumb
+        self.link = link
+        self.audio = audio
+        self.blacklist = blacklist
+        self.message_ends = message_ends
+        self.letters = letters
+        self.months = months
+        self.at = at
+
+        self.date_regex = re.compile(
+            rf"(\d{{1,2}}) ({'|'.join(months)}) (\d{{4}}) {at} "
+            rf"(\d{{1,2}}):(\d{{2}}):(\d{{2}})"
+        )
+        self._month_numbers = {month: i + 1 for i, month in enumerate(months)}
+
+    def parse_date(self, header: str) -> Optional[datetime]:
+        """Date of a message from its header, None if there is no date."""
+
+        match = self.date_regex.search(header)
+        if match is None:
+            return None
+        day, month, year, hour, minute, second = match.groups()
+        return datetime(
+            int(year),
+            self._month_numbers[month],
+            int(day),
+            int(hour),
+            int(minute),
+            int(second),
+        )
+
+    def parse_timestamp(self, header: str) -> int:
+        """
+        Date of a message in seconds since the epoch, taken as UTC,
+        0 if there is no date.
+        """
+
+        date = self.parse_date(header)
+        return 0 if date is None else calendar.timegm(date.timetuple())
+
+
+LOCALES: Dict[str, Locale] = {
+    locale.name: locale
+    for locale in [
+        Locale(
+            name="ru",
+            breadcrumb="Сообщения",
+            link="Ссылка",
+            audio="Аудиозапись",
+            blacklist=[
+                "Фотография",
+                "Документ",
+                "Видеозапись",
+                "Аудиозапись",
+                "Видео",
+                "История",
+                "Запись на стене",
+                "Подарок",
+                "Ссылка",
+            ],
+            message_ends=[
+                "прикреплённое сообщение",
+                "прикреплённых сообщений",
+                "прикреплённых сообщения",
+                "Запись на стене",
+                "Сообщение удалено",
+                "Карта",
+                "Стикер",
+            ],
+            letters="а-яА-ЯёЁ",
+            months="янв фев мар апр мая июн июл авг сен окт ноя дек".split(),
+            at="в",
+        ),
+        Locale(
+            name="uk",
+            breadcrumb="Повідомлення",
+            link="Посилання",
+            audio="Аудіозапис",
+            blacklist=[
+                "Фотографія",
+                "Документ",
+                "Відеозапис",
+                "Аудіозапис",
+                "Відео",
+                "Історія",
+                "Запис на стіні",
+                "Подарунок",
+                "Посилання",
+            ],
+            message_ends=[
+                "прикріплене повідомлення",
+                "прикріплених повідомлень",
+                "прикріплені повідомлення",
+                "Запис на стіні",
+                "Повідомлення видалено",
+                "Карта",
+                "Стікер",
+            ],
+            letters="а-щА-ЩьЬюЮяЯєЄіІїЇґҐ'ʼ",
+            months="січ лют бер кві тра чер лип сер вер жов лис гру".split(),
+            at="о",
+        ),
+        Locale(
+            name="en",
+            breadcrumb="Messages",
+            link="Link",
+            audio="Audio",
+            blacklist=[
+                "Photo",
+                "Document",
+                "Video",
+                "Audio",
+                "Story",
+                "Wall post",
+                "Gift",
+                "Link",
+            ],
+            message_ends=[
+                "attached message",
+                "attached messages",
+                "Wall post",
+                "Message deleted",
+                "Map",
+                "Sticker",
+            ],
+            letters="",
+            months="Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split(),
+            at="at",
+        ),
+    ]
+}
+DEFAULT_LOCALE = "ru"
+
+# Everything but the letters of all locales and the end of sentence marks:
+NON_LETTER_REGEX = re.compile(
+    f"[^{''.join(locale.letters for locale in LOCALES.values())}a-zA-Z.!?]+"
+)
+
+
+def detect_file_locale(path: str) -> Optional[str]:
+    """Language of the html file by its breadcrumb header, None if unknown."""
+
+    with open(path, "rb") as f:
+        head = f.read(HEAD_SIZE)
+    text = head.decode(detect_encoding(path) or "utf-8", "ignore")
+    for locale in LOCALES.values():
+        if f">{locale.breadcrumb}<" in text:
+            return locale.name
+    return None
@@ -0,0 +1,84 @@
+"""
+Timers and counters of the stages of preparing the data.
+"""
+import json
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Iterator, Optional
+
+
+class Profiler:
+    """
+    Total time and number of calls of every stage and counters of events,
+    such as parsed files or dropped messages.
+
+    Parameters
+    ----------
+    rules : bool (default=False)
+        Time every rule of `MessageCleaner` separately. It makes the cleaning
+        noticeably slower, so it is off by default.
+    """
+
+    def __init__(self, rules: bool = False):
+        self.rules = rules
+        self.times: defaultdict = defaultdict(float)
+        self.calls: Counter = Counter()
+        self.counters: Counter = Counter()
+
+    def add_time(self, stage: str, seconds: float, calls: int = 1) -> None:
+        self.times[stage] += seconds
+        self.calls[stage] += calls
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def merge(self, stats: dict) -> None:
+        """Add the stats of another profiler, see `to_dict`."""
+
+        for stage, value in stats["stages"].items():
+            self.add_time(stage, value["seconds"], value["calls"])
+        self.counters.update(stats["counters"])
+
+    def to_dict(self) -> dict:
+        return {
+            "stages": {
+                stage: {"seconds": self.times[stage], "calls": self.calls[stage]}
+                for stage in self.times
+            },
+            "counters": dict(self.counters),
+        }
+
+    def report(self) -> str:
+        """Table of the stages, the slowest first, followed by the counters."""
+
+        lines = [f"{'stage':<24}{'seconds':>10}{'calls':>12}{'us/call':>10}"]
+        for stage in sorted(self.times, key=self.times.get, reverse=True):
+            seconds, calls = self.times[stage], self.calls[stage]
+            lines.append(
+                f"{stage:<24}{seconds:>10.3f}{calls:>12,}"
+                f"{seconds / max(calls, 1) * 1e6:>10.1f}"
+            )
+        lines.append("")
+        lines.extend(
+            f"{name:<24}{value:>22,}" for name, value in sorted(self.counters.items())
+        )
+        return "\n".join(lines)
+
+    def dump(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def timer(profiler: Optional[Profiler], stage: str) -> ContextManager:
+    """Timer of the stage, which does nothing if `profiler` is None."""
+
+    return nullcontext() if profiler is None else profiler.timer(stage)
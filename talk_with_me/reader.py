@@ -0,0 +1,50 @@
+"""
+Reading of html files ahead of their parsing.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Tuple
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def prefetch(
+    paths: Iterable[str], workers: int = 4, max_pending: Optional[int] = None
+) -> Iterator[Tuple[str, bytes]]:
+    """
+    Read files in a pool of threads while the consumer parses the previous
+    ones, so that reads from slow storage overlap with the parsing.
+
+    Reading releases the GIL, so threads are enough. Only `max_pending`
+    files are read ahead, which bounds the memory.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Files to read.
+    workers : int (default=4)
+        Number of reading threads.
+    max_pending : int or None (default=None)
+        Max number of files read ahead, `2 * workers` if None.
+
+    Yields
+    ------
+    tuple of str and bytes
+        Path and content of every file, in the order of `paths`.
+    """
+
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque(
+            (path, executor.submit(read_file, path))
+            for path in islice(paths, max_pending or 2 * workers)
+        )
+        while pending:
+            path, future = pending.popleft()
+            for next_path in islice(paths, 1):
+                pending.append((next_path, executor.submit(read_file, next_path)))
+            yield path, future.result()
@@ -0,0 +1,131 @@
+"""
+Structured records of messages and their columnar form.
+
+Besides the text, every `<div class="message">` of an archive has the id
+of the message in `data-id`, the link to the author in the header (your own
+messages have no link) and the date after the name of the author.
+"""
+from typing import TYPE_CHECKING, Dict, Iterable, List
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Author of your own messages:
+OWNER_ID = 0
+# Author whose link is not a link to a user or a community:
+UNKNOWN_ID = -(1 << 63)
+
+
+class MessageRecord:
+    """
+    One message of a chat.
+
+    Parameters
+    ----------
+    id : int
+        Id of the message from `data-id`, 0 if there is none.
+    author_id : int
+        Id of the author: positive for users, negative for communities,
+        `OWNER_ID` for your own messages and `UNKNOWN_ID` if the link
+        is not recognized.
+    timestamp : int
+        Date of the message in seconds since the epoch, taken as UTC as the
+        archive does not keep the timezone. 0 if the date is not recognized.
+    text : str
+        Cleared text of the message.
+    """
+
+    __slots__ = ("id", "author_id", "timestamp", "text")
+
+    def __init__(self, id: int, author_id: int, timestamp: int, text: str):
+        self.id = id
+        self.author_id = author_id
+        self.timestamp = timestamp
+        self.text = text
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, MessageRecord):
+            return NotImplemented
+        return (self.id, self.author_id, self.timestamp, self.text) == (
+            other.id,
+            other.author_id,
+            other.timestamp,
+            other.text,
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"MessageRecord(id={self.id}, author_id={self.author_id}, "
+            f"timestamp={self.timestamp}, text={self.text!r})"
+        )
+
+    # `__slots__` classes without `__dict__` are pickled by their state:
+    def __getstate__(self) -> tuple:
+        return self.id, self.author_id, self.timestamp, self.text
+
+    def __setstate__(self, state: tuple) -> None:
+        self.id, self.author_id, self.timestamp, self.text = state
+
+
+def session_bounds(timestamps: "np.ndarray", gap: float) -> "np.ndarray":
+    """
+    Bounds of sessions of a chat split where the time between two messages
+    is longer than `gap` seconds. Unknown (zero) timestamps take the time
+    of the last known one, so they never split, but do not hide a gap
+    between the known timestamps around them either.
+
+    Returns
+    -------
+    np.ndarray
+        Indexes of the first message of every session followed by the number
+        of messages, so session `i` is `[bounds[i], bounds[i + 1])`.
+    """
+
+    import numpy as np
+
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    # Forward fill the unknown timestamps, the leading ones stay zero:
+    last_known = np.maximum.accumulate(
+        np.where(timestamps > 0, np.arange(len(timestamps)), 0)
+    )
+    filled = timestamps[last_known]
+    splits = np.flatnonzero((np.diff(filled) > gap) & (filled[:-1] > 0))
+    return np.concatenate(([0], splits + 1, [len(timestamps)]))
+
+
+def to_columns(records: Iterable[MessageRecord]) -> Dict[str, "np.ndarray"]:
+    """
+    Columns of the records for vectorized filtering.
+
+    Returns
+    -------
+    dict of str to np.ndarray
+        `id`, `author_id` and `timestamp` as int64 arrays and `text`
+        as an object array, all of the same length.
+    """
+
+    import numpy as np
+
+    records = list(records)
+    columns = {
+        name: np.fromiter(
+            (getattr(record, name) for record in records),
+            dtype=np.int64,
+            count=len(records),
+        )
+        for name in ["id", "author_id", "timestamp"]
+    }
+    columns["text"] = np.empty(len(records), dtype=object)
+    columns["text"][:] = [record.text for record in records]
+    return columns
+
+
+def from_columns(columns: Dict[str, "np.ndarray"]) -> List[MessageRecord]:
+    """Records from the columns of `to_columns`, for example after filtering."""
+
+    return [
+        MessageRecord(int(id), int(author_id), int(timestamp), text)
+        for id, author_id, timestamp, text in zip(
+            columns["id"], columns["author_id"], columns["timestamp"], columns["text"]
+        )
+    ]
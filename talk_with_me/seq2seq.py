@@ -0,0 +1,280 @@
+"""
+Encoder and attention decoder of the seq2seq chatbot.
+
+The models are the ones of `Data4Chatbot.ipynb` with the same parameters,
+so the `en`, `de` and `embedding` state dicts of its checkpoints load
+as they are. Two things are added for decoding batches of messages:
+the encoder takes inputs in any order of lengths, and the attention can
+ignore the padding of shorter inputs with a mask.
+"""
+from typing import Optional, Tuple
+import torch
+import torch.nn.functional as F
+from torch import nn
+from .vocabulary import Voc
+
+
+class EncoderRNN(nn.Module):
+    """
+    Bidirectional GRU over the embeddings of the input words.
+
+    Parameters
+    ----------
+    hidden_size : int
+        Size of the embeddings and of the hidden state.
+    embedding : nn.Embedding
+        Embeddings of words, shared with the decoder.
+    n_layers : int (default=1)
+        Number of layers of the GRU.
+    dropout : float (default=0)
+        Dropout between the layers, used only if there are several.
+    """
+
+    def __init__(
+        self,
+        hidden_size: int,
+        embedding: nn.Embedding,
+        n_layers: int = 1,
+        dropout: float = 0,
+    ):
+        super().__init__()
+        self.n_layers = n_layers
+        self.hidden_size = hidden_size
+        self.embedding = embedding
+        self.gru = nn.GRU(
+            hidden_size,
+            hidden_size,
+            n_layers,
+            dropout=(0 if n_layers == 1 else dropout),
+            bidirectional=True,
+        )
+
+    def forward(
+        self,
+        input_seq: torch.Tensor,
+        input_lengths: torch.Tensor,
+        hidden: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Parameters
+        ----------
+        input_seq : torch.Tensor
+            Time-major padded indexes of words, `(max length, batch size)`.
+        input_lengths : torch.Tensor
+            Number of words of every input, in any order.
+        hidden : torch.Tensor or None (default=None)
+            Initial hidden state, zeros if None.
+
+        Returns
+        -------
+        torch.Tensor
+            Sum of the outputs of both directions, `(max length, batch size,
+            hidden size)`, zeros at the padding.
+        torch.Tensor
+            Final hidden state of every layer and direction.
+        """
+
+        embedded = self.embedding(input_seq)
+        if hidden is None:
+            # Quantized GRU makes the zeros of the batch size seen by the trace:
+            hidden = embedded.new_zeros(
+                2 * self.n_layers, input_seq.size(1), self.hidden_size
+            )
+        packed = nn.utils.rnn.pack_padded_sequence(
+            embedded, input_lengths.cpu(), enforce_sorted=False
+        )
+        outputs, hidden = self.gru(packed, hidden)
+        outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs)
+        # Sum bidirectional GRU outputs:
+        outputs = outputs[:, :, : self.hidden_size] + outputs[:, :, self.hidden_size :]
+        return outputs, hidden
+
+
+class Attn(nn.Module):
+    """
+    Luong attention over the outputs of the encoder.
+
+    Parameters
+    ----------
+    method : str
+        Score function: `dot`, `general` or `concat`.
+    hidden_size : int
+        Size of the hidden state.
+    """
+
+    def __init__(self, method: str, hidden_size: int):
+        super().__init__()
+        self.method = method
+        if self.method not in ["dot", "general", "concat"]:
+            raise ValueError(self.method, "is not an appropriate attention method.")
+        self.hidden_size = hidden_size
+        if self.method == "general":
+            self.attn = nn.Linear(self.hidden_size, hidden_size)
+        elif self.method == "concat":
+            self.attn = nn.Linear(self.hidden_size * 2, hidden_size)
+            self.v = nn.Parameter(torch.FloatTensor(hidden_size))
+
+    def dot_score(
+        self, hidden: torch.Tensor, encoder_output: torch.Tensor
+    ) -> torch.Tensor:
+        return torch.sum(hidden * encoder_output, dim=2)
+
+    def general_score(
+        self, hidden: torch.Tensor, encoder_output: torch.Tensor
+    ) -> torch.Tensor:
+        energy = self.attn(encoder_output)
+        return torch.sum(hidden * energy, dim=2)
+
+    def concat_score(
+        self, hidden: torch.Tensor, encoder_output: torch.Tensor
+    ) -> torch.Tensor:
+        energy = self.attn(
+            torch.cat(
+                (hidden.expand(encoder_output.size(0), -1, -1), encoder_output), 2
+            )
+        ).tanh()
+        return torch.sum(self.v * energy, dim=2)
+
+    def forward(
+        self,
+        hidden: torch.Tensor,
+        encoder_outputs: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Attention weights of shape `(batch size, 1, max length)`. Positions
+        where the boolean `(max length, batch size)` mask is False get none.
+        """
+
+        if self.method == "general":
+            attn_energies = self.general_score(hidden, encoder_outputs)
+        elif self.method == "concat":
+            attn_energies = self.concat_score(hidden, encoder_outputs)
+        else:
+            attn_energies = self.dot_score(hidden, encoder_outputs)
+        if mask is not None:
+            attn_energies = attn_energies.masked_fill(~mask, float("-inf"))
+
+        # Transpose max_length and batch_size dimensions:
+        attn_energies = attn_energies.t()
+        return F.softmax(attn_energies, dim=1).unsqueeze(1)
+
+
+class LuongAttnDecoderRNN(nn.Module):
+    """
+    GRU decoder with Luong attention, run one word at a time.
+
+    Parameters
+    ----------
+    attn_model : str
+        Score function of `Attn`.
+    embedding : nn.Embedding
+        Embeddings of words, shared with the encoder.
+    hidden_size : int
+        Size of the embeddings and of the hidden state.
+    output_size : int
+        Number of words in the vocabulary.
+    n_layers : int (default=1)
+        Number of layers of the GRU.
+    dropout : float (default=0.1)
+        Dropout of the embeddings and between the layers.
+    """
+
+    def __init__(
+        self,
+        attn_model: str,
+        embedding: nn.Embedding,
+        hidden_size: int,
+        output_size: int,
+        n_layers: int = 1,
+        dropout: float = 0.1,
+    ):
+        super().__init__()
+        self.attn_model = attn_model
+        self.hidden_size = hidden_size
+        self.output_size = output_size
+        self.n_layers = n_layers
+        self.dropout = dropout
+
+        self.embedding = embedding
+        self.embedding_dropout = nn.Dropout(dropout)
+        self.gru = nn.GRU(
+            hidden_size,
+            hidden_size,
+            n_layers,
+            dropout=(0 if n_layers == 1 else dropout),
+        )
+        self.concat = nn.Linear(hidden_size * 2, hidden_size)
+        self.out = nn.Linear(hidden_size, output_size)
+        self.attn = Attn(attn_model, hidden_size)
+
+    def forward(
+        self,
+        input_step: torch.Tensor,
+        last_hidden: torch.Tensor,
+        encoder_outputs: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Parameters
+        ----------
+        input_step : torch.Tensor
+            Previous word of every sequence, `(1, batch size)`.
+        last_hidden : torch.Tensor
+            Hidden state of the previous step.
+        encoder_outputs : torch.Tensor
+            Outputs of `EncoderRNN`.
+        mask : torch.Tensor or None (default=None)
+            Boolean `(max length, batch size)` mask of the words of the inputs,
+            see `Attn`. Without it the padding of shorter inputs is attended too.
+
+        Returns
+        -------
+        torch.Tensor
+            Probabilities of the next word, `(batch size, output size)`.
+        torch.Tensor
+            Hidden state of this step.
+        """
+
+        embedded = self.embedding(input_step)
+        embedded = self.embedding_dropout(embedded)
+        rnn_output, hidden = self.gru(embedded, last_hidden)
+        attn_weights = self.attn(rnn_output, encoder_outputs, mask)
+        # Weighted sum of the encoder outputs:
+        context = attn_weights.bmm(encoder_outputs.transpose(0, 1))
+        # Concatenate weighted context vector and GRU output using Luong eq. 5:
+        rnn_output = rnn_output.squeeze(0)
+        context = context.squeeze(1)
+        concat_input = torch.cat((rnn_output, context), 1)
+        concat_output = torch.tanh(self.concat(concat_input))
+        # Predict next word using Luong eq. 6:
+        output = self.out(concat_output)
+        output = F.softmax(output, dim=1)
+        return output, hidden
+
+
+def load_checkpoint(
+    path: str,
+    hidden_size: int = 500,
+    encoder_n_layers: int = 2,
+    decoder_n_layers: int = 2,
+    attn_model: str = "dot",
+) -> Tuple[EncoderRNN, LuongAttnDecoderRNN, Voc]:
+    """
+    Models and vocabulary from a checkpoint of `Data4Chatbot.ipynb`,
+    the sizes of the models are the ones of the notebook by default.
+    """
+
+    checkpoint = torch.load(path, map_location="cpu")
+    voc = Voc("checkpoint")
+    voc.__dict__ = checkpoint["voc_dict"]
+
+    embedding = nn.Embedding(voc.num_words, hidden_size)
+    embedding.load_state_dict(checkpoint["embedding"])
+    encoder = EncoderRNN(hidden_size, embedding, encoder_n_layers)
+    decoder = LuongAttnDecoderRNN(
+        attn_model, embedding, hidden_size, voc.num_words, decoder_n_layers
+    )
+    encoder.load_state_dict(checkpoint["en"])
+    decoder.load_state_dict(checkpoint["de"])
+    return encoder.eval(), decoder.eval(), voc
@@ -0,0 +1,483 @@
+"""
+Local HTTP service of the trained models.
+
+The model is loaded once, and concurrent requests are grouped into
+micro-batches. A batch is sent to the model when it has `max_batch_size`
+requests or when its first request has waited `max_wait` seconds.
+
+Usage:
+    python -m talk_with_me.serve chatbot checkpoint.tar --port 8000
+    python -m talk_with_me.serve generator model-1000.pth --vocab ./dataset
+    python -m talk_with_me.serve generator generator.pt --exported
+
+    curl -d '{"message": "привет"}' localhost:8000/reply
+    curl -d '{"message": "привет", "conversation": "42"}' localhost:8000/reply
+    curl localhost:8000/metrics
+
+Endpoints:
+    POST /reply    `{"message": str, "conversation": str}` -> `{"reply": str}`,
+                   the conversation is optional, the generator continues
+                   the previous turns of it from the cached LSTM state;
+    GET  /metrics  number of requests and batches, throughput and
+                   p50/p99 latency of the recent requests, and the hit
+                   rate of the cache of conversations;
+    GET  /health   `{"status": "ok"}`.
+"""
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, List, Optional, Tuple
+from .state_cache import StateCache
+
+# Takes the messages of a batch and their conversations (None if not given)
+# and returns the replies in the same order:
+Handler = Callable[[List[str], List[Optional[str]]], List[str]]
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of sorted values, None if there are none."""
+
+    if not values:
+        return None
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)]
+
+
+class Metrics:
+    """
+    Counters of requests and batches and latencies of the last `window`
+    requests.
+
+    Parameters
+    ----------
+    window : int (default=10000)
+        Number of recent requests for the latency percentiles and throughput.
+    """
+
+    def __init__(self, window: int = 10000):
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        # Finish time and latency of the recent requests:
+        self.recent: Deque[Tuple[float, float]] = deque(maxlen=window)
+
+    def add_batch(self, latencies: List[float], failed: bool = False) -> None:
+        now = time.perf_counter()
+        self.batches += 1
+        self.requests += len(latencies)
+        if failed:
+            self.errors += len(latencies)
+        self.recent.extend((now, latency) for latency in latencies)
+
+    def snapshot(self) -> dict:
+        latencies = sorted(latency for _, latency in self.recent)
+        elapsed = time.perf_counter() - (
+            self.recent[0][0] if len(self.recent) > 1 else self.start
+        )
+
+        def ms(value: Optional[float]) -> Optional[float]:
+            return None if value is None else value * 1000
+
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "throughput_rps": len(self.recent) / elapsed if elapsed > 0 else 0.0,
+            "latency_ms": {
+                "p50": ms(percentile(latencies, 50)),
+                "p99": ms(percentile(latencies, 99)),
+            },
+        }
+
+
+class MicroBatcher:
+    """
+    Queue of requests served in batches by `handler` in a worker thread,
+    so the event loop keeps accepting requests while the model runs.
+
+    Parameters
+    ----------
+    handler : callable
+        Function of lists of messages and of their conversations returning
+        the list of replies.
+    max_batch_size : int (default=32)
+        Max number of requests in a batch.
+    max_wait : float (default=0.005)
+        Max seconds the first request of a batch waits for others.
+    """
+
+    def __init__(
+        self, handler: Handler, max_batch_size: int = 32, max_wait: float = 0.005
+    ):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = Metrics()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, message: str, conversation: Optional[str] = None) -> str:
+        """Reply to the message, computed in a batch with the concurrent ones."""
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((message, conversation, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> list:
+        """Requests of the next batch, waiting for the first one."""
+
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            messages = [message for message, _, _, _ in batch]
+            conversations = [conversation for _, conversation, _, _ in batch]
+            try:
+                replies = await loop.run_in_executor(
+                    self._executor, self.handler, messages, conversations
+                )
+                if len(replies) != len(messages):
+                    raise RuntimeError("The handler returned a wrong number of replies")
+            except Exception as e:  # the server keeps serving the next batches
+                replies, error = None, e
+            else:
+                error = None
+
+            now = time.perf_counter()
+            self.metrics.add_batch(
+                [now - start for _, _, _, start in batch], error is not None
+            )
+            for i, (_, _, future, _) in enumerate(batch):
+                if future.done():  # the client has gone
+                    continue
+                if error is None:
+                    future.set_result(replies[i])
+                else:
+                    future.set_exception(error)
+
+
+class InferenceServer:
+    """
+    Minimal HTTP/1.1 server of `MicroBatcher`, one request per connection.
+
+    Parameters
+    ----------
+    batcher : MicroBatcher
+        Batcher of the model.
+    host : str (default="127.0.0.1")
+        Address to listen on.
+    port : int (default=8000)
+        Port to listen on, 0 for any free one, see `self.port` after `start`.
+    cache : StateCache or None (default=None)
+        Cache of conversations of the model, its stats are in the metrics.
+    """
+
+    def __init__(
+        self,
+        batcher: MicroBatcher,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        cache: Optional[StateCache] = None,
+    ):
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+        self.cache = cache
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        await self.batcher.start()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.batcher.stop()
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        print(f"Serving on http://{self.host}:{self.port}", file=sys.stderr)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[int, Any]:
+        if path == "/reply":
+            if method != "POST":
+                return 405, {"error": "use POST"}
+            try:
+                request = json.loads(body.decode("utf-8"))
+                message = request["message"]
+                conversation = request.get("conversation")
+            except (ValueError, KeyError, TypeError, AttributeError):
+                return 400, {"error": 'expected json {"message": str}'}
+            if not isinstance(message, str):
+                return 400, {"error": "message must be a string"}
+            if conversation is not None and not isinstance(conversation, str):
+                return 400, {"error": "conversation must be a string"}
+            try:
+                reply = await self.batcher.submit(message, conversation)
+            except Exception as e:
+                return 500, {"error": repr(e)}
+            return 200, {"reply": reply}
+        if path == "/metrics":
+            metrics = self.batcher.metrics.snapshot()
+            if self.cache is not None:
+                metrics["cache"] = self.cache.stats()
+            return 200, metrics
+        if path == "/health":
+            return 200, {"status": "ok"}
+        return 404, {"error": f"unknown path: {path}"}
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, payload = await self._route(method, path, body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, payload = 400, {"error": "malformed request"}
+
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + data
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def load_chatbot(
+    checkpoint: str,
+    config: str = "./data_params.json",
+    hidden_size: int = 500,
+    encoder_n_layers: int = 2,
+    decoder_n_layers: int = 2,
+    attn_model: str = "dot",
+    exported: bool = False,
+    **decode_kwargs,
+) -> Handler:
+    """
+    Replies of the seq2seq chatbot from a checkpoint of `Data4Chatbot.ipynb`,
+    the sizes of the models are the ones of the notebook by default, or from
+    an artifact of `export.py` if `exported`. Messages are normalized as the
+    training pairs, see `BatchDecoder.decode` for `decode_kwargs`.
+    """
+
+    from .data4ml import Data4Chatbot
+    from .decoding import BatchDecoder
+
+    if exported:
+        from .export import load_batch_decoder
+
+        batch_decoder = load_batch_decoder(checkpoint)
+    else:
+        from .seq2seq import load_checkpoint
+
+        batch_decoder = BatchDecoder(
+            *load_checkpoint(
+                checkpoint,
+                hidden_size,
+                encoder_n_layers,
+                decoder_n_layers,
+                attn_model,
+            )
+        )
+    normalize = Data4Chatbot(path_to_config=config).normalize_message
+    # Replies depend only on the message, as in the notebook:
+    return lambda messages, conversations: batch_decoder.reply(
+        [normalize(message) for message in messages], **decode_kwargs
+    )
+
+
+def load_generator(
+    checkpoint: str,
+    vocab: Optional[str] = None,
+    embedding_size: int = 64,
+    lstm_size: int = 64,
+    length: int = 50,
+    top_k: int = 5,
+    cache: Optional[StateCache] = None,
+    exported: bool = False,
+) -> Handler:
+    """
+    Continuations of messages by the LSTM of `GenerationLSTM.ipynb` from its
+    `model-N.pth` state dict and the folder of `TokenDataset` with its
+    vocabulary, the sizes of the model are the ones of the notebook.
+    If `exported`, the checkpoint is an artifact of `export.py` that has
+    the vocabulary and the sizes. With `cache` the messages of
+    a conversation continue each other.
+    """
+
+    if exported:
+        from .export import load_text_generator
+
+        generator = load_text_generator(checkpoint, length, top_k, cache)
+    else:
+        import torch
+        from .generation import RNNModule, TextGenerator
+        from .text_dataset import TokenDataset
+
+        if vocab is None:
+            raise ValueError("The vocabulary is needed for a state dict")
+        int_to_vocab = TokenDataset.load_vocab(vocab)
+        net = RNNModule(len(int_to_vocab), 0, embedding_size, lstm_size)
+        net.load_state_dict(torch.load(checkpoint, map_location="cpu"))
+        generator = TextGenerator(net, int_to_vocab, length, top_k, cache)
+    return lambda messages, conversations: generator.generate(
+        messages, conversations=conversations
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument(
+        "--max-batch-size", type=int, default=32, help="max requests in a batch"
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=5,
+        help="max milliseconds a request waits for a batch",
+    )
+    models = parser.add_subparsers(dest="model", required=True)
+
+    chatbot = models.add_parser("chatbot", help="seq2seq chatbot")
+    chatbot.add_argument("checkpoint", help="checkpoint of the notebook")
+    chatbot.add_argument("--config", default="./data_params.json", help="json config")
+    chatbot.add_argument("--hidden-size", type=int, default=500)
+    chatbot.add_argument("--encoder-layers", type=int, default=2)
+    chatbot.add_argument("--decoder-layers", type=int, default=2)
+    chatbot.add_argument("--attn", default="dot", choices=["dot", "general", "concat"])
+    chatbot.add_argument(
+        "--method", default="greedy", choices=["greedy", "sample", "beam"]
+    )
+    chatbot.add_argument("--beam-size", type=int, default=5)
+    chatbot.add_argument("--top-k", type=int, default=10)
+
+    generator = models.add_parser("generator", help="LSTM text generator")
+    generator.add_argument("checkpoint", help="state dict of the model")
+    generator.add_argument("--vocab", help="folder of TokenDataset")
+    generator.add_argument("--embedding-size", type=int, default=64)
+    generator.add_argument("--lstm-size", type=int, default=64)
+    generator.add_argument("--length", type=int, default=50, help="words to generate")
+    generator.add_argument("--top-k", type=int, default=5)
+    for subparser in [chatbot, generator]:
+        subparser.add_argument(
+            "--exported",
+            action="store_true",
+            help="the checkpoint is an artifact of export.py",
+        )
+    generator.add_argument(
+        "--cache-size",
+        type=int,
+        default=10000,
+        help="max conversations in the cache of LSTM states, 0 to disable",
+    )
+    generator.add_argument(
+        "--cache-mb", type=float, help="max memory of the cache in megabytes"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    cache = None
+    if args.model == "chatbot":
+        handler = load_chatbot(
+            args.checkpoint,
+            args.config,
+            args.hidden_size,
+            args.encoder_layers,
+            args.decoder_layers,
+            args.attn,
+            exported=args.exported,
+            method=args.method,
+            beam_size=args.beam_size,
+            top_k=args.top_k,
+        )
+    else:
+        if args.cache_size > 0:
+            max_bytes = None if args.cache_mb is None else int(args.cache_mb * 2**20)
+            cache = StateCache(args.cache_size, max_bytes)
+        handler = load_generator(
+            args.checkpoint,
+            args.vocab,
+            args.embedding_size,
+            args.lstm_size,
+            args.length,
+            args.top_k,
+            cache,
+            args.exported,
+        )
+
+    batcher = MicroBatcher(handler, args.max_batch_size, args.max_wait_ms / 1000)
+    server = InferenceServer(batcher, args.host, args.port, cache)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
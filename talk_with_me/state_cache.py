@@ -0,0 +1,108 @@
+"""
+In-memory LRU cache of the states of models between the turns of conversations.
+
+A recurrent model that continues a conversation only needs its state after
+the previous turns, so a new turn feeds just its own words instead of the
+whole history. The states are kept per conversation id, and the least
+recently used conversations are evicted when the cache exceeds its limits.
+"""
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+def state_nbytes(state: Any) -> int:
+    """Memory of the arrays or tensors of a state, nested in tuples or lists."""
+
+    if isinstance(state, (tuple, list)):
+        return sum(state_nbytes(item) for item in state)
+    if hasattr(state, "element_size"):  # torch.Tensor
+        return state.element_size() * state.nelement()
+    return getattr(state, "nbytes", 0)  # np.ndarray, other values are not counted
+
+
+class StateCache:
+    """
+    States of conversations with least recently used eviction.
+
+    Every entry also keeps the number of tokens its state has consumed,
+    so the cache reports how many tokens were not fed again.
+
+    Parameters
+    ----------
+    max_entries : int (default=1024)
+        Max number of conversations.
+    max_bytes : int or None (default=None)
+        Max memory of the states in bytes, see `state_nbytes`, no limit if None.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_tokens = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[Tuple[Any, int]]:
+        """State of the conversation and its number of tokens or None."""
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.saved_tokens += entry[1]
+        return entry[0], entry[1]
+
+    def set(self, key: Hashable, state: Any, tokens: int) -> None:
+        """
+        Stores the state of the conversation after `tokens` tokens. A state
+        larger than `max_bytes` alone is not stored.
+        """
+
+        self.pop(key)
+        nbytes = state_nbytes(state)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        self._entries[key] = (state, tokens, nbytes)
+        self.nbytes += nbytes
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self.nbytes > self.max_bytes
+        ):
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= evicted
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        """Forgets the conversation, for example when it is over."""
+
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        turns = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "evictions": self.evictions,
+            "saved_tokens": self.saved_tokens,
+            "saved_tokens_per_turn": self.saved_tokens / turns if turns else 0.0,
+        }
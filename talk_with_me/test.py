@@ -1,6 +1,36 @@
+import asyncio
+import itertools
+import os
+import pickle
 import unittest
-from data4ml import Data4TextGeneration, Data4Chatbot
-from perfect_regex import (
+from collections import Counter
+from .data4ml import Data4TextGeneration, Data4Chatbot
+from .cache import FileCache
+from .cleaner import MessageCleaner
+from .corpus import Corpus, save_chats, save_pairs
+from .vocabulary import Voc, EOS_token
+from .batching import BucketBatcher
+from .text_dataset import TokenDataset
+from .html_parser import PARSERS, author_id, detect_encoding
+from .profiler import Profiler
+from .reader import prefetch
+from .records import (
+    MessageRecord,
+    OWNER_ID,
+    UNKNOWN_ID,
+    from_columns,
+    session_bounds,
+    to_columns,
+)
+from .cli import main, output_paths
+from .serve import InferenceServer, MicroBatcher, percentile
+from .state_cache import StateCache, state_nbytes
+from .dedup import Deduplicator, HashIndex
+from .config import DEFAULT_CONFIG, FolderFilter, validate_config
+from .locales import LOCALES, detect_file_locale
+from datetime import datetime, timezone
+import json
+from .perfect_regex import (
     perfect_url_regex,
     perfect_emoji_regex,
     perfect_email_regex,
@@ -8,6 +38,13 @@ from perfect_regex import (
 )
 import tempfile
 from pathlib import Path
+from typing import Iterator
+import numpy as np
+
+try:
+    import torch
+except ImportError:  # the chatbot models are optional
+    torch = None
 
 
 class TestData4ML(unittest.TestCase):
@@ -255,8 +292,54 @@ class TestData4Chatbot(unittest.TestCase):
 
         self.assertEqual(self.data4bot.clear_messages(to_check), answer)
 
+    def test_merge_by_author_id(self):
+        header = '<div class="message__header"><a href="https://vk.com/id{}">{}</a>'
+        messages = [(2, "Иван Иванов", "пока"), (1, "Иван Иванов", "привет")]
+        html = "".join(
+            f'<div class="message" data-id="{i}">{header.format(id, name)}'
+            f", 1 янв 2020 в 10:00:0{i}</div>\n<div>{text}</div></div>"
+            for i, (id, name, text) in enumerate(messages)
+        )
+        with tempfile.TemporaryDirectory() as dirpath:
+            Path(dirpath, "1000001").mkdir()
+            Path(dirpath, "1000001", "messages0.html").write_text(
+                f'<html><head><meta charset="utf-8"></head><body>{html}</body></html>',
+                encoding="utf-8",
+            )
+            data = Data4Chatbot(home_folder=dirpath)
+            self.assertEqual(data.make_data(limit=1), [["привет", "пока"]])
+
+            # The legacy path knows only the names, which are the same:
+            messages = data.parse_html(
+                str(Path(dirpath, "1000001")), ["messages0.html"]
+            )
+            self.assertEqual(data.clear_messages(messages), ["привет \n пока"])
+
     def test_make_data(self):
-        pass
+        pairs = self.data4bot.make_data(limit=1)
+        self.assertEqual(len(pairs), 17)
+        self.assertEqual(pairs[-1], ["она попросила", "хорошо"])
+
+        # Test the process pool gives the same result in the same order:
+        data4bot = Data4Chatbot(n_jobs=2)
+        data4bot.home_folder = self.data4bot.home_folder
+        self.assertEqual(data4bot.make_data(limit=1), pairs)
+
+    def test_iter_pairs(self):
+        pairs = self.data4bot.iter_pairs(limit=1)
+        self.assertIsInstance(pairs, Iterator)
+        self.assertEqual(list(pairs), self.data4bot.make_data(limit=1))
+
+        chats = list(self.data4bot.iter_messages(limit=1))
+        self.assertEqual(len(chats), 2)
+        self.assertEqual(
+            chats[1],
+            self.data4bot.clear_messages(
+                self.data4bot.parse_html(
+                    "talk_with_me/data4test/153164714", ["messages0.html"]
+                )
+            ),
+        )
 
     def test_check_max_length(self):
         self.assertTrue(self.data4bot._check_max_length(["* " * 5, "* " * 5]))
@@ -298,6 +381,29 @@ class TestData4Chatbot(unittest.TestCase):
         self.data4bot.max_length = 1
         self.assertEqual(self.data4bot.get_pairs(to_check), ans3)
 
+        self.assertEqual(self.data4bot.get_pairs(["1"]), [])
+        self.assertEqual(self.data4bot.get_pairs([]), [])
+
+    def test_length_constraints(self):
+        messages = ["1", "2 2", "3 3", "4 4 4 4", "5 5 5"]
+        np.testing.assert_array_equal(
+            self.data4bot.count_words(messages), [1, 2, 2, 4, 3]
+        )
+
+        data = Data4Chatbot(max_length=5, min_length=2)
+        self.assertEqual(
+            data.get_pairs(messages),
+            [["2 2", "3 3"], ["3 3", "4 4 4 4"], ["4 4 4 4", "5 5 5"]],
+        )
+        data = Data4Chatbot(max_length=5, max_ratio=1.5)
+        self.assertEqual(
+            data.get_pairs(messages), [["2 2", "3 3"], ["4 4 4 4", "5 5 5"]]
+        )
+        self.assertEqual(
+            data.filter_pairs([["1", "1"], ["1", "2 2"], ["3 3 3", "2 2"]]),
+            [["1", "1"], ["3 3 3", "2 2"]],
+        )
+
     def test_normalize_message(self):
 
         # ru:
@@ -483,6 +589,1214 @@ class TestData4TextGeneration(unittest.TestCase):
         clear_messages = self.data4gen.make_data(limit=3)
         self.assertEqual(clear_messages, [])
 
+        # Test lazy preparation:
+        chats = self.data4gen.iter_messages(limit=1)
+        self.assertIsInstance(chats, Iterator)
+        self.assertEqual(list(chats), answer)
+
+        # Test the process pool gives the same result in the same order:
+        for chunksize in [None, 1]:
+            data4gen = Data4TextGeneration(n_jobs=2, chunksize=chunksize)
+            data4gen.home_folder = self.data4gen.home_folder
+            self.assertEqual(data4gen.make_data(limit=1), answer)
+
+
+class TestMessageCleaner(unittest.TestCase):
+    def test_clear(self):
+        cleaner = MessageCleaner(["Фотография"], ["Стикер"])
+        self.assertEqual(cleaner.clear("Ок\nСтикер"), "Ок")
+        self.assertEqual(cleaner.clear("Ок\nФотография\nhttps://vk.com/1.jpg"), "Ок")
+        self.assertEqual(cleaner.clear("Ок\nДокумент"), "Ок\nДокумент")
+
+        # Without any rules only the common garbage is deleted:
+        cleaner = MessageCleaner([], [])
+        self.assertEqual(cleaner.clear("Ок\nФотография"), "Ок\nФотография")
+        self.assertEqual(cleaner.clear(" Ок https://vk.com  "), "Ок")
+
+        # Labels of English archives are ordinary words within a line:
+        en = LOCALES["en"]
+        cleaner = MessageCleaner(en.blacklist, en.message_ends, en.link, en.audio)
+        self.assertEqual(cleaner.clear("I love Audio books"), "I love Audio books")
+        self.assertEqual(cleaner.clear("Check the Map"), "Check the Map")
+        self.assertEqual(cleaner.clear("Hi\nCheck the Map"), "Hi\nCheck the Map")
+        self.assertEqual(cleaner.clear("Hi\nMap"), "Hi")
+        self.assertEqual(cleaner.clear("Hi\n2 attached messages"), "Hi")
+        self.assertEqual(cleaner.clear("Hi\nAudio\n\nAudio"), "Hi")
+
+    def test_clear_profiled(self):
+        cleaner = Data4Chatbot().cleaner
+        profiler = Profiler(rules=True)
+        messages = [
+            "Ок\nСтикер",
+            "Ок\nФотография\nhttps://vk.com/1.jpg",
+            "Всё👌 yanko.julia@yandex.ru 8(800)555-35-35 https://vk.com",
+            "Весело\nАудиозапись",
+            "Репост\nСсылка\nhttps://vk.com",
+        ]
+        for message in messages:
+            self.assertEqual(
+                cleaner.clear_profiled(message, profiler), cleaner.clear(message)
+            )
+        self.assertEqual(profiler.calls["rule:links"], len(messages))
+        self.assertEqual(profiler.calls["rule:spaces"], len(messages) - 1)
+
+    def test_drop_reason(self):
+        cleaner = MessageCleaner(["Фотография"], ["Стикер"])
+        self.assertEqual(cleaner.drop_reason("\nСсылка\nhttps://vk.com"), "link")
+        self.assertEqual(
+            cleaner.drop_reason("https://vk.com/wall1#comments"), "comments"
+        )
+        self.assertEqual(
+            cleaner.drop_reason("\nФотография\nhttps://a.jpg"), "attachment"
+        )
+        self.assertEqual(cleaner.drop_reason("\nСтикер"), "attachment")
+        self.assertEqual(cleaner.drop_reason("👌"), "empty")
+
+
+class TestProfiler(unittest.TestCase):
+    def test_merge(self):
+        profiler, other = Profiler(), Profiler()
+        profiler.add_time("parse_html", 1.0)
+        profiler.count("files_parsed")
+        other.add_time("parse_html", 0.5, calls=2)
+        other.add_time("clear_message", 0.25)
+        other.count("files_parsed", 3)
+
+        profiler.merge(other.to_dict())
+        self.assertEqual(
+            profiler.to_dict(),
+            {
+                "stages": {
+                    "parse_html": {"seconds": 1.5, "calls": 3},
+                    "clear_message": {"seconds": 0.25, "calls": 1},
+                },
+                "counters": {"files_parsed": 4},
+            },
+        )
+        self.assertTrue(profiler.report().splitlines()[1].startswith("parse_html"))
+
+    def test_make_data(self):
+        # Disabled by default:
+        self.assertIsNone(Data4Chatbot().profiler)
+
+        plain = Data4Chatbot()
+        plain.home_folder = "./talk_with_me/data4test"
+        answer = plain.make_data(limit=1)
+
+        for n_jobs in [1, 2]:
+            data = Data4Chatbot(profile=True, n_jobs=n_jobs)
+            data.home_folder = "./talk_with_me/data4test"
+            pairs = data.make_data(limit=1)
+            stats = data.profiler.to_dict()
+            counters = stats["counters"]
+            self.assertEqual(counters["files_parsed"], 3)
+            self.assertEqual(
+                counters["messages_in"],
+                counters["messages_out"]
+                + sum(v for k, v in counters.items() if k.startswith("dropped_"))
+                - counters.get("dropped_pairs", 0),
+            )
+            self.assertEqual(stats["stages"]["parse_html"]["calls"], 3)
+            self.assertEqual(pairs, answer)
+            self.assertNotIn("rule:emoji", stats["stages"])
+
+        data = Data4TextGeneration(profile_rules=True)
+        data.home_folder = "./talk_with_me/data4test"
+        data.make_data(limit=1)
+        self.assertIn("rule:emoji", data.profiler.to_dict()["stages"])
+
+
+class TestHtmlParser(unittest.TestCase):
+    def test_parsers(self):
+        for path in Path("./talk_with_me/data4test").glob("*/*.html"):
+            messages = PARSERS["bs4"](str(path))
+            self.assertTrue(messages)
+            for name, parse_file in PARSERS.items():
+                self.assertEqual(parse_file(str(path)), messages, name)
+
+        # Whitespaces, entities, comments and nested messages:
+        with tempfile.TemporaryDirectory() as dirpath:
+            path = Path(dirpath, "messages0.html")
+            path.write_text(
+                "<html><body><div class='message'>  a &amp; <b>b</b>\t<i> </i>"
+                "<!-- c -->\n\n d<div class='message x'>e</div>\n</div>"
+                "<div class='message__header'>f</div></body></html>"
+            )
+            for name, parse_file in PARSERS.items():
+                self.assertEqual(parse_file(str(path)), ["a & b  \n\n de", "e"], name)
+
+    def test_encoding(self):
+        paths = list(Path("./talk_with_me/data4test").glob("*/*.html"))
+        with tempfile.TemporaryDirectory() as dirpath:
+            # Empty files and files in other encodings:
+            Path(dirpath, "empty.html").write_bytes(b"")
+            for encoding in ["utf-8", "cp1251"]:
+                path = Path(dirpath, f"{encoding}.html")
+                path.write_bytes(
+                    f'<html><head><meta charset="{encoding}"></head><body>'
+                    "<div class='message'>Привет&#128076;</div></body></html>".encode(
+                        encoding
+                    )
+                )
+            self.assertIsNone(detect_encoding(str(Path(dirpath, "empty.html"))))
+            self.assertEqual(detect_encoding(str(paths[0])), "cp1251")
+
+            for path in paths + list(Path(dirpath).glob("*.html")):
+                encoding = detect_encoding(str(path))
+                for name, parse_file in PARSERS.items():
+                    messages = parse_file(str(path))
+                    for use_mmap in [False, True]:
+                        self.assertEqual(
+                            parse_file(str(path), encoding, use_mmap), messages, name
+                        )
+
+    def test_wrong_parser(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            path = Path(dirpath, "data_params.json")
+            path.write_text('{"html_parser": "wrong"}')
+            self.assertRaises(ValueError, Data4TextGeneration, path_to_config=str(path))
+
+
+class TestConfig(unittest.TestCase):
+    def test_validate_config(self):
+        self.assertEqual(validate_config({}), DEFAULT_CONFIG)
+        cfg = validate_config({"test": "OK", "folders": {"min_length": 3}})
+        self.assertEqual(cfg["test"], "OK")
+        self.assertEqual(cfg["folders"]["min_length"], 3)
+        self.assertEqual(cfg["folders"]["skip_lengths"], [10])
+
+        for wrong in [
+            [],
+            {"html_parser": "wrong"},
+            {"encoding": "wrong"},
+            {"mmap": "yes"},
+            {"home_folder": 1},
+            {"blacklist": "Фотография"},
+            {"message_ends": [""]},
+            {"folders": {"min_len": 7}},
+            {"folders": {"min_length": -1}},
+            {"folders": {"min_length": True}},
+            {"folders": {"skip_lengths": ["10"]}},
+            {"folders": {"skip_prefixes": [""]}},
+        ]:
+            self.assertRaises(ValueError, validate_config, wrong)
+
+    def test_folder_filter(self):
+        folder_filter = FolderFilter(**DEFAULT_CONFIG["folders"])
+        self.assertTrue(folder_filter.accepts("153164713"))
+        self.assertFalse(folder_filter.accepts("-153164713"))
+        self.assertFalse(folder_filter.accepts("123456"))
+        self.assertFalse(folder_filter.accepts("2000000001"))
+        self.assertTrue(FolderFilter([], 0, []).accepts("-1"))
+
+    def test_rules_from_config(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            path = Path(dirpath, "data_params.json")
+            path.write_text(
+                '{"home_folder": "./talk_with_me/data4test", "blacklist": ["Photo+"],'
+                ' "message_ends": ["Sticker"], "folders": {"skip_lengths": [9]}}',
+                encoding="utf-8",
+            )
+            data = Data4TextGeneration(path_to_config=str(path))
+            self.assertEqual(data.get_list_of_folders(data.home_folder), [])
+            self.assertEqual(data._clear_message("Ok\nPhoto+\nhttps://a.jpg"), "Ok")
+            self.assertEqual(
+                data._clear_message("Ok\nPhoto\nhttps://a.jpg"), "Ok\nPhoto"
+            )
+            self.assertEqual(data._clear_message("Ok\nSticker"), "Ok")
+            self.assertEqual(data._clear_message("Ok\nФотография"), "Ok\nФотография")
+
+
+def write_archive_file(path: Path, breadcrumb: str, messages: list) -> None:
+    """
+    Write a html file of a VK archive with `(header, text)` messages,
+    the newest ones first as in the archive.
+    """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    items = "".join(
+        f'<div class="item"><div class="message">\n<div class="message__header">'
+        f"{header}</div>\n<div>{text}</div>\n</div></div>"
+        for header, text in reversed(messages)
+    )
+    path.write_text(
+        '<html><head><meta charset="utf-8"></head><body><div class="ui_crumb">'
+        f"{breadcrumb}</div>{items}</body></html>",
+        encoding="utf-8",
+    )
+
+
+class TestLocales(unittest.TestCase):
+    def test_detect_locale(self):
+        path = "./talk_with_me/data4test/153164714/messages0.html"
+        self.assertEqual(detect_file_locale(path), "ru")
+        with tempfile.TemporaryDirectory() as dirpath:
+            for name, locale in LOCALES.items():
+                path = Path(dirpath, f"{name}.html")
+                write_archive_file(path, locale.breadcrumb, [])
+                self.assertEqual(detect_file_locale(str(path)), name)
+            path = Path(dirpath, "unknown.html")
+            write_archive_file(path, "Nachrichten", [])
+            self.assertIsNone(detect_file_locale(str(path)))
+
+    def test_parse_date(self):
+        date = datetime(2016, 3, 23, 20, 48, 28)
+        self.assertEqual(
+            LOCALES["ru"].parse_date("Юлия Николаева, 23 мар 2016 в 20:48:28"), date
+        )
+        self.assertEqual(LOCALES["en"].parse_date("You, 23 Mar 2016 at 20:48:28"), date)
+        self.assertEqual(LOCALES["uk"].parse_date("Ви, 23 бер 2016 о 20:48:28"), date)
+        self.assertIsNone(LOCALES["en"].parse_date("You"))
+        self.assertEqual(
+            LOCALES["en"].parse_timestamp("You, 23 Mar 2016 at 20:48:28"),
+            int(date.replace(tzinfo=timezone.utc).timestamp()),
+        )
+        self.assertEqual(LOCALES["en"].parse_timestamp("You"), 0)
+
+    def test_archives(self):
+        def user(name: str) -> str:
+            return f'<a href="https://vk.com/id1">{name}</a>'
+
+        messages = {
+            "en": [
+                (f"{user('Alice')}, 1 Mar 2016 at 10:00:00", "Hi, Bob! Привет"),
+                ("You, 1 Mar 2016 at 10:01:00", "Look\nPhoto\nhttps://a.jpg"),
+                (f"{user('Alice')}, 1 Mar 2016 at 10:02:00", "Nice\nSticker"),
+            ],
+            "uk": [
+                (f"{user('Олена')}, 1 бер 2016 о 10:00:00", "Привіт, як справи? Їжак"),
+                ("Ви, 1 бер 2016 о 10:01:00", "Дивись\nФотографія\nhttps://a.jpg"),
+                (f"{user('Олена')}, 1 бер 2016 о 10:02:00", "Гарно\nСтікер"),
+                ("Ви, 1 бер 2016 о 10:03:00", "мы это съели, ёлка"),
+            ],
+        }
+        # The letters do not depend on the language of the interface:
+        answers = {
+            "en": ["hi bob ! привет", "look", "nice"],
+            "uk": ["привіт як справи ? їжак", "дивись", "гарно", "мы это съели ёлка"],
+        }
+        with tempfile.TemporaryDirectory() as dirpath:
+            data = Data4Chatbot()
+            for name, locale_messages in messages.items():
+                archive = Path(dirpath, name)
+                path = Path(archive, "153164713", "messages0.html")
+                write_archive_file(path, LOCALES[name].breadcrumb, locale_messages)
+
+                # One instance adapts to every archive:
+                data.home_folder = str(archive)
+                chats = list(data.iter_messages(limit=1))
+                self.assertEqual(data.locale.name, name)
+                self.assertEqual(chats, [answers[name]])
+
+
+class TestFileCache(unittest.TestCase):
+    def test_get_set(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            path = Path(dirpath, "messages0.html")
+            path.write_text("old")
+            cache = FileCache(str(Path(dirpath, "cache")), "rules")
+
+            key = cache.key(str(path))
+            self.assertIsNone(cache.get(key))
+            cache.set(key, ["Привет"], str(path))
+            self.assertEqual(cache.get(key), ["Привет"])
+            self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "hit_rate": 0.5})
+
+            # Changed rules:
+            other_cache = FileCache(str(Path(dirpath, "cache")), "other rules")
+            self.assertNotEqual(other_cache.key(str(path)), key)
+
+            # Changed file:
+            path.write_text("new file")
+            self.assertNotEqual(cache.key(str(path)), key)
+
+            # Content hashing ignores the modification time:
+            cache = FileCache(str(Path(dirpath, "cache")), "rules", hash_content=True)
+            key = cache.key(str(path))
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(cache.key(str(path)), key)
+
+    def test_clear_prune(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            cache = FileCache(str(Path(dirpath, "cache")), "rules")
+            keys = []
+            for i in range(4):
+                path = Path(dirpath, f"messages{i}.html")
+                path.write_text(str(i))
+                keys.append(cache.key(str(path)))
+                cache.set(keys[-1], ["Привет"] * 10, str(path))
+                os.utime(cache._entry_path(keys[-1]), ns=(i * 10**9, i * 10**9))
+
+            # Entries of deleted files:
+            Path(dirpath, "messages3.html").unlink()
+            self.assertEqual(cache.prune(), 1)
+            self.assertIsNone(cache.get(keys[3]))
+
+            # The oldest entries above the size:
+            cache.max_size = 2 * os.path.getsize(cache._entry_path(keys[0]))
+            self.assertEqual(cache.prune(), 1)
+            self.assertEqual(
+                [cache.get(key) is not None for key in keys[:3]], [False, True, True]
+            )
+
+            cache.clear()
+            self.assertEqual([cache.get(key) for key in keys], [None] * 4)
+            self.assertEqual(cache.prune(), 0)
+
+    def test_make_data(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            for data_class in [Data4TextGeneration, Data4Chatbot]:
+                for n_jobs in [1, 2]:
+                    cache_dir = str(Path(dirpath, data_class.__name__, str(n_jobs)))
+                    data = data_class(n_jobs=n_jobs)
+                    data.home_folder = "./talk_with_me/data4test"
+                    answer = data.make_data(limit=1)
+
+                    data = data_class(n_jobs=n_jobs, cache_dir=cache_dir)
+                    data.home_folder = "./talk_with_me/data4test"
+                    self.assertEqual(data.make_data(limit=1), answer)
+                    self.assertEqual(data.cache.stats()["misses"], 3)
+                    self.assertEqual(data.make_data(limit=1), answer)
+                    self.assertEqual(data.cache.stats()["hits"], 3)
+
+                    # Changed rules invalidate the cache:
+                    data = data_class(n_jobs=n_jobs, cache_dir=cache_dir)
+                    data.blacklist = data.blacklist[1:]
+                    data.cache.fingerprint = data._fingerprint()
+                    data.home_folder = "./talk_with_me/data4test"
+                    data.make_data(limit=1)
+                    self.assertEqual(data.cache.hit_rate, 0.0)
+
+            # Entries of deleted files are pruned after a pass:
+            cache_dir = str(Path(dirpath, "pruned"))
+            data = Data4Chatbot(cache_dir=cache_dir, cache_max_size=10**6)
+            data.home_folder = "./talk_with_me/data4test"
+            stale = FileCache(cache_dir, "rules")
+            path = Path(dirpath, "messages0.html")
+            path.write_text("deleted")
+            stale.set(stale.key(str(path)), [], str(path))
+            path.unlink()
+            data.make_data(limit=1)
+            self.assertEqual(len(list(data.cache._entries())), 3)
+
+
+class TestReader(unittest.TestCase):
+    def test_prefetch(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            paths = []
+            for i in range(10):
+                paths.append(str(Path(dirpath, f"messages{i}.html")))
+                Path(paths[-1]).write_bytes(bytes([i]) * i)
+
+            for workers, max_pending in [(1, None), (3, 1), (4, 20)]:
+                self.assertEqual(
+                    list(prefetch(iter(paths), workers, max_pending)),
+                    [(path, bytes([i]) * i) for i, path in enumerate(paths)],
+                )
+            self.assertEqual(list(prefetch([])), [])
+
+    def test_make_data(self):
+        for data_class in [Data4TextGeneration, Data4Chatbot]:
+            for html_parser in PARSERS:
+                data = data_class()
+                data.html_parser = html_parser
+                data.home_folder = "./talk_with_me/data4test"
+                answer = data.make_data(limit=1)
+
+                data = data_class(prefetch=2)
+                data.html_parser = html_parser
+                data.home_folder = "./talk_with_me/data4test"
+                self.assertEqual(data.make_data(limit=1), answer)
+
+
+class TestRecords(unittest.TestCase):
+    def test_author_id(self):
+        self.assertEqual(author_id("https://vk.com/id119596593"), 119596593)
+        self.assertEqual(author_id("https://vk.com/club42"), -42)
+        self.assertEqual(author_id("https://vk.com/durov"), UNKNOWN_ID)
+        self.assertEqual(author_id(None), OWNER_ID)
+
+    def test_parsers(self):
+        path = "./talk_with_me/data4test/153164713/messages0.html"
+        results = [parse_file(path, records=True) for parse_file in PARSERS.values()]
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(
+            results[0][:3],
+            [
+                (813043, 119596593, "Юлия Николаева, 5 июн 2016 в 19:26:30\nспасибо"),
+                (
+                    813042,
+                    119596593,
+                    "Юлия Николаева, 5 июн 2016 в 19:26:26\nа до скольких?",
+                ),
+                (813036, OWNER_ID, results[0][2][2]),
+            ],
+        )
+        self.assertEqual([text for _, _, text in results[0]], PARSERS["lxml"](path))
+
+    def test_iter_records(self):
+        data = Data4Chatbot()
+        data.home_folder = "./talk_with_me/data4test"
+        chats = list(data.iter_records(limit=1))
+        self.assertEqual(
+            chats[1][-1],
+            MessageRecord(
+                813043,
+                119596593,
+                int(datetime(2016, 6, 5, 19, 26, 30, tzinfo=timezone.utc).timestamp()),
+                "спасибо",
+            ),
+        )
+        # Records are merged by author into the same messages:
+        self.assertEqual(
+            [
+                turn
+                for chat in chats
+                for turn in data._merge_turns(
+                    (record.author_id, record.text) for record in chat
+                )
+            ],
+            [message for chat in data.iter_messages(limit=1) for message in chat],
+        )
+        self.assertTrue(all(record.timestamp for chat in chats for record in chat))
+
+        data = Data4TextGeneration()
+        data.home_folder = "./talk_with_me/data4test"
+        self.assertEqual(
+            [[record.text for record in chat] for chat in data.iter_records(limit=1)],
+            data.make_data(limit=1),
+        )
+
+    def test_columns(self):
+        records = [
+            MessageRecord(1, OWNER_ID, 100, "привет"),
+            MessageRecord(2, 42, 160, "как дела"),
+            MessageRecord(3, 42, 5000, "я тут"),
+        ]
+        self.assertEqual(pickle.loads(pickle.dumps(records)), records)
+
+        columns = to_columns(records)
+        self.assertEqual(columns["id"].dtype, np.int64)
+        np.testing.assert_array_equal(columns["timestamp"], [100, 160, 5000])
+        self.assertEqual(from_columns(columns), records)
+
+        mask = columns["author_id"] == 42
+        self.assertEqual(
+            from_columns({name: column[mask] for name, column in columns.items()}),
+            records[1:],
+        )
+        self.assertEqual(from_columns(to_columns([])), [])
+
+    def test_session_bounds(self):
+        timestamps = [100, 160, 5000, 0, 9000, 9100, 20000]
+        self.assertEqual(session_bounds(timestamps, 3600).tolist(), [0, 2, 4, 6, 7])
+        self.assertEqual(session_bounds(timestamps, 1e9).tolist(), [0, 7])
+        self.assertEqual(session_bounds([5], 60).tolist(), [0, 1])
+        self.assertEqual(session_bounds([], 60).tolist(), [0, 0])
+
+        # An unknown timestamp does not hide the break around it:
+        timestamps = [0, 100, 200, 0, 36200, 0, 36300]
+        self.assertEqual(session_bounds(timestamps, 3600).tolist(), [0, 4, 7])
+
+    def test_sessions(self):
+        def user(name: str) -> str:
+            return f'<a href="https://vk.com/id1">{name}</a>'
+
+        messages = [
+            (f"{user('Юлия')}, 1 мар 2016 в 10:00:00", "Привет"),
+            ("Вы, 1 мар 2016 в 10:01:00", "Привет"),
+            ("Вы, 1 мар 2016 в 10:02:00", "Как дела?"),
+            (f"{user('Юлия')}, 1 июн 2016 в 10:00:00", "Ты тут?"),
+            (f"{user('Юлия')}, 1 июн 2016 в 10:00:30", "Ау"),
+            ("Вы, 1 июн 2016 в 10:05:00", "Да"),
+        ]
+        with tempfile.TemporaryDirectory() as dirpath:
+            path = Path(dirpath, "153164713", "messages0.html")
+            write_archive_file(path, LOCALES["ru"].breadcrumb, messages)
+
+            data = Data4Chatbot(home_folder=dirpath)
+            self.assertEqual(
+                data.make_data(limit=1),
+                [
+                    ["привет", "привет \n как дела ?"],
+                    ["привет \n как дела ?", "ты тут ? \n ау"],
+                    ["ты тут ? \n ау", "да"],
+                ],
+            )
+
+            data = Data4Chatbot(home_folder=dirpath, session_gap=6 * 3600, profile=True)
+            self.assertEqual(
+                data.make_data(limit=1),
+                [["привет", "привет \n как дела ?"], ["ты тут ? \n ау", "да"]],
+            )
+            self.assertEqual(data.profiler.counters["sessions"], 2)
+            self.assertEqual(
+                list(data.iter_messages(limit=1)),
+                [["привет", "привет \n как дела ?", "ты тут ? \n ау", "да"]],
+            )
+
+
+class TestCorpus(unittest.TestCase):
+    def test_chats(self):
+        chats = [["Привет", "", "как дела?"], [], ["👌"]]
+        with tempfile.TemporaryDirectory() as dirpath:
+            save_chats(dirpath, iter(chats))
+            corpus = Corpus(dirpath)
+            self.assertEqual(corpus.kind, "chats")
+            self.assertEqual(len(corpus), 3)
+            self.assertEqual(corpus.n_messages, 4)
+            self.assertEqual(corpus.tolist(), chats)
+            self.assertEqual(corpus[-1], ["👌"])
+            self.assertEqual(corpus.message(3), "👌")
+            self.assertRaises(IndexError, corpus.__getitem__, 3)
+
+    def test_pairs(self):
+        pairs = [["a", "b"], ["b", "c"], ["d", "e"], ["e", "e"]]
+        with tempfile.TemporaryDirectory() as dirpath:
+            save_pairs(dirpath, pairs)
+            corpus = Corpus(dirpath)
+            self.assertEqual(corpus.kind, "pairs")
+            self.assertEqual(corpus.tolist(), pairs)
+            self.assertEqual(corpus.n_messages, 6)  # `b` and `e` are shared
+
+        # Empty corpora:
+        with tempfile.TemporaryDirectory() as dirpath:
+            save_pairs(dirpath, [])
+            self.assertEqual(Corpus(dirpath).tolist(), [])
+
+    def test_save_load(self):
+        for data_class in [Data4TextGeneration, Data4Chatbot]:
+            data = data_class()
+            data.home_folder = "./talk_with_me/data4test"
+            answer = data.make_data(limit=1)
+            with tempfile.TemporaryDirectory() as dirpath:
+                data.save(dirpath, answer)
+                self.assertEqual(data.load(dirpath).tolist(), answer)
+
+                # Straight from the archive:
+                data.save(dirpath, limit=1)
+                self.assertEqual(data.load(dirpath).tolist(), answer)
+
+
+class TestVoc(unittest.TestCase):
+    def setUp(self):
+        self.pairs = [
+            ["привет", "привет как дела"],
+            ["как дела", "хорошо"],
+            ["редкое слово", "хорошо"],
+        ]
+
+    def test_add_pairs(self):
+        voc = Voc("test")
+        voc.add_pairs(self.pairs)
+        self.assertEqual(voc.num_words, 9)
+        self.assertEqual(voc.word2index["привет"], 3)
+        self.assertEqual(voc.word2count["привет"], 2)
+        self.assertEqual(voc.index2word[8], "слово")
+
+    def test_trim_pairs(self):
+        voc = Voc("test")
+        voc.add_pairs(self.pairs)
+        self.assertEqual(voc.trim_pairs(self.pairs, 2), self.pairs[:2])
+        self.assertEqual(voc.num_words, 7)
+        self.assertNotIn("редкое", voc.word2index)
+
+    def test_encode(self):
+        voc = Voc("test")
+        voc.add_pairs(self.pairs)
+        indexes, offsets = voc.encode(["как дела", "привет", "новое"])
+        self.assertEqual(indexes.tolist(), [4, 5, EOS_token, 3, EOS_token, -1, 2])
+        self.assertEqual(offsets.tolist(), [0, 3, 5, 7])
+
+    def test_fit_pairs(self):
+        for min_count in [1, 2, 4]:
+            voc = Voc("test")
+            voc.add_pairs(self.pairs)
+            answer = voc.trim_pairs(self.pairs, min_count)
+            encoded = voc.encode_pairs(answer)
+
+            fitted_voc = Voc("test")
+            pairs, fitted = fitted_voc.fit_pairs(self.pairs, min_count)
+            self.assertEqual(pairs, answer)
+            self.assertEqual(fitted_voc.__dict__, voc.__dict__)
+            for array, fitted_array in zip(encoded, fitted):
+                self.assertEqual(array.tolist(), fitted_array.tolist())
+
+
+class TestBucketBatcher(unittest.TestCase):
+    def setUp(self):
+        self.pairs = [
+            ["a", "b c"],
+            ["a b c", "a"],
+            ["b", "c c c c"],
+            ["c b", "a"],
+            ["a a", "b b"],
+        ]
+        self.voc = Voc("test")
+        self.voc.add_pairs(self.pairs)
+
+    def test_batches(self):
+        batcher = BucketBatcher(self.voc, self.pairs, batch_size=2, seed=0)
+        self.assertEqual(len(batcher), 3)  # lengths of inputs are 4, 3, 3, 2, 2
+
+        seen = []
+        for inputs, lengths, targets, mask, max_target_length in batcher:
+            input_batch = [inputs[:n, j].tolist() for j, n in enumerate(lengths)]
+            target_batch = [targets[m, j].tolist() for j, m in enumerate(mask.T)]
+
+            # The same as `zeroPadding` and `binaryMatrix` from the notebook:
+            padded = itertools.zip_longest(*input_batch, fillvalue=0)
+            self.assertEqual(inputs.tolist(), [list(row) for row in padded])
+            padded = itertools.zip_longest(*target_batch, fillvalue=0)
+            self.assertEqual(targets.tolist(), [list(row) for row in padded])
+            self.assertEqual(lengths.tolist(), sorted(lengths.tolist())[::-1])
+            self.assertEqual(max_target_length, max(map(len, target_batch)))
+            self.assertTrue(np.shares_memory(inputs, batcher.inputs))
+
+            for sentences in zip(input_batch, target_batch):
+                self.assertEqual([s[-1] for s in sentences], [EOS_token] * 2)
+                seen.append(
+                    [
+                        " ".join(self.voc.index2word[i] for i in s[:-1])
+                        for s in sentences
+                    ]
+                )
+        self.assertCountEqual(seen, self.pairs)
+
+    def test_epochs(self):
+        pairs = [[word, word] for word in "a b c a b c a b".split()]
+        pairs += [["a b", "c"], ["b c a", "a"], ["c a", "b b"]]
+        voc = Voc("test")
+        voc.add_pairs(pairs)
+        batcher = BucketBatcher(voc, pairs, batch_size=2, bucket_width=2, seed=0)
+
+        epochs = []
+        for _ in range(2):
+            batches = set()
+            for inputs, lengths, targets, mask, max_target_length in batcher:
+                self.assertEqual(lengths.tolist(), sorted(lengths.tolist())[::-1])
+                self.assertEqual(max_target_length, mask.sum(axis=0).max())
+                batches.add(tuple(map(tuple, inputs.T.tolist())))
+            epochs.append(batches)
+        self.assertNotEqual(epochs[0], epochs[1])
+
+    def test_padding_efficiency(self):
+        batcher = BucketBatcher(self.voc, self.pairs, batch_size=5)
+        self.assertEqual(len(batcher), 3)
+        self.assertEqual(batcher.padding_efficiency()["inputs"], 1.0)
+
+        batcher = BucketBatcher(self.voc, self.pairs, batch_size=5, bucket_width=4)
+        self.assertEqual(len(batcher), 1)
+        self.assertEqual(batcher.padding_efficiency()["inputs"], 14 / 20)
+
+    def test_max_length(self):
+        batcher = BucketBatcher(self.voc, self.pairs, max_length=3)
+        self.assertEqual(batcher.inputs.shape, (3, 3))
+        self.assertRaises(KeyError, BucketBatcher, self.voc, [["d", "a"]])
+
+
+class TestTokenDataset(unittest.TestCase):
+    def prepare_data(self, text, batch_size, seq_size):
+        """`prepare_data_from_file` from `GenerationLSTM.ipynb`."""
+
+        text = text.split()
+        word_counts = Counter(text)
+        sorted_vocab = sorted(word_counts, key=word_counts.get, reverse=True)
+        vocab_to_int = {w: k for k, w in enumerate(sorted_vocab)}
+        int_text = [vocab_to_int[w] for w in text]
+        num_batches = int(len(int_text) / (seq_size * batch_size))
+        in_text = int_text[: num_batches * batch_size * seq_size]
+        out_text = np.zeros_like(in_text)
+        out_text[:-1] = in_text[1:]
+        out_text[-1] = in_text[0]
+        in_text = np.reshape(in_text, (batch_size, -1))
+        out_text = np.reshape(out_text, (batch_size, -1))
+        return vocab_to_int, in_text, out_text
+
+    def test_build(self):
+        texts = ["a b c a", "b\nd  a", "e f a b c"]
+        with tempfile.TemporaryDirectory() as dirpath:
+            TokenDataset.build(dirpath, texts)
+            vocab_to_int, in_text, out_text = self.prepare_data(" ".join(texts), 2, 3)
+
+            dataset = TokenDataset(dirpath, batch_size=2, seq_size=3)
+            self.assertEqual(dataset.vocab_to_int, vocab_to_int)
+            self.assertEqual(dataset.num_batches, 2)
+            self.assertEqual(dataset.in_text.tolist(), in_text.tolist())
+            self.assertEqual(dataset.out_text.tolist(), out_text.tolist())
+            self.assertEqual(len(list(dataset.get_batches())), 2)
+            for x, y in dataset.get_batches():
+                self.assertEqual(x.shape, (2, 3))
+                self.assertTrue(np.shares_memory(x, dataset.tokens))
+
+            # Truncated text, the last target is the next word:
+            dataset = TokenDataset(dirpath, batch_size=1, seq_size=5)
+            self.assertEqual(
+                dataset.decode(dataset.out_text[0]), "b c a b d a e f a b".split()
+            )
+
+    def test_from_file(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            text_path = Path(dirpath, "text.txt")
+            text_path.write_text("привет как дела\nпривет\n")
+            path = str(Path(dirpath, "dataset"))
+            dataset = TokenDataset.from_file(str(text_path), path, 1, 2)
+            self.assertEqual(dataset.n_vocab, 3)
+            self.assertEqual(dataset.num_batches, 2)
+            self.assertEqual(
+                dataset.decode(dataset.in_text[0]), ["привет", "как", "дела", "привет"]
+            )
+
+            # Empty corpus:
+            TokenDataset.build(path, [])
+            self.assertEqual(TokenDataset(path, 1, 2).num_batches, 0)
+
+
+class TestDedup(unittest.TestCase):
+    def test_hash_index(self):
+        index = HashIndex(capacity=4)
+        self.assertEqual(
+            [index.add(key) for key in [5, 0, 5, 1, 2**64 + 5]], [0, 0, 1, 1, 2]
+        )
+        for key in range(100, 200):
+            index.add(key)
+        self.assertEqual(len(index), 102)
+        self.assertIn(150, index)
+        self.assertEqual(index.add(5), 3)  # the counts survive growing
+
+        # Full index does not remember new hashes:
+        index = HashIndex(max_items=1)
+        self.assertEqual([index.add(key) for key in [1, 2, 2, 1]], [0, 0, 0, 1])
+
+    def test_filter(self):
+        dedup = Deduplicator()
+        self.assertEqual(dedup.filter(["ок", "привет", "ок"], "a"), ["ок", "привет"])
+        self.assertEqual(dedup.filter(["ок", "пока"], "b"), ["пока"])
+        pairs = [["ок", "привет"], ["ок", "привет"], ["привет", "ок"]]
+        self.assertEqual(dedup.filter_pairs(pairs, "c"), [pairs[0], pairs[2]])
+        stats = dedup.stats()
+        self.assertEqual(
+            stats["overall"], {"total": 8, "duplicates": 3, "ratio": 3 / 8}
+        )
+        self.assertEqual(stats["chats"]["b"]["ratio"], 0.5)
+
+        # Down-weighting keeps a few copies:
+        dedup = Deduplicator(max_copies=2)
+        self.assertEqual(dedup.filter(["ок"] * 5), ["ок", "ок"])
+
+        # Near-duplicates:
+        messages = ["привет как дела что делаешь", "привет, как дела что делаешь"]
+        self.assertEqual(Deduplicator().filter(messages), messages)
+        self.assertEqual(Deduplicator(near=True).filter(messages), messages[:1])
+
+        # Distinct short messages are not near-duplicates:
+        messages = [
+            "привет как дела",
+            "привет что делаешь",
+            "пойдем в кино завтра",
+            "пойдем в парк завтра",
+            "hello there",
+            "hi there",
+            "спасибо",
+            "спасибо большое",
+        ]
+        self.assertEqual(Deduplicator(near=True).filter(messages), messages)
+
+    def test_make_data(self):
+        archive = "./talk_with_me/data4test"
+        for data_class in [Data4TextGeneration, Data4Chatbot]:
+            answer = data_class(home_folder=archive).make_data(limit=1)
+            for n_jobs in [1, 2]:
+                data = data_class(home_folder=archive, n_jobs=n_jobs, dedup=1)
+                result = data.make_data(limit=1)
+                items = list(itertools.chain.from_iterable(result))
+                if data_class is Data4TextGeneration:
+                    self.assertEqual(len(result), len(answer))
+                    self.assertEqual(
+                        items, list(dict.fromkeys(itertools.chain(*answer)))
+                    )
+                else:
+                    self.assertEqual(
+                        list(map(tuple, result)),
+                        list(dict.fromkeys(map(tuple, answer))),
+                    )
+                self.assertEqual(
+                    set(data.dedup.stats()["chats"]), {"153164713", "153164714"}
+                )
+                # The index stays in the parent process:
+                self.assertIsNone(pickle.loads(pickle.dumps(data)).dedup)
+
+
+@unittest.skipIf(torch is None, "torch is not installed")
+class TestBatchDecoder(unittest.TestCase):
+    def setUp(self):
+        from .decoding import BatchDecoder
+        from .seq2seq import EncoderRNN, LuongAttnDecoderRNN
+
+        torch.manual_seed(0)
+        self.voc = Voc("test")
+        self.voc.add_sentences(
+            ["привет как дела", "хорошо а у тебя", "что делаешь", "ничего"]
+        )
+        embedding = torch.nn.Embedding(self.voc.num_words, 16)
+        encoder = EncoderRNN(16, embedding, n_layers=2)
+        decoder = LuongAttnDecoderRNN("dot", embedding, 16, self.voc.num_words, 2)
+        self.decoder = BatchDecoder(encoder, decoder, self.voc, max_length=6)
+        self.sentences = ["привет", "как дела у тебя", "что", "ничего хорошо"]
+
+    def test_greedy(self):
+        replies = self.decoder.decode(self.sentences)
+        self.assertEqual(len(replies), len(self.sentences))
+        for sentence, words in zip(self.sentences, replies):
+            # Padding of the batch does not change the replies:
+            self.assertEqual(self.decoder.decode([sentence]), [words])
+            self.assertLessEqual(len(words), 6)
+            self.assertNotIn("EOS", words)
+        self.assertEqual(
+            self.decoder.reply(self.sentences), [" ".join(w) for w in replies]
+        )
+
+        # Unknown words are skipped:
+        self.assertEqual(
+            self.decoder.decode(["привет незнакомое"]), self.decoder.decode(["привет"])
+        )
+        self.assertEqual(self.decoder.decode([]), [])
+        self.assertRaises(ValueError, self.decoder.decode, ["привет"], "unknown")
+
+    def test_perplexity(self):
+        pairs = [["привет", "как дела"], ["что", "ничего"], ["как", "хорошо а у тебя"]]
+        perplexity = self.decoder.perplexity(pairs)
+        # Random models are about uniform over the vocabulary:
+        self.assertTrue(1 < perplexity < 2 * self.voc.num_words)
+        self.assertAlmostEqual(
+            self.decoder.perplexity(pairs, batch_size=1), perplexity, places=4
+        )
+
+    def test_sample(self):
+        greedy = self.decoder.decode(self.sentences)
+        self.assertEqual(self.decoder.decode(self.sentences, "sample", top_k=1), greedy)
+        generator = torch.Generator().manual_seed(0)
+        replies = self.decoder.decode(
+            self.sentences, "sample", top_k=5, generator=generator
+        )
+        generator = torch.Generator().manual_seed(0)
+        self.assertEqual(
+            self.decoder.decode(self.sentences, "sample", top_k=5, generator=generator),
+            replies,
+        )
+
+    def test_beam(self):
+        greedy = self.decoder.decode(self.sentences)
+        self.assertEqual(
+            self.decoder.decode(self.sentences, "beam", beam_size=1), greedy
+        )
+        replies = self.decoder.decode(self.sentences, "beam", beam_size=4)
+        for sentence, words in zip(self.sentences, replies):
+            self.assertEqual(
+                self.decoder.decode([sentence], "beam", beam_size=4), [words]
+            )
+            self.assertLessEqual(len(words), 6)
+
+
+@unittest.skipIf(torch is None, "torch is not installed")
+class TestTextGenerator(unittest.TestCase):
+    def test_generate(self):
+        from .generation import RNNModule, TextGenerator
+
+        torch.manual_seed(0)
+        vocab = ["привет", "как", "дела", "хорошо", "а", "у", "тебя"]
+        generator = TextGenerator(RNNModule(len(vocab), 32, 8, 8), vocab, length=5)
+        prompts = ["привет как", "дела", "незнакомое"]
+        texts = generator.generate(prompts, torch.Generator().manual_seed(0))
+        for prompt, text in zip(prompts, texts):
+            self.assertTrue(text.startswith(prompt + " "))
+            self.assertEqual(len(text.split()), len(prompt.split()) + 5)
+        self.assertEqual(
+            generator.generate(prompts, torch.Generator().manual_seed(0)), texts
+        )
+        self.assertEqual(generator.generate([]), [])
+
+    def test_conversations(self):
+        from .generation import RNNModule, TextGenerator
+
+        torch.manual_seed(0)
+        vocab = ["привет", "как", "дела", "хорошо", "а", "у", "тебя"]
+        net = RNNModule(len(vocab), 32, 8, 8)
+        cache = StateCache()
+        cached = TextGenerator(net, vocab, length=3, cache=cache)
+        plain = TextGenerator(net, vocab, length=3)
+
+        first = cached.generate(["привет"], conversations=["a"])
+        second = cached.generate(
+            ["как дела", "у тебя"],
+            torch.Generator().manual_seed(1),
+            conversations=["a", "b"],
+        )
+        # The cached turn continues the text of the first one:
+        expected = plain.generate(
+            [first[0] + " как дела", "у тебя"], torch.Generator().manual_seed(1)
+        )
+        self.assertEqual(expected[0], first[0] + " " + second[0])
+        self.assertEqual(expected[1], second[1])
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["saved_tokens"], 4)
+        self.assertEqual(cache.get("a")[1], 9)
+
+
+async def http_request(port: int, method: str, path: str, body: bytes = b"") -> tuple:
+    """Status and json payload of a request to the local server."""
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, data = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(data.decode("utf-8"))
+
+
+@unittest.skipIf(torch is None, "torch is not installed")
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_chatbot(self):
+        from .decoding import BatchDecoder
+        from .export import export_chatbot, load_batch_decoder, reply_agreement
+        from .seq2seq import EncoderRNN, LuongAttnDecoderRNN
+
+        voc = Voc("test")
+        voc.add_sentences(["привет как дела", "хорошо а у тебя", "что делаешь"])
+        embedding = torch.nn.Embedding(voc.num_words, 16)
+        encoder = EncoderRNN(16, embedding, n_layers=2)
+        decoder = LuongAttnDecoderRNN("dot", embedding, 16, voc.num_words, 2)
+        eager = BatchDecoder(encoder, decoder, voc, max_length=6)
+        pairs = [["привет", "как дела"], ["что делаешь", "хорошо а у тебя"]]
+        sentences = ["привет", "как дела у тебя", "что", "делаешь хорошо"]
+
+        for quantized in [False, True]:
+            path = os.path.join(self.tmp.name, f"chatbot-{quantized}.pt")
+            export_chatbot(encoder, decoder, voc, path, quantized)
+            exported = load_batch_decoder(path, max_length=6)
+            self.assertEqual(exported.voc.index2word, voc.index2word)
+            replies = exported.decode(sentences)
+            self.assertEqual(len(replies), len(sentences))
+            if not quantized:
+                self.assertEqual(reply_agreement(eager, exported, sentences), 1.0)
+                self.assertAlmostEqual(
+                    exported.perplexity(pairs), eager.perplexity(pairs), places=3
+                )
+            else:
+                self.assertTrue(exported.perplexity(pairs) > 1)
+
+    def test_generator(self):
+        from .export import export_generator, load_text_generator
+        from .generation import RNNModule, TextGenerator
+
+        vocab = ["привет", "как", "дела", "хорошо", "а", "у", "тебя"]
+        net = RNNModule(len(vocab), 32, 8, 8)
+        eager = TextGenerator(net, vocab, length=4)
+        tokens = torch.randint(len(vocab), (3, 9)).numpy()
+        batches = [(tokens[:, :-1], tokens[:, 1:])]
+
+        for quantized in [False, True]:
+            path = os.path.join(self.tmp.name, f"generator-{quantized}.pt")
+            export_generator(net, vocab, path, quantized)
+            exported = load_text_generator(path, length=4)
+            self.assertEqual(exported.int_to_vocab, vocab)
+            # int8 weights change the perplexity by a few percent at most:
+            self.assertAlmostEqual(
+                exported.perplexity(batches),
+                eager.perplexity(batches),
+                delta=0.05 * eager.perplexity(batches) if quantized else 1e-4,
+            )
+            prompts = ["привет как", "у"]
+            generator = torch.Generator().manual_seed(0)
+            texts = exported.generate(prompts, generator)
+            if not quantized:
+                generator = torch.Generator().manual_seed(0)
+                self.assertEqual(eager.generate(prompts, generator), texts)
+            for prompt, text in zip(prompts, texts):
+                self.assertEqual(len(text.split()), len(prompt.split()) + 4)
+
+
+class TestStateCache(unittest.TestCase):
+    def test_lru(self):
+        cache = StateCache(max_entries=2)
+        cache.set("a", (np.zeros(4), np.zeros(4)), 3)
+        cache.set("b", np.zeros(8), 5)
+        self.assertEqual(cache.nbytes, 128)
+        self.assertEqual(cache.get("a")[1], 3)
+        cache.set("c", np.zeros(8), 1)  # evicts "b", the least recently used
+        self.assertNotIn("b", cache)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.nbytes, 128)
+        self.assertEqual(
+            {k: cache.stats()[k] for k in ["hits", "misses", "evictions"]},
+            {"hits": 1, "misses": 1, "evictions": 1},
+        )
+        self.assertEqual(cache.stats()["saved_tokens"], 3)
+        self.assertEqual(cache.hit_rate, 0.5)
+        cache.pop("a")
+        self.assertEqual((len(cache), cache.nbytes), (1, 64))
+
+    def test_memory_limit(self):
+        cache = StateCache(max_bytes=100)
+        cache.set("a", np.zeros(8), 1)
+        cache.set("b", np.zeros(6), 1)  # 112 bytes in total evict "a"
+        self.assertEqual(("a" in cache, "b" in cache), (False, True))
+        cache.set("c", np.zeros(16), 1)  # larger than the limit alone
+        self.assertNotIn("c", cache)
+        cache.set("b", np.zeros(8), 1)  # replaced, not counted twice
+        self.assertEqual(cache.nbytes, 64)
+        self.assertEqual(state_nbytes([np.zeros(2), (np.zeros(3), "text")]), 40)
+
+
+class TestServe(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        values = [10, 20, 30, 40]
+        self.assertEqual(percentile(values, 50), 20)
+        self.assertEqual(percentile(values, 75), 30)
+        self.assertEqual(percentile(values, 99), 40)
+        self.assertEqual(percentile(values, 0), 10)
+        self.assertEqual(percentile([5], 50), 5)
+        self.assertIsNone(percentile([], 50))
+
+    def test_server(self):
+        batch_sizes = []
+
+        def handler(messages, conversations):
+            batch_sizes.append(len(messages))
+            if "ошибка" in messages:
+                raise ValueError("bad message")
+            return [
+                message.upper() if conversation is None else conversation
+                for message, conversation in zip(messages, conversations)
+            ]
+
+        async def scenario():
+            batcher = MicroBatcher(handler, max_batch_size=8, max_wait=0.05)
+            server = InferenceServer(batcher, port=0)
+            await server.start()
+            try:
+                messages = [f"сообщение {i}" for i in range(20)]
+                responses = await asyncio.gather(
+                    *(
+                        http_request(
+                            server.port,
+                            "POST",
+                            "/reply",
+                            json.dumps({"message": m}).encode("utf-8"),
+                        )
+                        for m in messages
+                    )
+                )
+                self.assertEqual(
+                    responses, [(200, {"reply": m.upper()}) for m in messages]
+                )
+                # Concurrent requests are served in batches:
+                self.assertLess(len(batch_sizes), len(messages))
+                self.assertLessEqual(max(batch_sizes), 8)
+
+                status, metrics = await http_request(server.port, "GET", "/metrics")
+                self.assertEqual(status, 200)
+                self.assertEqual(metrics["requests"], 20)
+                self.assertEqual(metrics["batches"], len(batch_sizes))
+                self.assertGreater(metrics["throughput_rps"], 0)
+                self.assertLessEqual(
+                    metrics["latency_ms"]["p50"], metrics["latency_ms"]["p99"]
+                )
+
+                body = json.dumps({"message": "а", "conversation": "42"})
+                self.assertEqual(
+                    await http_request(
+                        server.port, "POST", "/reply", body.encode("utf-8")
+                    ),
+                    (200, {"reply": "42"}),
+                )
+                body = json.dumps({"message": "а", "conversation": 42})
+                status, _ = await http_request(
+                    server.port, "POST", "/reply", body.encode("utf-8")
+                )
+                self.assertEqual(status, 400)
+
+                body = json.dumps({"message": "ошибка"}).encode("utf-8")
+                status, _ = await http_request(server.port, "POST", "/reply", body)
+                self.assertEqual(status, 500)
+                status, _ = await http_request(server.port, "POST", "/reply", b"{")
+                self.assertEqual(status, 400)
+                status, _ = await http_request(server.port, "GET", "/reply")
+                self.assertEqual(status, 405)
+                status, _ = await http_request(server.port, "GET", "/unknown")
+                self.assertEqual(status, 404)
+                self.assertEqual(
+                    await http_request(server.port, "GET", "/health"),
+                    (200, {"status": "ok"}),
+                )
+            finally:
+                await server.stop()
+
+        asyncio.run(scenario())
+
+
+class TestCli(unittest.TestCase):
+    def test_output_paths(self):
+        self.assertEqual(output_paths(["a/b"], "out"), ["out"])
+        self.assertEqual(
+            output_paths(["a/b", "c/b/", "d/messages"], "out"),
+            [
+                os.path.join("out", "b"),
+                os.path.join("out", "b_2"),
+                os.path.join("out", "d"),
+            ],
+        )
+
+    def test_main(self):
+        archive = "./talk_with_me/data4test"
+        with tempfile.TemporaryDirectory() as dirpath:
+            output = str(Path(dirpath, "pairs"))
+            self.assertEqual(main([archive, "--limit", "1", "--output", output]), 0)
+            self.assertEqual(
+                Corpus(output).tolist(),
+                Data4Chatbot(home_folder=archive).make_data(limit=1),
+            )
+
+            # Several archives, one of which does not exist:
+            output = str(Path(dirpath, "chats"))
+            argv = [archive, archive + "/", str(Path(dirpath, "none")), "--limit", "1"]
+            argv += ["--mode", "text", "--format", "jsonl", "--output", output]
+            self.assertEqual(main(argv), 1)
+            answer = Data4TextGeneration(home_folder=archive).make_data(limit=1)
+            for name in ["data4test", "data4test_2"]:
+                with open(Path(output, name), encoding="utf-8") as f:
+                    self.assertEqual([json.loads(line) for line in f], answer)
+
+            # Near-duplicates are a mode of deduplication:
+            with self.assertRaises(SystemExit):
+                main([archive, "--near-duplicates", "--output", output])
+
+            # A bad config fails the archive, not the whole run:
+            argv = [archive, "--config", str(Path(dirpath, "none.json"))]
+            self.assertEqual(main(argv + ["--output", output]), 1)
+
+            # The default config does not depend on the current directory:
+            cwd = os.getcwd()
+            os.chdir(dirpath)
+            try:
+                argv = [os.path.join(cwd, archive), "--limit", "1"]
+                self.assertEqual(main(argv + ["--output", "pairs"]), 0)
+            finally:
+                os.chdir(cwd)
+
 
 class TestPerfectRegex(unittest.TestCase):
     def test_telephone_numbers(self):
@@ -0,0 +1,154 @@
+"""
+Memory-mapped dataset of words for training the LSTM text generator.
+"""
+
+import json
+import os
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Tuple
+import numpy as np
+
+# Number of tokens remapped at once while building the dataset:
+CHUNK_SIZE = 1 << 18
+
+
+class TokenDataset:
+    """
+    Corpus encoded into a file of int32 word indexes and served as
+    `(batch_size, seq_size)` windows of memory-mapped views.
+
+    It gives the same data as `prepare_data_from_file` and `get_batches`
+    from `GenerationLSTM.ipynb`: the vocabulary is sorted by word counts,
+    the text is split into `batch_size` rows and the targets are the inputs
+    shifted by one word. The only difference is that the last target is
+    the next word of the corpus (or the first word if there is no next one).
+
+    Parameters
+    ----------
+    path : str
+        Folder of the dataset made by `TokenDataset.build`.
+    batch_size : int
+        Number of rows of the text.
+    seq_size : int
+        Number of words in a window.
+    """
+
+    def __init__(self, path: str, batch_size: int, seq_size: int):
+        self.path = path
+        self.batch_size = batch_size
+        self.seq_size = seq_size
+
+        vocab = self.load_vocab(path)
+        self.int_to_vocab: Dict[int, str] = dict(enumerate(vocab))
+        self.vocab_to_int: Dict[str, int] = {w: k for k, w in enumerate(vocab)}
+        self.n_vocab = len(vocab)
+
+        # The file ends with one extra token, the target of the last word:
+        tokens_path = os.path.join(path, "tokens.bin")
+        if os.path.getsize(tokens_path):
+            self.tokens = np.memmap(tokens_path, dtype=np.int32, mode="r")
+        else:  # empty files can not be memory-mapped
+            self.tokens = np.zeros(0, dtype=np.int32)
+        n_tokens = max(len(self.tokens) - 1, 0)
+
+        self.num_batches = n_tokens // (seq_size * batch_size)
+        size = self.num_batches * batch_size * seq_size
+        self.in_text = self.tokens[:size].reshape(batch_size, -1)
+        self.out_text = self.tokens[1 : size + 1].reshape(batch_size, -1)
+
+    @staticmethod
+    def load_vocab(path: str) -> List[str]:
+        """Words of the dataset in `path`, sorted by their counts."""
+
+        with open(os.path.join(path, "vocab.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    @staticmethod
+    def build(path: str, texts: Iterable[str]) -> None:
+        """
+        Encode texts into a dataset in one pass, keeping in memory only
+        the vocabulary.
+
+        Parameters
+        ----------
+        path : str
+            Folder of the dataset.
+        texts : iterable of str
+            Texts to split into words by whitespaces, for example lines
+            of a file or messages from `Data4TextGeneration.iter_messages`.
+        """
+
+        os.makedirs(path, exist_ok=True)
+        tokens_path = os.path.join(path, "tokens.bin")
+
+        # Write indexes in the order of the first occurrence of words,
+        # as the final order is known only after counting all of them:
+        word_counts: Counter = Counter()
+        first_index: Dict[str, int] = {}
+
+        def write(words: List[str]) -> None:
+            word_counts.update(words)
+            for word in dict.fromkeys(words):
+                if word not in first_index:
+                    first_index[word] = len(first_index)
+            f.write(
+                np.fromiter(
+                    map(first_index.__getitem__, words),
+                    dtype=np.int32,
+                    count=len(words),
+                ).tobytes()
+            )
+
+        with open(tokens_path, "wb") as f:
+            words: List[str] = []
+            for text in texts:
+                words.extend(text.split())
+                if len(words) >= CHUNK_SIZE:
+                    write(words)
+                    words = []
+            write(words)
+
+        sorted_vocab = sorted(word_counts, key=word_counts.get, reverse=True)
+        mapping = np.zeros(len(sorted_vocab), dtype=np.int32)
+        mapping[[first_index[word] for word in sorted_vocab]] = np.arange(
+            len(sorted_vocab)
+        )
+
+        n_tokens = os.path.getsize(tokens_path) // 4
+        if n_tokens:
+            tokens = np.memmap(tokens_path, dtype=np.int32, mode="r+")
+            for start in range(0, n_tokens, CHUNK_SIZE):
+                tokens[start : start + CHUNK_SIZE] = mapping[
+                    tokens[start : start + CHUNK_SIZE]
+                ]
+            first = tokens[0]
+            tokens.flush()
+            del tokens
+            with open(tokens_path, "ab") as f:
+                f.write(np.int32(first).tobytes())
+
+        with open(os.path.join(path, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(sorted_vocab, f, ensure_ascii=False)
+
+    @classmethod
+    def from_file(
+        cls, text_path: str, path: str, batch_size: int, seq_size: int
+    ) -> "TokenDataset":
+        """Build the dataset from a text file, if not built yet, and open it."""
+
+        if not os.path.exists(os.path.join(path, "vocab.json")):
+            with open(text_path, "r") as f:
+                cls.build(path, f)
+        return cls(path, batch_size, seq_size)
+
+    def get_batches(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Windows of inputs and targets, views of the memory-mapped file."""
+
+        for i in range(0, self.num_batches * self.seq_size, self.seq_size):
+            yield (
+                self.in_text[:, i : i + self.seq_size],
+                self.out_text[:, i : i + self.seq_size],
+            )
+
+    def decode(self, indexes: Iterable[int]) -> List[str]:
+        return [self.int_to_vocab[int(i)] for i in indexes]
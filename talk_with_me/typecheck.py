@@ -0,0 +1,27 @@
+"""
+Runtime type checking of arguments, enabled only for debugging and tests.
+
+Set the environment variable `TALK_WITH_ME_TYPECHECK=1` before importing
+the package to wrap the decorated functions with `typeguard.typechecked`.
+Otherwise the decorator returns functions as they are, so they cost nothing
+per call and typeguard is not even imported.
+
+The flag is read once, when the modules are imported, so the tests, which
+check the arguments, set it in `conftest.py` at the root of the repository
+before pytest imports the package.
+"""
+import os
+from typing import Callable, TypeVar
+
+ENABLED = os.environ.get("TALK_WITH_ME_TYPECHECK", "0") not in ("", "0")
+
+F = TypeVar("F", bound=Callable)
+
+
+def typechecked(func: F) -> F:
+    if not ENABLED:
+        return func
+
+    from typeguard import typechecked as typeguard_typechecked
+
+    return typeguard_typechecked(func)
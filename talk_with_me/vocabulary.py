@@ -0,0 +1,256 @@
+"""
+Vocabulary of the chatbot and encoding of pairs of messages into indexes.
+"""
+from itertools import chain, repeat
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+
+# Default word tokens
+PAD_token = 0  # Used for padding short sentences
+SOS_token = 1  # Start-of-sentence token
+EOS_token = 2  # End-of-sentence token
+
+# Indexes and offsets of questions, indexes and offsets of answers:
+PairIndexes = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+class Voc:
+    """
+    Vocabulary built from normalized messages, words are separated by spaces.
+
+    Has the same attributes as `Voc` from the chatbot notebook, so
+    `voc.__dict__` of the checkpoints is compatible, but all the work
+    is done with bulk operations over the whole list of sentences.
+
+    Parameters
+    ----------
+    name : str
+        Name of the vocabulary.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trimmed = False
+        self._reset()
+
+    def _reset(self) -> None:
+        self.word2index: Dict[str, int] = {}
+        self.word2count: Dict[str, int] = {}
+        self.index2word = {PAD_token: "PAD", SOS_token: "SOS", EOS_token: "EOS"}
+        self.num_words = 3  # Count SOS, EOS, PAD
+
+    @staticmethod
+    def split(sentences: List[str]) -> Tuple[List[str], np.ndarray]:
+        """
+        Split all sentences at once.
+
+        Returns
+        -------
+        list of str
+            Words of all sentences one after another.
+        np.ndarray
+            Number of words in every sentence.
+        """
+
+        # Joining with spaces and splitting once is the same
+        # as splitting each sentence, empty words included:
+        words = " ".join(sentences).split(" ") if sentences else []
+        lengths = np.fromiter(
+            map(str.count, sentences, repeat(" ")),
+            dtype=np.int64,
+            count=len(sentences),
+        )
+        return words, lengths + 1
+
+    def _add_counts(self, counts: Dict[str, int]) -> None:
+        for word, count in counts.items():
+            if word in self.word2index:
+                self.word2count[word] += count
+            else:
+                self.word2index[word] = self.num_words
+                self.word2count[word] = count
+                self.index2word[self.num_words] = word
+                self.num_words += 1
+
+    def _add_words(self, words: List[str]) -> np.ndarray:
+        """
+        Add words in the order of their first occurrence.
+
+        Returns
+        -------
+        np.ndarray
+            int32 indexes of the words.
+        """
+
+        for word in dict.fromkeys(words):
+            if word not in self.word2index:
+                self.word2index[word] = self.num_words
+                self.word2count[word] = 0
+                self.index2word[self.num_words] = word
+                self.num_words += 1
+
+        indexes = self._lookup(words)
+        counts = np.bincount(indexes, minlength=self.num_words).tolist()
+        for word, index in self.word2index.items():
+            self.word2count[word] += counts[index]
+        return indexes
+
+    def add_sentences(self, sentences: Iterable[str]) -> None:
+        """Add words of the sentences, in the order of their first occurrence."""
+
+        self._add_words(self.split(list(sentences))[0])
+
+    def add_pairs(self, pairs: Iterable[List[str]]) -> None:
+        self.add_sentences(chain.from_iterable(pairs))
+
+    def trim(self, min_count: int) -> None:
+        """
+        Remove words below a certain count threshold.
+
+        Unlike the notebook version the counts of the kept words are preserved.
+        """
+
+        if self.trimmed:
+            return
+        self.trimmed = True
+
+        counts = {k: v for k, v in self.word2count.items() if v >= min_count}
+        self._reset()
+        self._add_counts(counts)
+
+    @staticmethod
+    def _add_eos(
+        indexes: np.ndarray, lengths: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Append `EOS_token` to every sentence of `indexes` with `lengths` words.
+
+        Returns
+        -------
+        np.ndarray
+            int32 indexes of all sentences one after another.
+        np.ndarray
+            int64 offsets, sentence `i` is `indexes[offsets[i]:offsets[i + 1]]`.
+        """
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths + 1, out=offsets[1:])
+
+        # Shift every word by the number of EOS tokens before it:
+        result = np.full(offsets[-1], EOS_token, dtype=np.int32)
+        positions = np.arange(len(indexes)) + np.repeat(
+            np.arange(len(lengths)), lengths
+        )
+        result[positions] = indexes
+        return result, offsets
+
+    def _lookup(self, words: List[str], unknown: int = -1) -> np.ndarray:
+        return np.fromiter(
+            map(self.word2index.get, words, repeat(unknown)),
+            dtype=np.int32,
+            count=len(words),
+        )
+
+    def encode(
+        self, sentences: List[str], unknown: int = -1
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Encode sentences into indexes of words, each followed by `EOS_token`.
+
+        Parameters
+        ----------
+        sentences : list of str
+            Sentences to encode.
+        unknown : int (default=-1)
+            Index of the words which are not in the vocabulary.
+
+        Returns
+        -------
+        np.ndarray
+            int32 indexes of all sentences one after another.
+        np.ndarray
+            int64 offsets, sentence `i` is `indexes[offsets[i]:offsets[i + 1]]`.
+        """
+
+        words, lengths = self.split(sentences)
+        return self._add_eos(self._lookup(words, unknown), lengths)
+
+    def encode_pairs(self, pairs: List[List[str]]) -> PairIndexes:
+        """
+        Encode questions and answers of pairs, see `encode`.
+
+        Returns
+        -------
+        tuple of np.ndarray
+            Indexes and offsets of questions, indexes and offsets of answers.
+        """
+
+        questions, answers = zip(*pairs) if pairs else ((), ())
+        return (*self.encode(list(questions)), *self.encode(list(answers)))
+
+    def trim_pairs(self, pairs: List[List[str]], min_count: int) -> List[List[str]]:
+        """
+        Trim words used under the `min_count` from the vocabulary and
+        keep only pairs that do not contain trimmed words.
+        """
+
+        self.trim(min_count)
+        if not pairs:
+            return []
+
+        indexes, offsets = self.encode(list(chain.from_iterable(pairs)))
+        unknown = np.minimum.reduceat(indexes, offsets[:-1]) < 0
+        keep = np.flatnonzero(~(unknown[0::2] | unknown[1::2]))
+        return [pairs[i] for i in keep]
+
+    def fit_pairs(
+        self, pairs: List[List[str]], min_count: int = 1
+    ) -> Tuple[List[List[str]], PairIndexes]:
+        """
+        Add words of the pairs, trim the rare ones and encode the kept pairs,
+        splitting and looking up every word only once.
+
+        It is the same as `add_pairs`, `trim_pairs` and `encode_pairs` in turn.
+
+        Returns
+        -------
+        list of lists of str
+            Pairs that do not contain trimmed words.
+        tuple of np.ndarray
+            Encoded kept pairs, see `encode_pairs`.
+        """
+
+        words, lengths = self.split(list(chain.from_iterable(pairs)))
+        indexes = self._add_words(words)
+
+        if not self.trimmed:
+            old_index = self.word2index
+            self.trim(min_count)
+
+            # Map the old indexes to the new ones or to -1 for trimmed words:
+            mapping = np.full(len(old_index) + 3, -1, dtype=np.int32)
+            mapping[:3] = np.arange(3)
+            mapping[[old_index[word] for word in self.word2index]] = list(
+                self.word2index.values()
+            )
+            indexes = mapping[indexes]
+
+        # Sentences go in turn: question, answer, question, answer...
+        keep = np.ones(len(lengths), dtype=bool)
+        if len(indexes):
+            starts = np.zeros(len(lengths), dtype=np.int64)
+            np.cumsum(lengths[:-1], out=starts[1:])
+            unknown = np.minimum.reduceat(indexes, starts) < 0
+            keep = np.repeat(~(unknown[0::2] | unknown[1::2]), 2)
+        is_question = np.zeros(len(lengths), dtype=bool)
+        is_question[0::2] = True
+
+        encoded = []
+        for sentences in [keep & is_question, keep & ~is_question]:
+            encoded.extend(
+                self._add_eos(
+                    indexes[np.repeat(sentences, lengths)], lengths[sentences]
+                )
+            )
+        kept_pairs = [pairs[i] for i in np.flatnonzero(keep[0::2])]
+        return kept_pairs, tuple(encoded)